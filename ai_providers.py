@@ -2,118 +2,722 @@
 # -*- coding:utf-8 -*-
 #一个AI服务的简单封装，提供一个统一的借口
 #Author: cdhigh <https://github.com/cdhigh>
-import os, sys, json, ssl
-import http.client
+import os, sys, re, json, ssl, time, threading, random, contextvars, asyncio, functools
+import http.client, zlib, gzip
+from collections import namedtuple
 from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+try:
+    import brotli #可选，安装后支持br压缩的响应
+except ImportError:
+    brotli = None
 
 #支持的AI服务商列表，models里面的第一项请设置为默认要使用的model
 #context: 输入上下文长度，因为程序采用估计法，建议设小一些。注意：一般的AI的输出长度较短，大约4k/8k
+#output: 最大输出token数量，需要明显小于context，同时用于计算每个批次的大小
+#  请求时发送的 max_tokens 不超过 context 减去提示词的token数量，避免超出模型的上下文长度被服务器拒绝
 #rpm(requests per minute)是针对免费用户的，如果是付费用户，一般会高很多，可以自己修改
+#tpm/tpd: 每分钟/每天的token数量限制，0或者没有提供为不限制，服务器返回速率限制响应头时以响应头为准
+#price: 每百万token的价格(美元)，(输入, 输出)，用于统计费用和 --max-cost
 #大语言模型发展迅速，估计没多久这些数据会全部过时
 AI_LIST = {
     'google': {'host': 'https://generativelanguage.googleapis.com', 'models': [
-        {'name': 'gemini-1.5-flash', 'rpm': 60, 'context': 128000}, #其实支持100万
-        {'name': 'gemini-1.5-flash-8b', 'rpm': 60, 'context': 128000},
-        {'name': 'gemini-1.5-pro', 'rpm': 10, 'context': 128000},
-        {'name': 'gemini-2.0-flash-exp', 'rpm': 10, 'context': 128000},
-        {'name': 'gemini-2.0-flash-thinking-exp', 'rpm': 10, 'context': 128000},],},
+        {'name': 'gemini-1.5-flash', 'rpm': 60, 'context': 128000, #其实支持100万
+            'output': 8192, 'tpm': 1000000, 'price': (0.075, 0.3)},
+        {'name': 'gemini-1.5-flash-8b', 'rpm': 60, 'context': 128000, 'output': 8192, 'tpm': 1000000, 
+            'price': (0.0375, 0.15)},
+        {'name': 'gemini-1.5-pro', 'rpm': 10, 'context': 128000, 'output': 8192, 'tpm': 32000, 
+            'price': (1.25, 5.0)},
+        {'name': 'gemini-2.0-flash-exp', 'rpm': 10, 'context': 128000, 'output': 8192, 'tpm': 4000000, 
+            'price': (0, 0)},
+        {'name': 'gemini-2.0-flash-thinking-exp', 'rpm': 10, 'context': 128000, 'output': 8192, 'tpm': 4000000, 
+            'price': (0, 0)},],},
     'openai': {'host': 'https://api.openai.com', 'models': [
-        {'name': 'gpt-4o-mini', 'rpm': 3, 'context': 128000},
-        {'name': 'gpt-4o', 'rpm': 3, 'context': 128000},
-        {'name': 'gpt-4-turbo', 'rpm': 3, 'context': 128000},
-        {'name': 'gpt-3.5-turbo', 'rpm': 3, 'context': 16000},
-        {'name': 'gpt-3.5-turbo-instruct', 'rpm': 3, 'context': 4000},],},
+        {'name': 'gpt-4o-mini', 'rpm': 3, 'context': 128000, 'output': 16384, 'tpm': 40000, 
+            'price': (0.15, 0.6)},
+        {'name': 'gpt-4o', 'rpm': 3, 'context': 128000, 'output': 16384, 'tpm': 30000, 'price': (2.5, 10.0)},
+        {'name': 'gpt-4-turbo', 'rpm': 3, 'context': 128000, 'output': 4096, 'tpm': 30000, 'price': (10.0, 30.0)},
+        {'name': 'gpt-3.5-turbo', 'rpm': 3, 'context': 16000, 'output': 4096, 'tpm': 40000, 'price': (0.5, 1.5)},
+        {'name': 'gpt-3.5-turbo-instruct', 'rpm': 3, 'context': 4000, 'output': 2048, 'tpm': 90000, 
+            'price': (1.5, 2.0)},],},
     'anthropic': {'host': 'https://api.anthropic.com', 'models': [
-        {'name': 'claude-2', 'rpm': 5, 'context': 100000},
-        {'name': 'claude-3', 'rpm': 5, 'context': 200000},
-        {'name': 'claude-2.1', 'rpm': 5, 'context': 100000},],},
+        {'name': 'claude-2', 'rpm': 5, 'context': 100000, 'output': 4096, 'tpm': 20000, 'price': (8.0, 24.0)},
+        {'name': 'claude-3', 'rpm': 5, 'context': 200000, 'output': 4096, 'tpm': 20000, 'price': (15.0, 75.0)},
+        {'name': 'claude-2.1', 'rpm': 5, 'context': 100000, 'output': 4096, 'tpm': 20000, 'price': (8.0, 24.0)},],},
     'xai': {'host': 'https://api.x.ai', 'models': [
-        {'name': 'grok-beta', 'rpm': 60, 'context': 128000},
-        {'name': 'grok-2', 'rpm': 60, 'context': 128000},],},
+        {'name': 'grok-beta', 'rpm': 60, 'context': 128000, 'output': 4096, 'price': (5.0, 15.0)},
+        {'name': 'grok-2', 'rpm': 60, 'context': 128000, 'output': 8192, 'price': (2.0, 10.0)},],},
     'mistral': {'host': 'https://api.mistral.ai', 'models': [
-        {'name': 'open-mistral-7b', 'rpm': 60, 'context': 32000},
-        {'name': 'mistral-small-latest', 'rpm': 60, 'context': 32000},
-        {'name': 'open-mixtral-8x7b', 'rpm': 60, 'context': 32000},
-        {'name': 'open-mixtral-8x22b', 'rpm': 60, 'context': 64000},
-        {'name': 'mistral-medium-latest', 'rpm': 60, 'context': 32000},
-        {'name': 'mistral-large-latest', 'rpm': 60, 'context': 128000},
-        {'name': 'pixtral-12b-2409', 'rpm': 60, 'context': 128000},],},
+        {'name': 'open-mistral-7b', 'rpm': 60, 'context': 32000, 'output': 4096, 'tpm': 500000, 
+            'price': (0.25, 0.25)},
+        {'name': 'mistral-small-latest', 'rpm': 60, 'context': 32000, 'output': 8192, 'tpm': 500000, 
+            'price': (0.2, 0.6)},
+        {'name': 'open-mixtral-8x7b', 'rpm': 60, 'context': 32000, 'output': 4096, 'tpm': 500000, 
+            'price': (0.7, 0.7)},
+        {'name': 'open-mixtral-8x22b', 'rpm': 60, 'context': 64000, 'output': 4096, 'tpm': 500000, 
+            'price': (2.0, 6.0)},
+        {'name': 'mistral-medium-latest', 'rpm': 60, 'context': 32000, 'output': 8192, 'tpm': 500000, 
+            'price': (2.7, 8.1)},
+        {'name': 'mistral-large-latest', 'rpm': 60, 'context': 128000, 'output': 8192, 'tpm': 500000, 
+            'price': (2.0, 6.0)},
+        {'name': 'pixtral-12b-2409', 'rpm': 60, 'context': 128000, 'output': 8192, 'tpm': 500000, 
+            'price': (0.15, 0.15)},],},
     'groq': {'host': 'https://api.groq.com', 'models': [
-        {'name': 'gemma2-9b-it', 'rpm': 30, 'context': 8000},
-        {'name': 'gemma-7b-it', 'rpm': 30, 'context': 8000},
-        {'name': 'llama-guard-3-8b', 'rpm': 30, 'context': 8000},
-        {'name': 'llama3-70b-8192', 'rpm': 30, 'context': 8000},
-        {'name': 'llama3-8b-8192', 'rpm': 30, 'context': 8000},
-        {'name': 'mixtral-8x7b-32768', 'rpm': 30, 'context': 32000},],},
+        {'name': 'gemma2-9b-it', 'rpm': 30, 'context': 8000, 'output': 2048, 'tpm': 15000, 'tpd': 500000, 
+            'price': (0.2, 0.2)},
+        {'name': 'gemma-7b-it', 'rpm': 30, 'context': 8000, 'output': 2048, 'tpm': 15000, 'tpd': 500000, 
+            'price': (0.07, 0.07)},
+        {'name': 'llama-guard-3-8b', 'rpm': 30, 'context': 8000, 'output': 2048, 'tpm': 15000, 'tpd': 500000, 
+            'price': (0.2, 0.2)},
+        {'name': 'llama3-70b-8192', 'rpm': 30, 'context': 8000, 'output': 2048, 'tpm': 6000, 'tpd': 500000, 
+            'price': (0.59, 0.79)},
+        {'name': 'llama3-8b-8192', 'rpm': 30, 'context': 8000, 'output': 2048, 'tpm': 30000, 'tpd': 500000, 
+            'price': (0.05, 0.08)},
+        {'name': 'mixtral-8x7b-32768', 'rpm': 30, 'context': 32000, 'output': 8192, 'tpm': 5000, 'tpd': 500000, 
+            'price': (0.24, 0.24)},],},
     'perplexity': {'host': 'https://api.perplexity.ai', 'models': [
-        {'name': 'llama-3.1-sonar-small-128k-online', 'rpm': 60, 'context': 128000},
-        {'name': 'llama-3.1-sonar-large-128k-online', 'rpm': 60, 'context': 128000},
-        {'name': 'llama-3.1-sonar-huge-128k-online', 'rpm': 60, 'context': 128000},],},
+        {'name': 'llama-3.1-sonar-small-128k-online', 'rpm': 60, 'context': 128000, 'output': 4096, 
+            'price': (0.2, 0.2)},
+        {'name': 'llama-3.1-sonar-large-128k-online', 'rpm': 60, 'context': 128000, 'output': 4096, 
+            'price': (1.0, 1.0)},
+        {'name': 'llama-3.1-sonar-huge-128k-online', 'rpm': 60, 'context': 128000, 'output': 4096, 
+            'price': (5.0, 5.0)},],},
     'alibaba': {'host': 'https://dashscope.aliyuncs.com', 'models': [
-        {'name': 'qwen-turbo', 'rpm': 60, 'context': 128000}, #其实支持100万
-        {'name': 'qwen-plus', 'rpm': 60, 'context': 128000},
-        {'name': 'qwen-long', 'rpm': 60, 'context': 128000},
-        {'name': 'qwen-max', 'rpm': 60, 'context': 32000},],},
+        {'name': 'qwen-turbo', 'rpm': 60, 'context': 128000, #其实支持100万
+            'output': 8192, 'tpm': 5000000, 'price': (0.05, 0.2)},
+        {'name': 'qwen-plus', 'rpm': 60, 'context': 128000, 'output': 8192, 'tpm': 1000000, 'price': (0.4, 1.2)},
+        {'name': 'qwen-long', 'rpm': 60, 'context': 128000, 'output': 6000, 'tpm': 1000000, 'price': (0.07, 0.28)},
+        {'name': 'qwen-max', 'rpm': 60, 'context': 32000, 'output': 8192, 'tpm': 1000000, 'price': (1.6, 6.4)},],},
 }
 
+DEFAULT_OUTPUT_SIZE = 4096 #AI_LIST中没有提供output时使用的最大输出token数量
+
+#估计一段文本的token数量，不同模型的分词器不一样，这里仅做粗略估计
+#英文等ASCII文本大约4个字符一个token，中日韩文字大约一个字一个token，其他文字(西里尔字母等)大约两个字符一个token
+def estimateTokens(text):
+    if not text:
+        return 0
+    ascii_ = cjk = 0
+    for ch in text:
+        code = ord(ch)
+        if code < 0x80:
+            ascii_ += 1
+        elif (0x3040 <= code <= 0x30ff) or (0x3400 <= code <= 0x9fff) or (0xac00 <= code <= 0xd7af) or (0xf900 <= code <= 0xfaff):
+            cjk += 1
+    other = len(text) - ascii_ - cjk
+    return int(ascii_ / 4 + cjk + other / 2) + 1
+
 #自定义HTTP响应错误异常
+#headers: 响应头，可以从中获取 Retry-After / x-ratelimit-* 等速率限制信息
 class HttpResponseError(Exception):
-    def __init__(self, status, reason, body=None):
+    def __init__(self, status, reason, body=None, headers=None):
         super().__init__(f"{status}: {reason}")
         self.status = status
         self.reason = reason
         self.body = body
+        self.headers = headers or {}
+
+#计算失败重试前需要等待的秒数，指数退避并且加入随机抖动，避免多个线程同时重试
+#attempt: 第几次重试，从0开始
+def backoffDelay(attempt, base=1.0, cap=60.0):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+#请求头 Accept-Encoding 的值，响应体根据 Content-Encoding 流式解压
+ACCEPT_ENCODING = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+COMPRESS_MIN_SIZE = 16 * 1024 #启用请求压缩时，仅压缩超过这个字节数的请求体
+RATE_WAIT_NOTICE = 30 #等待速率限制超过这个秒数时打印提示
+MAX_RATE_WAIT = 600 #等待速率限制超过这个秒数时(比如每天的token额度用完)停止翻译，而不是长时间没有输出地等待
+
+#根据Content-Encoding流式解压响应体，不支持的编码原样返回
+class BodyDecoder:
+    def __init__(self, encoding):
+        self.encoding = (encoding or '').strip().lower()
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.obj = zlib.decompressobj()
+        elif (self.encoding == 'br') and brotli:
+            self.obj = brotli.Decompressor()
+        else:
+            self.obj = None
+        self._first = True
+
+    def decompress(self, data):
+        if not (self.obj and data):
+            return data
+        if self.encoding == 'br':
+            return self.obj.process(data)
+        try:
+            ret = self.obj.decompress(data)
+        except zlib.error:
+            #有些服务器的deflate没有zlib头，使用raw deflate格式重新解压
+            if not (self._first and self.encoding == 'deflate'):
+                raise
+            self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            ret = self.obj.decompress(data)
+        self._first = False
+        return ret
+
+    def flush(self):
+        if not self.obj or (self.encoding == 'br'):
+            return b''
+        return self.obj.flush()
+
+#包装 http.client.HTTPResponse，read()/readline() 返回解压后的数据
+#没有压缩时 decodeResponse() 直接返回原来的响应对象
+class DecodedResponse:
+    decoded = True #已经解压，decodeResponse() 不需要再次处理
+
+    def __init__(self, resp, decoder):
+        self.resp = resp
+        self.decoder = decoder
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+        self._buf = b''
+        self._eof = False
+
+    #读取并解压下一段数据，结束后返回 b''
+    def _readChunk(self):
+        while not self._eof:
+            raw = self.resp.read1(65536)
+            if not raw:
+                self._eof = True
+                self.resp.read() #将响应标记为已经结束，连接才可以复用
+                return self.decoder.flush()
+            if data := self.decoder.decompress(raw):
+                return data
+        return b''
+
+    def read(self):
+        chunks = [self._buf]
+        self._buf = b''
+        while chunk := self._readChunk():
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def readline(self):
+        while (b'\n' not in self._buf) and not self._eof:
+            self._buf += self._readChunk()
+        idx = self._buf.find(b'\n')
+        if idx < 0:
+            line, self._buf = self._buf, b''
+        else:
+            line, self._buf = self._buf[:idx + 1], self._buf[idx + 1:]
+        return line
+
+def decodeResponse(resp):
+    if getattr(resp, 'decoded', False):
+        return resp
+    encoding = resp.headers.get('Content-Encoding', '') if resp.headers else ''
+    decoder = BodyDecoder(encoding)
+    return DecodedResponse(resp, decoder) if decoder.obj else resp
+
+#压缩较大的请求体，返回 (body, headers)，headers为加上 Content-Encoding 之后的新字典
+def compressBody(body, headers):
+    if not body or (len(body) < COMPRESS_MIN_SIZE):
+        return body, headers
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return gzip.compress(body, compresslevel=6), {**headers, 'Content-Encoding': 'gzip'}
+
+#将速率限制相关响应头里面的时间转换为秒数
+#支持纯数字(秒)，openai的 "1m30.5s"/"20ms" 格式，HTTP日期和RFC3339时间戳
+def parseResetTime(value):
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    total = 0.0
+    matched = False
+    for num, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value):
+        total += float(num) * units[unit]
+        matched = True
+    if matched and not re.search(r'[^\d.mshMS]', value):
+        return total
+    try:
+        if re.match(r'\d{4}-\d{2}-\d{2}T', value):
+            tm = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        else:
+            tm = parsedate_to_datetime(value)
+        return max(0.0, (tm - datetime.now(timezone.utc)).total_seconds())
+    except (ValueError, TypeError):
+        return None
+
+#令牌桶速率限制器，每个key一个实例，同一个key经过不同host的请求共享
+#初始速率为AI_LIST里面的rpm/tpm/tpd，之后根据服务器返回的速率限制响应头和429错误动态调整
+#请求数和token数分别使用一个令牌桶，一个请求需要两个桶都有足够的令牌才可以发出
+class RateLimiter:
+    MAX_SCALE = 10 #没有速率限制响应头时，最多自动提升到初始rpm的倍数
+    DAY = 86400
+
+    #rpm: 每分钟请求数，tpm/tpd: 每分钟/每天的token数量，0为不限制
+    def __init__(self, rpm, tpm=0, tpd=0):
+        self.initRpm = rpm
+        self.rpm = float(rpm)
+        self.tpm = float(tpm or 0)
+        self.tpd = tpd or 0
+        self.tokens = 1.0
+        self.tpmTokens = self.tpm #token桶的容量为一分钟的tpm
+        self.dayUsed = 0 #当前24小时窗口内已经使用的token数量
+        self.dayStart = time.monotonic()
+        self.updated = time.monotonic()
+        self.blockedUntil = 0 #收到429或额度用完后，在此时间点之前不再发起请求
+        self.failures = 0 #连续的429次数，用于计算退避时间
+        self._lock = threading.Lock()
+
+    #补充令牌，请求桶容量为1，也就是不允许突发请求
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.tokens = min(1.0, self.tokens + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tpmTokens = min(self.tpm, self.tpmTokens + elapsed * self.tpm / 60)
+        if now - self.dayStart >= self.DAY:
+            self.dayStart = now
+            self.dayUsed = 0
+        self.updated = now
+
+    #在已经补充令牌后，计算发起一个使用tokens个token的请求需要等待的秒数
+    def _wait(self, now, tokens):
+        wait = (1 - self.tokens) * 60 / self.rpm if self.tokens < 1 else 0
+        if self.tpm and tokens:
+            tokens = min(tokens, self.tpm) #超过桶容量的请求只要桶满就可以发出
+            if self.tpmTokens < tokens:
+                wait = max(wait, (tokens - self.tpmTokens) * 60 / self.tpm)
+        if self.tpd and tokens and (self.dayUsed + tokens > self.tpd):
+            wait = max(wait, self.dayStart + self.DAY - now)
+        return max(wait, self.blockedUntil - now)
+
+    #距离下一次允许请求还需要等待的秒数，不消耗令牌
+    #tokens: 请求预计使用的token数量
+    def readyIn(self, tokens=0):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self._wait(now, tokens)
+
+    #预定一个请求和tokens个token，返回需要等待的秒数，令牌可以透支，透支后的请求排队等待
+    def reserve(self, tokens=0):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._wait(now, tokens)
+            self.tokens -= 1
+            if self.tpm:
+                self.tpmTokens -= min(tokens, self.tpm)
+            self.dayUsed += tokens
+            return wait
+
+    #请求完成后，使用实际的token数量修正预定时的估计值
+    #delta: 实际使用的token数量减去预定的数量
+    def adjust(self, delta):
+        with self._lock:
+            if self.tpm:
+                self.tpmTokens = min(self.tpm, self.tpmTokens - delta)
+            self.dayUsed = max(0, self.dayUsed + delta)
+
+    #根据响应状态和响应头调整速率
+    def update(self, status, headers):
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        limit = remaining = reset = None
+        tokLimit = tokRemaining = tokReset = None
+        toInt = lambda *names: next((int(float(headers[n])) for n in names if headers.get(n)), None)
+        for prefix in ('x-ratelimit-', 'anthropic-ratelimit-'):
+            try:
+                limit = toInt(f'{prefix}limit-requests', f'{prefix}requests-limit') or limit
+                value = toInt(f'{prefix}remaining-requests', f'{prefix}requests-remaining')
+                remaining = value if value is not None else remaining
+            except (TypeError, ValueError):
+                pass
+            reset = parseResetTime(headers.get(f'{prefix}reset-requests') or 
+                headers.get(f'{prefix}requests-reset')) or reset
+            try:
+                tokLimit = toInt(f'{prefix}limit-tokens', f'{prefix}tokens-limit') or tokLimit
+                value = toInt(f'{prefix}remaining-tokens', f'{prefix}tokens-remaining')
+                tokRemaining = value if value is not None else tokRemaining
+            except (TypeError, ValueError):
+                pass
+            tokReset = parseResetTime(headers.get(f'{prefix}reset-tokens') or 
+                headers.get(f'{prefix}tokens-reset')) or tokReset
+        retryAfter = parseResetTime(headers.get('retry-after'))
+        if retryAfter is None and headers.get('retry-after-ms'):
+            retryAfter = (parseResetTime(headers['retry-after-ms']) or 0) / 1000
+
+        with self._lock:
+            now = time.monotonic()
+            #有的服务商(比如groq)返回的是每天的请求限制，只有窗口在一分钟以内的才当作rpm/tpm
+            if limit and (reset is None or reset <= 60):
+                self.rpm = float(limit)
+            if tokLimit and (tokReset is None or tokReset <= 60):
+                if not self.tpm:
+                    self.tpmTokens = float(tokLimit)
+                self.tpm = float(tokLimit)
+            elif tokLimit: #每天的token限制，使用服务器的重置时间和剩余额度，而不是从程序启动开始计算
+                self.tpd = tokLimit
+                if tokReset is not None:
+                    self.dayStart = now + tokReset - self.DAY
+                if tokRemaining is not None:
+                    self.dayUsed = max(self.dayUsed, tokLimit - tokRemaining)
+            if (tokRemaining is not None) and self.tpm and (tokReset is None or tokReset <= 60):
+                self.tpmTokens = min(self.tpmTokens, float(tokRemaining)) #服务器的剩余额度更准确
+            tokenBound = (tokRemaining == 0) #token额度用完，而不是请求数量
+            if status == 429:
+                self.failures += 1
+                if retryAfter is None: #服务器没有告知等待时间，降低速率并且指数退避
+                    if tokenBound and tokReset is not None:
+                        retryAfter = tokReset
+                    else:
+                        self.rpm = max(1.0, self.rpm / 2)
+                        retryAfter = reset if (reset is not None) else backoffDelay(self.failures, base=2)
+                self.blockedUntil = max(self.blockedUntil, now + retryAfter)
+                self.tokens = min(self.tokens, 0.0)
+            elif 200 <= status < 300:
+                self.failures = 0
+                if remaining == 0 and reset:
+                    self.blockedUntil = max(self.blockedUntil, now + reset)
+                elif tokenBound and tokReset:
+                    self.blockedUntil = max(self.blockedUntil, now + tokReset)
+                elif not limit: #没有速率限制信息，缓慢提升速率，直到出现429
+                    self.rpm = min(self.initRpm * self.MAX_SCALE, self.rpm + 1 / self.rpm)
+
+#每个 host/key 组合的健康状态，记录延迟/错误率/429次数，连续失败后熔断一段时间
+#熔断器有三个状态：closed(正常)，open(熔断中，不使用)，half-open(熔断时间到，允许一个试探请求)
+class EndpointHealth:
+    ALPHA = 0.2 #指数加权移动平均(EWMA)的平滑系数，越大越重视最近的请求
+    FAILURE_THRESHOLD = 3 #连续失败多少次后熔断
+    OPEN_TIME = 30 #第一次熔断的秒数，之后每次熔断时间加倍
+    MAX_OPEN_TIME = 600 #最长熔断秒数，api key无效(401/403)时直接使用这个时间
+
+    def __init__(self):
+        self.latency = None #成功请求的平均耗时(秒)，None表示还没有数据
+        self.errorRate = 0.0 #失败请求比例的EWMA
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0 #429的次数
+        self.failures = 0 #连续失败次数
+        self.state = 'closed'
+        self.openUntil = 0
+        self.openTime = self.OPEN_TIME
+        self.inFlight = 0 #正在进行中的请求数量，half-open状态只允许一个试探请求
+        self._lock = threading.Lock()
+
+    #是否可以发起请求，熔断时间到了以后转为half-open状态
+    def available(self, now=None):
+        with self._lock:
+            if self.state == 'open' and (now or time.monotonic()) >= self.openUntil:
+                self.state = 'half-open'
+            return (self.state == 'closed') or (self.state == 'half-open' and self.inFlight == 0)
+
+    #选择endpoint时的权重，越快越可靠的权重越大
+    #defLatency: 没有延迟数据时使用的值，一般为其他endpoint的平均值，这样新的endpoint也有机会被使用
+    def weight(self, defLatency=1.0):
+        latency = self.latency if self.latency is not None else defLatency
+        return max(0.05, 1.0 - self.errorRate) / max(0.05, latency)
+
+    def begin(self):
+        with self._lock:
+            self.inFlight += 1
+
+    def cancel(self):
+        with self._lock:
+            self.inFlight = max(0, self.inFlight - 1)
+
+    #记录一次请求的结果
+    #status: 失败时的HTTP状态码，网络错误等为None
+    def record(self, success, latency=0, status=None):
+        with self._lock:
+            self.inFlight = max(0, self.inFlight - 1)
+            self.requests += 1
+            self.errorRate += self.ALPHA * ((0.0 if success else 1.0) - self.errorRate)
+            if success:
+                self.latency = latency if self.latency is None else (self.latency + self.ALPHA * (latency - self.latency))
+                self.failures = 0
+                self.state = 'closed'
+                self.openTime = self.OPEN_TIME
+                return
+
+            self.errors += 1
+            self.failures += 1
+            if status == 429:
+                self.throttled += 1
+            if status in (401, 403): #api key无效或者被禁用，短时间内不会恢复
+                self._open(self.MAX_OPEN_TIME)
+            elif self.state == 'half-open': #试探失败，熔断时间加倍
+                self.openTime = min(self.MAX_OPEN_TIME, self.openTime * 2)
+                self._open(self.openTime)
+            elif self.failures >= self.FAILURE_THRESHOLD:
+                self._open(self.openTime)
+
+    def _open(self, duration):
+        self.state = 'open'
+        self.openUntil = time.monotonic() + duration
+
+    #返回用于查看的状态字典
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'latency': round(self.latency, 3) if self.latency is not None else None,
+                'errorRate': round(self.errorRate, 3), 'requests': self.requests, 'errors': self.errors,
+                'throttled': self.throttled, 'openFor': round(max(0, self.openUntil - time.monotonic()), 1) 
+                if self.state == 'open' else 0}
+
+#一个 host/key 组合，请求按照健康状态和速率限制在这些组合之间分配
+#一个host和key的组合，速率限制是针对key的，同一个key的所有endpoint共享一个 RateLimiter
+class Endpoint:
+    def __init__(self, hostIdx, key, limiter):
+        self.hostIdx = hostIdx
+        self.key = key
+        self.limiter = limiter
+        self.health = EndpointHealth()
+
+    def __repr__(self):
+        return f'Endpoint({self.hostIdx}, ...{self.key[-4:]})'
+
+#一个chat请求，由各个服务商的 _xxx_request() 构建，同步和异步接口共用
+#parse: 从完整响应的json中提取文本的函数
+#extract: 从流式响应的每个事件中提取文本的函数
+#finish: 从完整响应的json或者流式响应的事件中提取结束原因的函数，没有结束原因时返回None
+#usage: 从完整响应的json或者流式响应的事件中提取 (输入token, 输出token) 的函数，服务商不返回时为None
+ChatRequest = namedtuple('ChatRequest', ['path', 'headers', 'payload', 'parse', 'extract', 'finish', 'usage'],
+    defaults=(None,))
+
+#chat() 返回的文本，额外保存了服务器返回的结束原因和token用量
+#truncated: 是否因为达到最大输出长度而被截断
+#usage: 服务器返回的 (输入token, 输出token)，没有返回时为None
+class ChatText(str):
+    TRUNCATED_REASONS = ('length', 'max_tokens', 'MAX_TOKENS')
+
+    def __new__(cls, text, finishReason=None, usage=None):
+        obj = super().__new__(cls, text or '')
+        obj.finishReason = finishReason
+        obj.usage = usage
+        return obj
+
+    @property
+    def truncated(self):
+        return self.finishReason in self.TRUNCATED_REASONS
+
+#使用 ChatRequest.finish 提取结束原因，格式不对时返回None，也用于 ChatRequest.usage
+def finishReason(finish, data):
+    try:
+        return finish(data) if (finish and data) else None
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+#超出了 --max-cost/--max-tokens 设置的上限，不再发起新的请求
+class BudgetExceeded(Exception):
+    pass
+
+#需要等待速率限制超过 MAX_RATE_WAIT 秒，和超出上限一样停止发起新的请求，已经翻译的条目会被保存
+class RateLimitExceeded(BudgetExceeded):
+    pass
+
+#一次运行的费用和token总量上限，预计的用量超出上限的请求不会发出
+#请求前按照估计值预留额度，完成后使用实际的用量结算，这样并发的请求也不会超出上限
+class SpendBudget:
+    #maxCost: 最多花费的美元，maxTokens: 最多使用的token数量，0为不限制，仅统计用量
+    def __init__(self, maxCost=0, maxTokens=0):
+        self.maxCost = maxCost or 0
+        self.maxTokens = maxTokens or 0
+        self.cost = 0.0
+        self.tokens = 0
+        self.requests = 0
+        self._reservedCost = 0.0
+        self._reservedTokens = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'SpendBudget(cost={self.cost:.4f}/{self.maxCost}, tokens={self.tokens}/{self.maxTokens})'
+
+    #预留一个请求的额度，超出上限时抛出 BudgetExceeded
+    def admit(self, tokens, cost):
+        with self._lock:
+            if self.maxTokens and (self.tokens + self._reservedTokens + tokens > self.maxTokens):
+                raise BudgetExceeded(f'Token budget exhausted: {self.tokens}/{self.maxTokens} tokens used')
+            if self.maxCost and (self.cost + self._reservedCost + cost > self.maxCost):
+                raise BudgetExceeded(f'Cost budget exhausted: ${self.cost:.4f}/${self.maxCost} used')
+            self._reservedTokens += tokens
+            self._reservedCost += cost
+
+    #请求结束后释放预留的额度，记录实际用量，失败的请求实际用量为0
+    def settle(self, estTokens, estCost, tokens, cost):
+        with self._lock:
+            self._reservedTokens -= estTokens
+            self._reservedCost -= estCost
+            self.tokens += tokens
+            self.cost += cost
+            self.requests += 1 if tokens else 0
+
+#当前任务的 SpendBudget，在线程池中执行时需要复制上下文，服务模式下每个任务各自一个
+currentBudget = contextvars.ContextVar('currentBudget', default=None)
+
+#当前任务的指标记录器(tr_metrics.Metrics)，设置后每个chat请求结束时调用 record('request', **fields)
+currentMetrics = contextvars.ContextVar('currentMetrics', default=None)
 
 class SimpleAiProvider:
+    #支持批量任务接口(离线处理，配额更高，费用更低)的服务商
+    BULK_PROVIDERS = ('openai', 'anthropic')
+
+    #兼容openai接口的服务商的chat路径
+    OPENAI_PATHS = {'openai': 'v1/chat/completions', 'xai': 'v1/chat/completions', 
+        'mistral': 'v1/chat/completions', 'groq': 'openai/v1/chat/completions', 
+        'perplexity': 'chat/completions', 'alibaba': 'compatible-mode/v1/chat/completions'}
+
     #name: AI提供商的名字
     #apiKey: 如需要多个Key，以分号分割，逐个使用
     #apiHost: 支持自搭建的API转发服务器，传入以分号分割的地址列表字符串，则逐个使用
     #singleTurn: 一些API转发服务不支持多轮对话模式，设置此标识，当前仅支持 openai
-    def __init__(self, name, apiKey, model=None, apiHost=None, singleTurn=False):
+    #compressRequests: 使用gzip压缩较大的请求体，服务器返回415时自动关闭
+    def __init__(self, name, apiKey, model=None, apiHost=None, singleTurn=False, compressRequests=False):
         name = name.lower()
         if name not in AI_LIST:
             raise ValueError(f"Unsupported provider: {name}")
         self.name = name
         self.apiKeys = apiKey.split(';')
         self.apiKeyIdx = 0
+        self._lock = threading.Lock() #支持多线程并发调用 chat()
         self.singleTurn = singleTurn
+        self.compressRequests = compressRequests
         self._models = AI_LIST[name]['models']
         
         #如果传入的model不在列表中，默认使用第一个
         item = next((m for m in self._models if m['name'] == model), self._models[0])
         self.model = item['name']
         self._rpm = item['rpm']
+        self._tpm = item.get('tpm', 0)
+        self._tpd = item.get('tpd', 0)
+        self.price = item.get('price') #(输入, 输出) 每百万token的美元价格
         self.context_size = item['context']
+        self.output_size = item.get('output', DEFAULT_OUTPUT_SIZE) #最大输出token数量
         if self._rpm <= 0:
             self._rpm = 2
         if self.context_size < 1000:
             self.context_size = 1000
+        if self.output_size < 256:
+            self.output_size = 256
         #分析主机和url，保存为 SplitResult(scheme,netloc,path,query,frament)元祖
-        #connPools每个元素为 [host_tuple, conn_obj]
+        #connPools每个元素为 [host_tuple, conn_obj]，conn_obj被某个线程取用时为None
+        #并发请求时同一个host额外创建的连接，空闲时保存在spareConns里面，可以复用
         self.connPools = [[urlsplit(e if e.startswith('http') else ('https://' + e)), None]
             for e in (apiHost or AI_LIST[name]['host']).replace(' ', '').split(';')]
+        self.spareConns = [[] for _ in self.connPools]
+        self.asyncPools = {} #{host_index: AsyncConnectionPool}，异步接口使用，第一次使用时创建
+        self.timeout = 60 #连接和读取响应的超时时间(秒)，同步和异步接口都使用
         self.host = '' #当前正在使用的 netloc
         self.connIdx = 0
         self.createConnections()
+        #每个host和每个key的组合为一个endpoint，各自有健康状态
+        #一个中转服务器故障或者一个key失效时，仅熔断包含它的组合，其他host仍然可以使用这个key，反之亦然
+        #响应头中的速率限制是针对key的，所以同一个key经过不同host的请求共享这个key的速率限制器
+        #总的初始速率仍然为 rpm * max(host数量, key数量)，平均分配到每个key，之后按照响应头调整
+        hostNum, keyNum = len(self.connPools), len(self.apiKeys)
+        share = max(hostNum, keyNum) / keyNum
+        self.limiters = {key: RateLimiter(self._rpm * share, self._tpm * share, self._tpd * share)
+            for key in self.apiKeys} #{key: RateLimiter}
+        self.endpoints = [Endpoint(hostIdx, key, self.limiters[key])
+            for key in self.apiKeys for hostIdx in range(hostNum)]
+        self._endpoint = contextvars.ContextVar('endpoint', default=None) #当前请求使用的endpoint
+        self._transfer = contextvars.ContextVar('transfer', default=None) #当前请求的网络传输统计，记录指标时才有
+        self.usage = {'input': 0, 'output': 0, 'requests': 0} #累计的token用量
 
     #返回速率限制，如果有多个host或key，则速率可以倍数放大
     @property
     def rpm(self):
-        return int(self._rpm * max([len(self.connPools), len(self.apiKeys)]))
+        return int(sum(limiter.rpm for limiter in self.limiters.values()))
 
-    #自动获取下一个ApiKey
+    #自动获取下一个ApiKey，如果当前请求已经选定了endpoint，则使用其对应的key
     @property
     def apiKey(self):
-        ret = self.apiKeys[self.apiKeyIdx]
-        self.apiKeyIdx = (self.apiKeyIdx + 1) % len(self.apiKeys)
+        ep = self._endpoint.get()
+        if ep:
+            return ep.key
+        with self._lock:
+            ret = self.apiKeys[self.apiKeyIdx]
+            self.apiKeyIdx = (self.apiKeyIdx + 1) % len(self.apiKeys)
         return ret
 
     #自动获取列表中下一个连接对象，返回 (index, host tuple, con obj)
+    #连接对象同时只能给一个线程使用，用完后需要调用 releaseConnection() 归还
     def nextConnection(self):
-        index = self.connIdx
-        host, conn = self.connPools[index]
-        self.connIdx = (self.connIdx + 1) % len(self.connPools)
-        return index, host, conn
+        ep = self._endpoint.get()
+        with self._lock:
+            if ep:
+                index = ep.hostIdx
+            else:
+                index = self.connIdx
+                self.connIdx = (self.connIdx + 1) % len(self.connPools)
+            host, conn = self.connPools[index]
+            if conn:
+                self.connPools[index][1] = None
+            elif self.spareConns[index]:
+                conn = self.spareConns[index].pop()
+        return index, host, (conn or self.newConnection(host))
+
+    #归还 nextConnection() 取出的连接对象，以便后续请求复用长连接
+    def releaseConnection(self, index, conn):
+        with self._lock:
+            if self.connPools[index][1] is None:
+                self.connPools[index][1] = conn
+            else:
+                self.spareConns[index].append(conn)
+
+    #选择一个endpoint并且等待其速率限制器允许发起请求，多个线程共享
+    #熔断中的endpoint会被跳过，被429阻塞的endpoint因为需要等待也会被自动跳过
+    def acquireEndpoint(self, tokens=0):
+        ep, wait = self._reserveEndpoint(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return ep
+
+    #acquireEndpoint() 的异步版本
+    async def aacquireEndpoint(self, tokens=0):
+        ep, wait = self._reserveEndpoint(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return ep
+
+    #选择endpoint并且预定一个请求和tokens个token，返回 (endpoint, 需要等待的秒数)
+    #最快的endpoint也需要等待超过 MAX_RATE_WAIT 秒时抛出 RateLimitExceeded
+    #在没有熔断并且最快可以发起请求(请求数和token数都满足)的endpoint中，按照延迟和错误率加权随机选择一个
+    #如果全部熔断，则使用最早恢复的那个，让请求仍然可以继续
+    def _reserveEndpoint(self, tokens=0):
+        with self._lock:
+            now = time.monotonic()
+            candidates = [ep for ep in self.endpoints if ep.health.available(now)]
+            if not candidates:
+                candidates = [min(self.endpoints, key=lambda e: e.health.openUntil)]
+            readyIn = {id(ep): ep.limiter.readyIn(tokens) for ep in candidates}
+            soonest = min(readyIn.values())
+            if soonest > MAX_RATE_WAIT:
+                raise RateLimitExceeded(f'Rate limit of {self.name}/{self.model} reached (tokens per day or '
+                    f'Retry-After), next request allowed in {soonest / 60:.0f} minutes')
+            candidates = [ep for ep in candidates if readyIn[id(ep)] <= soonest + 0.05]
+            latencies = [ep.health.latency for ep in self.endpoints if ep.health.latency is not None]
+            defLatency = (sum(latencies) / len(latencies)) if latencies else 1.0
+            ep = random.choices(candidates, [ep.health.weight(defLatency) for ep in candidates])[0]
+            ep.health.begin()
+            wait = ep.limiter.reserve(tokens)
+        if wait > RATE_WAIT_NOTICE:
+            print(f'  Rate limit of {self.name}/{self.model} reached, waiting {wait:.0f}s')
+        return ep, wait
+
+    #返回每个endpoint的速率限制和健康状态，用于查看，key仅显示最后4个字符
+    def endpointStats(self):
+        return [{'host': self.connPools[ep.hostIdx][0].netloc, 'key': f'...{ep.key[-4:]}', 
+            'rpm': round(ep.limiter.rpm, 1), **ep.health.stats()} for ep in self.endpoints]
+
+    #记录一次请求的结果，更新endpoint的健康状态
+    @staticmethod
+    def _recordResult(ep, start, exc=None):
+        if exc is None:
+            ep.health.record(True, time.monotonic() - start)
+        else:
+            ep.health.record(False, status=getattr(exc, 'status', None))
 
     #创建长连接
     #index: 如果传入一个整型，则只重新创建此索引的连接实例
@@ -133,56 +737,154 @@ class SimpleAiProvider:
         host, e = self.connPools[index]
         if e:
             e.close()
+        self.connPools[index][1] = self.newConnection(host)
+
+    #根据host元祖创建一个新的连接对象
+    def newConnection(self, host):
         #使用http.client.HTTPSConnection有一个好处是短时间多次对话只需要一次握手
         if host.netloc.endswith('duckduckgo.com'):
-            conn = DuckOpenAi()
+            return DuckOpenAi()
         elif host.scheme == 'https':
             sslCtx = ssl._create_unverified_context()
-            conn = http.client.HTTPSConnection(host.netloc, timeout=60, context=sslCtx)
+            return http.client.HTTPSConnection(host.netloc, timeout=self.timeout, context=sslCtx)
         else:
-            conn = http.client.HTTPConnection(host.netloc, timeout=60)
-        self.connPools[index][1] = conn
+            return http.client.HTTPConnection(host.netloc, timeout=self.timeout)
 
     #发起一个网络请求，返回json数据
-    def _send(self, path, headers=None, payload=None, toJson=True, method='POST') -> dict:
-        if payload:
+    #onEvent: 如果提供，则以流式(SSE)方式读取响应，每收到一个事件就调用 onEvent(event_dict)，此时返回None
+    #payload: 字典会被编码为json，bytes/str则直接发送(比如上传文件时的multipart数据)
+    #响应体支持gzip/deflate/br压缩，流式响应也是边读取边解压
+    def _send(self, path, headers=None, payload=None, toJson=True, method='POST', onEvent=None) -> dict:
+        if payload and not isinstance(payload, (bytes, str)):
             payload = json.dumps(payload)
+        reqHeaders, body = self._prepareBody(headers, payload)
         retried = 0
+        index, host, conn = self.nextConnection() #(index, host_tuple, conn_obj)
+        self.host = host.netloc
+        #拼接路径，避免一些边界条件出错
+        url = '/' + host.path.strip('/') + (('?' + host.query) if host.query else '') + path.lstrip('/')
         while retried < 2:
+            start = time.monotonic()
             try:
-                index, host, conn = self.nextConnection() #(index, host_tuple, conn_obj)
-                self.host = host.netloc
-                #拼接路径，避免一些边界条件出错
-                url = '/' + host.path.strip('/') + (('?' + host.query) if host.query else '') + path.lstrip('/')
-                conn.request(method, url, payload, headers)
+                conn.request(method, url, body, reqHeaders)
                 resp = conn.getresponse()
-                body = resp.read().decode("utf-8")
-                #print(resp.reason, ', ', body) #TODO
-                if not (200 <= resp.status < 300):
-                    raise HttpResponseError(resp.status, resp.reason, body)
-                return json.loads(body) if toJson else body
             except (http.client.CannotSendRequest, http.client.RemoteDisconnected) as e:
+                conn.close()
                 if retried:
                     raise
                 #print("Connection issue, retrying:", e)
-                self.createOneConnection(index)
+                conn = self.newConnection(host)
                 retried += 1
+                continue
+
+            if ep := self._endpoint.get():
+                ep.limiter.update(resp.status, resp.headers)
+            try:
+                resp = decodeResponse(resp)
+                if onEvent and (200 <= resp.status < 300):
+                    received = self._readEvents(resp, onEvent)
+                    data = None
+                else:
+                    data = resp.read()
+                    received = len(data)
+                    data = data.decode("utf-8")
+            except BaseException: #流中断时已经收到的内容已经通过onEvent交给调用者了
+                conn.close()
+                raise
+            self.releaseConnection(index, conn)
+            self._noteTransfer(start, resp.status, len(body or ''), received)
+            #print(resp.reason, ', ', data) #TODO
+            if (resp.status == 415) and (body is not payload): #服务器不接受压缩的请求体
+                self.compressRequests = False
+                return self._send(path, headers, payload, toJson, method, onEvent)
+            if not (200 <= resp.status < 300):
+                raise HttpResponseError(resp.status, resp.reason, data, resp.headers)
+            if data is None:
+                return None
+            return json.loads(data) if toJson else data
+
+    #加上 Accept-Encoding 请求头，启用了请求压缩时压缩较大的请求体，返回 (新的headers, body)
+    def _prepareBody(self, headers, payload):
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
+        if self.compressRequests and payload:
+            payload, headers = compressBody(payload, headers)
+        return headers, payload
+
+    #逐行读取SSE(server-sent events)格式的响应，每个事件的data解析为json后调用onEvent
+    #收到 [DONE] 之后继续读到响应结束，以便连接可以复用
+    #返回读取的字节数(解压后)
+    @classmethod
+    def _readEvents(cls, resp, onEvent):
+        size = 0
+        while line := resp.readline():
+            size += len(line)
+            cls._dispatchEvent(line, onEvent)
+        return size
+
+    #将一次http请求的耗时、状态码和收发的字节数累加到当前请求的传输统计中
+    def _noteTransfer(self, start, status, sent, received):
+        info = self._transfer.get()
+        if info is not None:
+            info['http'] += 1
+            info['status'] = status
+            info['network'] += time.monotonic() - start
+            info['sent'] += sent
+            info['received'] += received
+
+    #解析SSE的一行，如果是data行，则解析为json后调用onEvent
+    @staticmethod
+    def _dispatchEvent(line, onEvent):
+        line = line.decode('utf-8').strip()
+        if not line.startswith('data:'):
+            return
+        data = line[5:].strip()
+        if data == '[DONE]':
+            return
+        try:
+            event = json.loads(data)
+        except ValueError:
+            return
+        onEvent(event)
+
+    #以流式方式请求，收到一段文本就调用 onText(text)，返回完整的文本(ChatText)
+    #extract: 从每个事件中提取文本的函数
+    #finish: 从事件中提取结束原因的函数
+    #usage: 从事件中提取token用量的函数，一般只有最后一个事件有
+    def _sendStream(self, path, headers, payload, extract, onText, finish=None, usage=None):
+        texts = []
+        reason = used = None
+        def onEvent(event):
+            nonlocal reason, used
+            try:
+                text = extract(event)
+            except (KeyError, IndexError, TypeError):
+                text = ''
+            if text:
+                texts.append(text)
+                onText(text)
+            reason = finishReason(finish, event) or reason
+            used = finishReason(usage, event) or used
+        self._send(path, headers=headers, payload=payload, method='POST', onEvent=onEvent)
+        return ChatText(''.join(texts), reason, used)
 
     #关闭连接
     #index: 如果传入一个整型，则只关闭对应索引的连接
     def close(self, index=None):
         connNum = len(self.connPools)
         if isinstance(index, int) and (0 <= index < connNum):
-            host, e = self.connPools[index]
-            if e:
-                e.close()
-                self.connPools[index][1] = None
+            indexes = [index]
+        else:
+            indexes = range(connNum)
 
-        for index in range(connNum):
+        for index in indexes:
             host, e = self.connPools[index] #[host_tuple, conn_obj]
             if e:
                 e.close()
                 self.connPools[index][1] = None
+            for e in self.spareConns[index]:
+                e.close()
+            self.spareConns[index] = []
 
     def __repr__(self):
         return f'{self.name}/{self.model}'
@@ -191,26 +893,261 @@ class SimpleAiProvider:
     #message: 如果是文本，则使用各项默认参数
     #传入 list/dict 可以定制 role 等参数
     #返回 respTxt，如果要获取当前使用的主机，可以使用 host 属性
-    def chat(self, message) -> (str, str):
-        if not self.apiKey:
+    #请求前会按照所选 host/key 的速率限制自动等待
+    #onText: 如果提供，则使用流式响应，每收到一段文本就调用 onText(text)，最后仍然返回完整的文本
+    #如果设置了 currentBudget，预计的用量超出上限时抛出 BudgetExceeded，不会发出请求
+    def chat(self, message, onText=None) -> (str, str):
+        estIn, estOut = self.estimateRequest(message)
+        budget = self._admit(estIn, estOut)
+        begin = time.monotonic()
+        ep = self.acquireEndpoint(estIn + estOut)
+        if not ep.key:
+            ep.health.record(False, status=401)
+            self._settle(ep, budget, estIn, estOut)
             raise ValueError(f'The api key is empty')
+        token = self._endpoint.set(ep)
+        start = time.monotonic()
+        call = self._beginCall(start - begin)
+        try:
+            ret = self._chat(message, onText)
+        except Exception as e:
+            self._recordResult(ep, start, e)
+            self._settle(ep, budget, estIn, estOut)
+            self._endCall(call, ep, start, estIn, estOut, exc=e)
+            raise
+        except BaseException as e: #任务取消或者用户中断，不是endpoint的问题
+            ep.health.cancel()
+            self._settle(ep, budget, estIn, estOut)
+            self._endCall(call, ep, start, estIn, estOut, exc=e)
+            raise
+        finally:
+            self._endpoint.reset(token)
+        self._recordResult(ep, start)
+        self._settle(ep, budget, estIn, estOut, ret)
+        self._endCall(call, ep, start, estIn, estOut, ret)
+        return ret
+
+    #设置了 currentMetrics 时开始统计一个请求，wait: 等待速率限制的秒数
+    #返回 (metrics, 传输统计字典, contextvar token)，没有设置时返回None
+    def _beginCall(self, wait):
+        metrics = currentMetrics.get()
+        if not metrics:
+            return None
+        info = {'wait': wait, 'http': 0, 'status': None, 'network': 0.0, 'sent': 0, 'received': 0}
+        return metrics, info, self._transfer.set(info)
+
+    #请求结束，记录一个 request 事件，包括endpoint、耗时、传输统计、估计和实际的token用量
+    #ret: 响应文本，请求失败时为None，exc: 请求失败的异常
+    def _endCall(self, call, ep, start, estIn, estOut, ret=None, exc=None):
+        if not call:
+            return
+        metrics, info, token = call
+        self._transfer.reset(token)
+        inTok, outTok = getattr(ret, 'usage', None) or (None, None)
+        metrics.record('request', provider=self.name, model=self.model, host=self.connPools[ep.hostIdx][0].netloc,
+            key=f'...{ep.key[-4:]}', status=info['status'], error=type(exc).__name__ if exc else None, 
+            seconds=round(time.monotonic() - start, 4), wait=round(info['wait'], 4), 
+            network=round(info['network'], 4), http=info['http'], sent=info['sent'], received=info['received'],
+            estInput=estIn, estOutput=estOut, input=inTok, output=outTok, finish=getattr(ret, 'finishReason', None))
+
+    #chat() 的异步版本，需要在asyncio事件循环中调用，参数和返回值与 chat() 一致
+    #使用每个host一个的异步长连接池，适合在一个进程中同时发起大量请求
+    async def achat(self, message, onText=None):
+        estIn, estOut = self.estimateRequest(message)
+        budget = self._admit(estIn, estOut)
+        begin = time.monotonic()
+        ep = await self.aacquireEndpoint(estIn + estOut)
+        if not ep.key:
+            ep.health.record(False, status=401)
+            self._settle(ep, budget, estIn, estOut)
+            raise ValueError(f'The api key is empty')
+        token = self._endpoint.set(ep)
+        start = time.monotonic()
+        call = self._beginCall(start - begin)
+        try:
+            ret = await self._achat(message, onText)
+        except Exception as e:
+            self._recordResult(ep, start, e)
+            self._settle(ep, budget, estIn, estOut)
+            self._endCall(call, ep, start, estIn, estOut, exc=e)
+            raise
+        except BaseException as e: #任务取消或者用户中断，不是endpoint的问题
+            ep.health.cancel()
+            self._settle(ep, budget, estIn, estOut)
+            self._endCall(call, ep, start, estIn, estOut, exc=e)
+            raise
+        finally:
+            self._endpoint.reset(token)
+        self._recordResult(ep, start)
+        self._settle(ep, budget, estIn, estOut, ret)
+        self._endCall(call, ep, start, estIn, estOut, ret)
+        return ret
+
+    #估计一个请求的token数量，返回 (输入token, 输出token)
+    #输出按照不超过输入的数量估计(翻译的输出和输入差不多长)，同时不超过模型的最大输出
+    def estimateRequest(self, message):
+        if isinstance(message, str):
+            text = message
+        elif isinstance(message, list):
+            text = '\n'.join(str(item.get('content', '')) for item in message)
+        else:
+            text = json.dumps(message, ensure_ascii=False)
+        estIn = estimateTokens(text)
+        return estIn, min(self.output_size, estIn)
+
+    #请求时发送的最大输出token数量，提示词和输出的总和不能超过模型的上下文长度
+    def maxTokens(self, message):
+        return max(256, min(self.output_size, self.context_size - self.estimateRequest(message)[0]))
+
+    #根据价格计算费用(美元)，AI_LIST中没有价格的模型返回0
+    def cost(self, inTokens, outTokens):
+        if not self.price:
+            return 0.0
+        return (inTokens * self.price[0] + outTokens * self.price[1]) / 1000000
+
+    #按照估计的用量在当前任务的 SpendBudget 中预留额度，没有设置时返回None
+    def _admit(self, estIn, estOut):
+        budget = currentBudget.get()
+        if budget:
+            budget.admit(estIn + estOut, self.cost(estIn, estOut))
+        return budget
+
+    #请求结束后按照实际用量结算，服务器没有返回用量时使用估计值
+    #ret: 响应文本，为None表示请求失败，仅释放预留的额度
+    def _settle(self, ep, budget, estIn, estOut, ret=None):
+        if ret is None:
+            inTok = outTok = 0
+        elif getattr(ret, 'usage', None):
+            inTok, outTok = ret.usage
+        else:
+            inTok, outTok = estIn, estimateTokens(ret)
+        if ret is not None:
+            ep.limiter.adjust(inTok + outTok - estIn - estOut)
+            with self._lock:
+                self.usage['input'] += inTok
+                self.usage['output'] += outTok
+                self.usage['requests'] += 1
+        if budget:
+            budget.settle(estIn + estOut, self.cost(estIn, estOut), inTok + outTok, self.cost(inTok, outTok))
+
+    async def _achat(self, message, onText=None):
+        req = self._buildRequest(message, bool(onText))
+        if not onText:
+            data = await self._asend(req.path, headers=req.headers, payload=req.payload, method='POST')
+            return ChatText(req.parse(data), finishReason(req.finish, data), finishReason(req.usage, data))
+
+        texts = []
+        reason = used = None
+        def onEvent(event):
+            nonlocal reason, used
+            try:
+                text = req.extract(event)
+            except (KeyError, IndexError, TypeError):
+                text = ''
+            if text:
+                texts.append(text)
+                onText(text)
+            reason = finishReason(req.finish, event) or reason
+            used = finishReason(req.usage, event) or used
+        await self._asend(req.path, headers=req.headers, payload=req.payload, method='POST', onEvent=onEvent)
+        return ChatText(''.join(texts), reason, used)
+
+    #_send() 的异步版本，参数和返回值与 _send() 一致
+    async def _asend(self, path, headers=None, payload=None, toJson=True, method='POST', onEvent=None):
+        ep = self._endpoint.get()
+        with self._lock:
+            if ep:
+                index = ep.hostIdx
+            else:
+                index = self.connIdx
+                self.connIdx = (self.connIdx + 1) % len(self.connPools)
+        host = self.connPools[index][0]
+        self.host = host.netloc
+        if host.netloc.endswith('duckduckgo.com'): #duckduckgo的封装器只有同步接口，在线程池中执行
+            ctx = contextvars.copy_context()
+            func = functools.partial(ctx.run, self._send, path, headers, payload, toJson, method, onEvent)
+            return await asyncio.get_running_loop().run_in_executor(None, func)
+
+        pool = self.asyncPools.get(index)
+        if pool is None:
+            pool = self.asyncPools[index] = AsyncConnectionPool(host, self.timeout)
+        url = '/' + host.path.strip('/') + (('?' + host.query) if host.query else '') + path.lstrip('/')
+        if payload and not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode('utf-8')
+        reqHeaders, body = self._prepareBody(headers, payload or None)
+        start = time.monotonic()
+        resp = await pool.request(method, url, body, reqHeaders)
+        if ep:
+            ep.limiter.update(resp.status, resp.headers)
+        try:
+            received = 0
+            if onEvent and (200 <= resp.status < 300):
+                while line := await resp.readline():
+                    received += len(line)
+                    self._dispatchEvent(line, onEvent)
+                data = None
+            else:
+                data = await resp.read()
+                received = len(data)
+                data = data.decode('utf-8')
+        except BaseException:
+            resp.close()
+            raise
+        resp.release()
+        self._noteTransfer(start, resp.status, len(body or b''), received)
+        if (resp.status == 415) and (body is not payload): #服务器不接受压缩的请求体
+            self.compressRequests = False
+            return await self._asend(path, headers, payload, toJson, method, onEvent)
+        if not (200 <= resp.status < 300):
+            raise HttpResponseError(resp.status, resp.reason, data, resp.headers)
+        if data is None:
+            return None
+        return json.loads(data) if toJson else data
+
+    #关闭所有异步连接
+    async def aclose(self):
+        for pool in self.asyncPools.values():
+            await pool.close()
+        self.asyncPools = {}
+
+    #根据服务商构建chat请求，返回 ChatRequest 实例
+    def _buildRequest(self, message, stream=False):
+        name = self.name
+        if name == "anthropic":
+            return self._anthropic_request(message, stream)
+        elif name == "google":
+            return self._google_request(message, stream)
+        elif name in self.OPENAI_PATHS:
+            return self._openai_request(message, self.OPENAI_PATHS[name], stream)
+        else:
+            raise ValueError(f"Unsupported provider: {name}")
+
+    #执行一个 ChatRequest，返回响应文本(ChatText)
+    def _execute(self, req, onText=None):
+        if onText:
+            return self._sendStream(req.path, req.headers, req.payload, req.extract, onText, req.finish, req.usage)
+        data = self._send(req.path, headers=req.headers, payload=req.payload, method='POST')
+        return ChatText(req.parse(data), finishReason(req.finish, data), finishReason(req.usage, data))
+
+    #根据服务商分发到具体的chat实现
+    def _chat(self, message, onText=None):
         name = self.name
         if name == "openai":
-            return self._openai_chat(message)
+            return self._openai_chat(message, onText=onText)
         elif name == "anthropic":
-            return self._anthropic_chat(message)
+            return self._anthropic_chat(message, onText=onText)
         elif name == "google":
-            return self._google_chat(message)
+            return self._google_chat(message, onText=onText)
         elif name == "xai":
-            return self._xai_chat(message)
+            return self._xai_chat(message, onText=onText)
         elif name == "mistral":
-            return self._mistral_chat(message)
+            return self._mistral_chat(message, onText=onText)
         elif name == 'groq':
-            return self._groq_chat(message)
+            return self._groq_chat(message, onText=onText)
         elif name == 'perplexity':
-            return self._perplexity_chat(message)
+            return self._perplexity_chat(message, onText=onText)
         elif name == "alibaba":
-            return self._alibaba_chat(message)
+            return self._alibaba_chat(message, onText=onText)
         else:
             raise ValueError(f"Unsupported provider: {name}")
 
@@ -224,7 +1161,11 @@ class SimpleAiProvider:
             return [item['name'] for item in self._models]
 
     #openai的chat接口
-    def _openai_chat(self, message, path='v1/chat/completions'):
+    def _openai_chat(self, message, path='v1/chat/completions', onText=None):
+        return self._execute(self._openai_request(message, path, bool(onText)), onText)
+
+    #构建openai格式的chat请求，同步和异步接口共用
+    def _openai_request(self, message, path='v1/chat/completions', stream=False):
         headers = {'Authorization': f'Bearer {self.apiKey}', 'Content-Type': 'application/json'}
         if isinstance(message, str):
             msg = [{"role": "user", "content": message}]
@@ -239,9 +1180,12 @@ class SimpleAiProvider:
             msg = [{"role": "user", "content": '\n'.join(msgArr)}]
         else:
             msg = message
-        payload = {"model": self.model, "messages": msg}
-        data = self._send(path, headers=headers, payload=payload, method='POST')
-        return data["choices"][0]["message"]["content"]
+        payload = {"model": self.model, "messages": msg, "max_tokens": self.maxTokens(msg)}
+        if stream:
+            payload['stream'] = True
+        return ChatRequest(path, headers, payload, lambda d: d["choices"][0]["message"]["content"],
+            lambda e: e["choices"][0]["delta"].get("content"), lambda d: d["choices"][0].get("finish_reason"),
+            lambda d: (d["usage"]["prompt_tokens"], d["usage"]["completion_tokens"]))
 
     #openai的models接口
     def _openai_models(self):
@@ -250,7 +1194,11 @@ class SimpleAiProvider:
         return [item['id'] for item in data['data']]
 
     #anthropic的chat接口
-    def _anthropic_chat(self, message):
+    def _anthropic_chat(self, message, onText=None):
+        return self._execute(self._anthropic_request(message, bool(onText)), onText)
+
+    #构建anthropic的chat请求
+    def _anthropic_request(self, message, stream=False):
         headers = {'Accept': 'application/json', 'Anthropic-Version': '2023-06-01',
             'Content-Type': 'application/json', 'x-api-key': self.apiKey}
 
@@ -261,19 +1209,28 @@ class SimpleAiProvider:
                 content = item.get('content', '')
                 msg.append(f"\n\n{role}: {content}")
             prompt = ''.join(msg) + "\n\nAssistant:"
-            payload = {"prompt": prompt, "model": self.model, "max_tokens_to_sample": 256}
+            payload = {"prompt": prompt, "model": self.model, "max_tokens_to_sample": self.maxTokens(prompt)}
         elif isinstance(message, dict):
             payload = message
         else:
             prompt = f"\n\nHuman: {message}\n\nAssistant:"
-            payload = {"prompt": prompt, "model": self.model, "max_tokens_to_sample": 256}
+            payload = {"prompt": prompt, "model": self.model, "max_tokens_to_sample": self.maxTokens(prompt)}
         
-        data = self._send('v1/complete', payload=payload, headers=headers, method='POST')
-        return data["completion"]
+        if stream:
+            payload['stream'] = True
+        return ChatRequest('v1/complete', headers, payload, lambda d: d["completion"], lambda e: e.get("completion"),
+            lambda d: d.get("stop_reason"))
 
     #google的chat接口
-    def _google_chat(self, message):
-        url = f'v1beta/models/{self.model}:generateContent?key={self.apiKey}'
+    def _google_chat(self, message, onText=None):
+        return self._execute(self._google_request(message, bool(onText)), onText)
+
+    #构建google的chat请求
+    def _google_request(self, message, stream=False):
+        if stream:
+            url = f'v1beta/models/{self.model}:streamGenerateContent?alt=sse&key={self.apiKey}'
+        else:
+            url = f'v1beta/models/{self.model}:generateContent?key={self.apiKey}'
         headers = {'Content-Type': 'application/json'}
         if isinstance(message, list): #将openai的payload格式转换为gemini的格式
             msg = []
@@ -281,14 +1238,16 @@ class SimpleAiProvider:
                 role = 'user' if (item.get('role') != 'assistant') else 'model'
                 content = item.get('content', '')
                 msg.append({'role': role, 'parts': [{'text': content}]})
-            payload = {'contents': msg}
+            payload = {'contents': msg, 'generationConfig': {'maxOutputTokens': self.maxTokens(message)}}
         elif isinstance(message, dict):
             payload = message
         else:
-            payload = {'contents': [{'role': 'user', 'parts': [{'text': message}]}]}
-        data = self._send(url, payload=payload, headers=headers, method='POST')
-        contents = data["candidates"][0]["content"]
-        return contents['parts'][0]['text']
+            payload = {'contents': [{'role': 'user', 'parts': [{'text': message}]}], 
+                'generationConfig': {'maxOutputTokens': self.maxTokens(message)}}
+        extract = lambda e: e["candidates"][0]["content"]["parts"][0]["text"]
+        usage = lambda d: (d["usageMetadata"]["promptTokenCount"], d["usageMetadata"].get("candidatesTokenCount", 0))
+        return ChatRequest(url, headers, payload, extract, extract, lambda d: d["candidates"][0].get("finishReason"),
+            usage)
 
     #google的models接口
     def _google_models(self):
@@ -299,24 +1258,332 @@ class SimpleAiProvider:
         return [_trim(item['name']) for item in data['models']]
 
     #xai的chat接口
-    def _xai_chat(self, message):
-        return self._openai_chat(message, path='v1/chat/completions')
+    def _xai_chat(self, message, onText=None):
+        return self._openai_chat(message, path='v1/chat/completions', onText=onText)
 
     #mistral的chat接口
-    def _mistral_chat(self, message):
-        return self._openai_chat(message, path='v1/chat/completions')
+    def _mistral_chat(self, message, onText=None):
+        return self._openai_chat(message, path='v1/chat/completions', onText=onText)
 
     #groq的chat接口
-    def _groq_chat(self, message):
-        return self._openai_chat(message, path='openai/v1/chat/completions')
+    def _groq_chat(self, message, onText=None):
+        return self._openai_chat(message, path='openai/v1/chat/completions', onText=onText)
 
     #perplexity的chat接口
-    def _perplexity_chat(self, message):
-        return self._openai_chat(message, path='chat/completions')
+    def _perplexity_chat(self, message, onText=None):
+        return self._openai_chat(message, path='chat/completions', onText=onText)
 
     #通义千问
-    def _alibaba_chat(self, message):
-        return self._openai_chat(message, path='compatible-mode/v1/chat/completions')
+    def _alibaba_chat(self, message, onText=None):
+        return self._openai_chat(message, path='compatible-mode/v1/chat/completions', onText=onText)
+
+    #提交一个批量任务，批量任务异步执行，一般在24小时内完成
+    #messages: 字典 {custom_id: message}，message和 chat() 的参数一致
+    #批量任务属于某个api key，所以批量任务的所有请求都使用第一个endpoint
+    #返回任务id
+    def submitBatch(self, messages):
+        return self._bulkCall(self._openai_submit_batch if self.name == 'openai' else self._anthropic_submit_batch,
+            messages)
+
+    #查询批量任务状态，返回 (state, status)
+    #state: 'running'/'ended'/'failed'，status为服务商返回的原始状态字符串
+    def batchStatus(self, jobId):
+        return self._bulkCall(self._openai_batch_status if self.name == 'openai' else self._anthropic_batch_status,
+            jobId)
+
+    #获取已经完成的批量任务的结果，返回字典 {custom_id: respTxt}，失败的请求不包含在内
+    def batchResults(self, jobId):
+        return self._bulkCall(self._openai_batch_results if self.name == 'openai' else self._anthropic_batch_results,
+            jobId)
+
+    #使用第一个endpoint调用批量任务的接口
+    def _bulkCall(self, func, *args):
+        if self.name not in self.BULK_PROVIDERS:
+            raise ValueError(f"Batch jobs are not supported by provider: {self.name}")
+        token = self._endpoint.set(self.endpoints[0])
+        try:
+            return func(*args)
+        finally:
+            self._endpoint.reset(token)
+
+    #openai的批量任务需要先上传一个jsonl文件，每一行为一个chat请求
+    def _openai_submit_batch(self, messages):
+        path = '/' + self.OPENAI_PATHS['openai']
+        lines = [json.dumps({'custom_id': cid, 'method': 'POST', 'url': path, 
+            'body': self._openai_request(msg).payload}, ensure_ascii=False) for cid, msg in messages.items()]
+        boundary = f'----autopo{random.getrandbits(64):016x}'
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="batch.jsonl"\r\n'
+            f'Content-Type: application/jsonl\r\n\r\n' + '\n'.join(lines) + f'\r\n--{boundary}--\r\n')
+        headers = {'Authorization': f'Bearer {self.apiKey}', 
+            'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        data = self._send('v1/files', headers=headers, payload=body.encode('utf-8'), method='POST')
+        headers['Content-Type'] = 'application/json'
+        payload = {'input_file_id': data['id'], 'endpoint': path, 'completion_window': '24h'}
+        return self._send('v1/batches', headers=headers, payload=payload, method='POST')['id']
+
+    #openai的批量任务状态，过期或者取消的任务也可能有部分已经完成的结果
+    def _openai_batch_status(self, jobId):
+        headers = {'Authorization': f'Bearer {self.apiKey}'}
+        data = self._send(f'v1/batches/{jobId}', headers=headers, payload=None, method='GET')
+        status = data.get('status', '')
+        if status in ('validating', 'in_progress', 'finalizing', 'cancelling'):
+            return 'running', status
+        elif data.get('output_file_id'):
+            return 'ended', status
+        else:
+            return 'failed', status
+
+    def _openai_batch_results(self, jobId):
+        headers = {'Authorization': f'Bearer {self.apiKey}'}
+        data = self._send(f'v1/batches/{jobId}', headers=headers, payload=None, method='GET')
+        fileId = data.get('output_file_id')
+        if not fileId:
+            return {}
+        body = self._send(f'v1/files/{fileId}/content', headers=headers, payload=None, toJson=False, method='GET')
+        ret = {}
+        for line in body.splitlines():
+            try:
+                item = json.loads(line)
+                resp = item.get('response') or {}
+                if resp.get('status_code') == 200:
+                    choice = resp['body']['choices'][0]
+                    ret[item['custom_id']] = ChatText(choice['message']['content'], choice.get('finish_reason'))
+            except (ValueError, KeyError, IndexError, TypeError):
+                continue
+        return ret
+
+    #anthropic的批量任务仅支持messages接口，需要将openai格式的对话转换为messages接口的参数
+    def _anthropic_submit_batch(self, messages):
+        headers = {'Accept': 'application/json', 'Anthropic-Version': '2023-06-01',
+            'Content-Type': 'application/json', 'x-api-key': self.apiKey}
+        requests = []
+        for cid, message in messages.items():
+            if isinstance(message, str):
+                message = [{'role': 'user', 'content': message}]
+            params = {'model': self.model, 'max_tokens': self.maxTokens(message),
+                'messages': [{'role': 'assistant' if e.get('role') == 'assistant' else 'user', 
+                    'content': e.get('content', '')} for e in message if e.get('role') != 'system']}
+            system = '\n\n'.join(e.get('content', '') for e in message if e.get('role') == 'system')
+            if system:
+                params['system'] = system
+            requests.append({'custom_id': cid, 'params': params})
+        data = self._send('v1/messages/batches', headers=headers, payload={'requests': requests}, method='POST')
+        return data['id']
+
+    def _anthropic_batch_status(self, jobId):
+        headers = {'Anthropic-Version': '2023-06-01', 'x-api-key': self.apiKey}
+        data = self._send(f'v1/messages/batches/{jobId}', headers=headers, payload=None, method='GET')
+        status = data.get('processing_status', '')
+        return ('ended' if status == 'ended' else 'running'), status
+
+    def _anthropic_batch_results(self, jobId):
+        headers = {'Anthropic-Version': '2023-06-01', 'x-api-key': self.apiKey}
+        body = self._send(f'v1/messages/batches/{jobId}/results', headers=headers, payload=None, toJson=False, 
+            method='GET')
+        ret = {}
+        for line in body.splitlines():
+            try:
+                item = json.loads(line)
+                result = item.get('result') or {}
+                if result.get('type') == 'succeeded':
+                    message = result['message']
+                    ret[item['custom_id']] = ChatText(''.join(c.get('text', '') for c in message['content']),
+                        message.get('stop_reason'))
+            except (ValueError, KeyError, TypeError):
+                continue
+        return ret
+
+#在后台线程的asyncio事件循环中执行 achat()，让多线程的翻译流程使用异步接口 (--async)
+#所有请求共用每个host一个的异步长连接池，调用 chat() 的线程等待结果，其他属性和方法转发给原来的agent
+#请求在调用线程的上下文副本中执行，currentBudget/currentMetrics 等仍然有效，onText 在事件循环线程中调用
+class AsyncBridge:
+    #agent: SimpleAiProvider实例
+    def __init__(self, agent):
+        self.agent = agent
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.agent, name)
+
+    def __repr__(self):
+        return repr(self.agent)
+
+    #和 SimpleAiProvider.chat() 一致
+    def chat(self, message, onText=None):
+        future = asyncio.run_coroutine_threadsafe(self.agent.achat(message, onText), self.loop)
+        try:
+            return future.result()
+        except BaseException: #调用线程被中断时取消请求，请求已经结束时没有影响
+            future.cancel()
+            raise
+
+    #关闭异步连接和事件循环，之后不能再使用
+    def close(self):
+        if self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self.agent.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+#asyncio版本的HTTP/1.1长连接池，仅使用标准库，每个host一个实例
+#连接用完后如果服务器没有要求关闭，则放回池中复用，避免重复握手
+class AsyncConnectionPool:
+    MAX_IDLE = 16 #最多保留的空闲连接数量
+
+    def __init__(self, host, timeout=60):
+        self.host = host #SplitResult
+        self.timeout = timeout
+        self.idle = []
+        self.sslCtx = ssl._create_unverified_context() if host.scheme == 'https' else None
+
+    async def _connect(self):
+        port = self.host.port or (443 if self.sslCtx else 80)
+        return await asyncio.wait_for(asyncio.open_connection(self.host.hostname, port, ssl=self.sslCtx),
+            self.timeout)
+
+    #发送请求并读取响应头，返回 AsyncResponse 实例
+    #复用的空闲连接可能已经被服务器关闭，这种情况下使用新连接重试一次
+    async def request(self, method, url, body=None, headers=None):
+        head = [f'{method} {url} HTTP/1.1', f'Host: {self.host.netloc}', 'Connection: keep-alive']
+        head.extend(f'{k}: {v}' for k, v in (headers or {}).items())
+        if body is not None:
+            head.append(f'Content-Length: {len(body)}')
+        data = ('\r\n'.join(head) + '\r\n\r\n').encode('utf-8') + (body or b'')
+        while True:
+            reused = bool(self.idle)
+            reader, writer = self.idle.pop() if reused else await self._connect()
+            try:
+                writer.write(data)
+                await writer.drain()
+                statusLine = await asyncio.wait_for(reader.readline(), self.timeout)
+                if not statusLine:
+                    raise ConnectionResetError('Connection closed by server')
+                resp = AsyncResponse(self, reader, writer, method)
+                await resp.readHead(statusLine)
+                return resp
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+            except BaseException: #超时或者任务被取消，这个连接的状态未知，不能再复用
+                writer.close()
+                raise
+
+    def release(self, reader, writer):
+        if len(self.idle) < self.MAX_IDLE:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+#AsyncConnectionPool.request() 返回的响应对象，响应体支持 Content-Length/chunked/读到连接关闭三种方式
+class AsyncResponse:
+    def __init__(self, pool, reader, writer, method):
+        self.pool = pool
+        self.reader = reader
+        self.writer = writer
+        self.method = method
+        self.status = 0
+        self.reason = ''
+        self.headers = {}
+        self._remaining = None #Content-Length方式剩余的字节数
+        self._chunked = False
+        self._eof = False
+        self._buf = b''
+        self._decoder = None
+
+    async def readHead(self, statusLine):
+        parts = statusLine.decode('latin-1').strip().split(' ', 2)
+        self.status = int(parts[1])
+        self.reason = parts[2] if len(parts) > 2 else ''
+        while (line := await asyncio.wait_for(self.reader.readline(), self.pool.timeout)) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            self.headers[name.strip()] = value.strip()
+        lowHeaders = {k.lower(): v for k, v in self.headers.items()}
+        self._chunked = 'chunked' in lowHeaders.get('transfer-encoding', '').lower()
+        if not self._chunked and ('content-length' in lowHeaders):
+            self._remaining = int(lowHeaders['content-length'])
+        self._keepAlive = lowHeaders.get('connection', '').lower() != 'close'
+        decoder = BodyDecoder(lowHeaders.get('content-encoding'))
+        self._decoder = decoder if decoder.obj else None
+        if (self.method == 'HEAD') or (self.status in (204, 304)) or (self._remaining == 0):
+            self._eof = True
+
+    #读取并解压下一段响应体，结束后返回 b''
+    async def _readChunk(self):
+        if not self._decoder:
+            return await self._readRaw()
+        while True:
+            raw = await self._readRaw()
+            if not raw:
+                return self._decoder.flush() if self._eof else b''
+            if data := self._decoder.decompress(raw):
+                return data
+
+    #读取下一段原始的响应体，结束后返回 b''
+    async def _readRaw(self):
+        if self._eof:
+            return b''
+        timeout = self.pool.timeout
+        if self._chunked:
+            size = int((await asyncio.wait_for(self.reader.readline(), timeout)).split(b';')[0], 16)
+            if size == 0:
+                while (await asyncio.wait_for(self.reader.readline(), timeout)) not in (b'\r\n', b'\n', b''):
+                    pass
+                self._eof = True
+                return b''
+            data = await asyncio.wait_for(self.reader.readexactly(size + 2), timeout)
+            return data[:-2]
+        elif self._remaining is not None:
+            data = await asyncio.wait_for(self.reader.read(min(self._remaining, 65536)), timeout)
+            if not data:
+                raise asyncio.IncompleteReadError(b'', self._remaining)
+            self._remaining -= len(data)
+            self._eof = (self._remaining <= 0)
+            return data
+        else:
+            data = await asyncio.wait_for(self.reader.read(65536), timeout)
+            if not data:
+                self._eof = True
+                self._keepAlive = False
+            return data
+
+    #读取全部响应体
+    async def read(self):
+        chunks = [self._buf]
+        self._buf = b''
+        while chunk := await self._readChunk():
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    #读取一行，包括行尾的换行符，结束后返回 b''
+    async def readline(self):
+        while (b'\n' not in self._buf) and not self._eof:
+            self._buf += await self._readChunk()
+        idx = self._buf.find(b'\n')
+        if idx < 0:
+            line, self._buf = self._buf, b''
+        else:
+            line, self._buf = self._buf[:idx + 1], self._buf[idx + 1:]
+        return line
+
+    #响应体已经全部读取后，将连接放回连接池
+    def release(self):
+        if self._eof and self._keepAlive and not self._buf:
+            self.pool.release(self.reader, self.writer)
+        else:
+            self.writer.close()
+
+    def close(self):
+        self.writer.close()
 
 #duckduckgo转openai格式的封装器，外部接口兼容http.HTTPConnection
 class DuckOpenAi:
@@ -324,7 +1591,7 @@ class DuckOpenAi:
         "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:91.0) Gecko/20100101 Firefox/91.0",
         "Accept": "text/event-stream",
         "Accept-Language": "de,en-US;q=0.7,en;q=0.3",
-        "Accept-Encoding": "gzip, deflate, br",
+        "Accept-Encoding": ACCEPT_ENCODING,
         "Referer": "https://duckduckgo.com/",
         "Content-Type": "application/json",
         "Origin": "https://duckduckgo.com",
@@ -342,6 +1609,7 @@ class DuckOpenAi:
 
     #模拟HTTPConnection实例 getresponse() 返回的的结果
     class DuckResponse:
+        decoded = True
         def __init__(self, status, headers, data, reason=''):
             self.status = status
             self.headers = headers
@@ -350,6 +1618,27 @@ class DuckOpenAi:
         def read(self):
             return self.data
 
+    #流式响应，逐行将duckduckgo的事件流转换为openai格式的事件流
+    class DuckStreamResponse:
+        decoded = True
+        def __init__(self, resp):
+            self.resp = resp
+            self.status = resp.status
+            self.headers = resp.headers
+            self.reason = resp.reason
+        def read(self):
+            return self.resp.read()
+        def readline(self):
+            line = self.resp.readline()
+            if line.startswith(b'data: ') and not line.startswith(b'data: [DONE]'):
+                try:
+                    data = json.loads(line[6:])
+                except ValueError:
+                    return line
+                chunk = {"choices": [{"index": 0, "delta": {"content": data.get("message", "")}}]}
+                return b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n'
+            return line
+
     def __init__(self):
         self.conn = None
         self._payload = {}
@@ -367,16 +1656,16 @@ class DuckOpenAi:
         return self.conn
 
     #使用底层接口实际发送网络请求
-    #返回元祖 (status, headers, body)
-    def _send(self, url, headers=None, payload=None, method='GET'):
+    #返回元祖 (status, headers, body)，如果stream=True，则body为未读取的响应对象
+    #响应体已经根据Content-Encoding解压
+    def _send(self, url, headers=None, payload=None, method='GET', stream=False):
         retried = 0
-        _headers = self.HEADERS
-        _headers.update(headers)
+        _headers = {**self.HEADERS, **(headers or {})}
         while retried < 2:
             try:
                 self.conn.request(method, url, payload, _headers)
-                resp = self.conn.getresponse()
-                return resp.status, resp.headers, resp.read()
+                resp = decodeResponse(self.conn.getresponse())
+                return resp.status, resp.headers, (resp if stream else resp.read())
             except (http.client.CannotSendRequest, http.client.RemoteDisconnected) as e:
                 if retried:
                     raise
@@ -397,9 +1686,12 @@ class DuckOpenAi:
             
         vqd4 = heads.get("x-vqd-4", '')
         payload = {"model": "gpt-4o-mini", "messages": self._payload.get('messages', [])}
+        stream = bool(self._payload.get('stream'))
 
         status, heads, body = self._send(self.CHAT_URL, headers={"x-vqd-4": vqd4}, 
-            payload=json.dumps(payload), method='POST')
+            payload=json.dumps(payload), method='POST', stream=stream)
+        if stream:
+            return self.DuckStreamResponse(body)
         if status != 200:
             return self.DuckResponse(status, heads, body)
 
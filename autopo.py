@@ -2,14 +2,39 @@
 #-*- coding:utf-8 -*-
 """使用ai自动翻译po文件
 """
-import os, sys, re, json, argparse, time, datetime, shutil
+import os, sys, re, json, argparse, time, datetime, shutil, functools, glob, threading, contextvars
+from collections import Counter
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import polib
 import ai_providers
+from tr_memory import TranslationMemory
+from tr_journal import TranslationJournal
+from tr_stats import FormatStats
+from tr_bulk import runBulkJob, BulkReplayAgent
+from tr_catalog import StreamCatalog
+from tr_placeholders import maskBatch, unmaskResult, fixWhitespace, checkTranslation
+from tr_hedge import HedgedAgent
+from tr_compendium import Compendium
+from tr_glossary import Glossary
+from tr_metrics import Metrics
+from tr_server import TranslationServer, submitJob, DEFAULT_ADDRESS
 
 __Version__ = '1.0'
 appDir = os.path.dirname(os.path.abspath(__file__))
 CONFIG_JSON = os.path.join(appDir, 'config.json')
-BATCH_SIZE = 2000   #每次翻译的字节数量
+#运行过程中积累的统计数据的默认保存目录，可以使用环境变量 AUTOPO_HOME 修改
+DATA_DIR = os.environ.get('AUTOPO_HOME') or os.path.join(os.path.expanduser('~'), '.autopo')
+FORMAT_STATS_JSON = os.path.join(DATA_DIR, 'format_stats.json')
+HEDGE_STATS_JSON = os.path.join(DATA_DIR, 'hedge_stats.json')
+COMPENDIUM_DB = os.path.join(DATA_DIR, 'compendium.db')
+OUTPUT_USAGE = 0.8 #每个批次预计的输出token最多占模型最大输出的比例，留一些余量给估计误差
+ENTRY_OVERHEAD = 4 #json格式中每个条目额外的token数量(引号/冒号/逗号等)
+CHECKPOINT_INTERVAL = 60 #翻译过程中每隔多少秒保存一次po文件
+MAX_RETRIES = 3 #每个请求失败后的最大重试次数
+PLAN_LATENCY = 1.5 #plan 子命令估计时间时，每个请求除了输出之外的延迟(秒)
+PLAN_OUTPUT_SPEED = 60 #plan 子命令估计时间时，每秒输出的token数量
+IDENTITY_MAX_WORDS = 2 #不超过这个单词数的文本(比如 "OK"、"URL"、品牌名)，译文和原文相同也是有效的翻译
 
 SYS_PROMPT = """You are a renowned translation expert{fields}, translate the text in a professional and elegant manner without sounding like a machine translation.
 
@@ -18,6 +43,7 @@ Your primary focus is to deliver translations following these guidelines:
 - Only translate the text and not interpret it further.
 - Do not translate format placeholders like {{}}, {{0}}, {{{{id_0}}}}, {{name}}, %s, %(name)s, etc.
 - Do not translate HTML tag names like <br/> etc.
+- Keep tokens like ⟦0⟧, ⟦1⟧ unchanged and in a suitable position, they stand for placeholders or markup.
 - If original text has only one word, translate it as a single word.
 - The translation must preserve the original markdown formats, line breaks and leading/trailing spaces.
 - The translation should have a length in bytes that is as close as possible to the original, being shorter if needed, but never longer than the original by a considerable amount.
@@ -41,14 +67,47 @@ Return the fully translated valid JSON dictionary in the same structure, without
 JSON dictionary:
 {text}"""
 
+TR_MULTI_PROMPT = """I will provide a JSON dictionary below.
+Please translate the keys from the source language ({src}) to each of these target languages: {dst}.
+Replace the original dictionary values with objects that map each language code ({codes}) to the translation of the corresponding key, without modifying the dictionary keys.
+{ref}Return the fully translated valid JSON dictionary, without any explanations or additional comments.
+
+JSON dictionary:
+{text}"""
+
+TR_MULTI_REF = """The original values (if present) in the dictionary are {refLang} translations of the keys, provided as a reference to help you translate them more accurately.
+"""
+
+TR_ID_PROMPT = """I will provide a JSON dictionary below, its keys are numeric ids and its values are the texts to translate.
+Please translate the values from the source language ({src}) to the target language ({dst}).
+{ref}Return a valid JSON dictionary that maps each id to its translation, without the original texts, explanations or additional comments.
+
+JSON dictionary:
+{text}
+"""
+
+TR_ID_REF = """The reference dictionary below the texts contains {refLang} translations of some of them under the same ids, provided as a reference to help you translate them more accurately.
+"""
+
+TR_TERMS_PROMPT = """
+Use these translations for the following terms wherever they appear:
+{terms}"""
+
+TR_CTX_PROMPT = """
+Some texts are used in a specific context (given below), translate them accordingly:
+{contexts}"""
+
 TR_PH_PROMPT = """I will provide some text below.
 Please translate them from the source language ({src}) to the target language ({dst}).
-Return the translated text in the same structure, without any explanations or additional comments.
+{ref}Return the translated text in the same structure, without any explanations or additional comments.
 
 Text block:
 {text}
 """
 
+TR_PH_REF = """The reference dictionary below the text block contains {refLang} translations of some of the texts under their ids, provided as a reference to help you translate them more accurately.
+"""
+
 #常见语种的代码对应表，不在这个表中的直接使用语言代码，AI识别也不会有任何问题，不会影响翻译
 LANGUAGE_CODES = {"en": "English", "zh": "Chinese", "zh_cn": "Simplified Chinese",
     "es": "Spanish", "fr": "French", "de": "German", "ja": "Japanese", "ko": "Korean",
@@ -64,6 +123,15 @@ LANGUAGE_CODES = {"en": "English", "zh": "Chinese", "zh_cn": "Simplified Chinese
     "mk": "Macedonian", "cy": "Welsh", "eu": "Basque", "gl": "Galician","bs": "Bosnian",
     "zu": "Zulu", "af": "Afrikaans", "is": "Icelandic", "eu": "Basque", "am": "Amharic",}
 
+#译文相对于英文原文的token数量比例，用于估计每个批次的输出长度，不在这个表中的使用 DEFAULT_EXPANSION
+#德语/法语等译文比英文长一些，非拉丁字母的语种每个字需要更多的token
+DEFAULT_EXPANSION = 1.5
+LANGUAGE_EXPANSION = {"en": 1.0, "es": 1.3, "fr": 1.3, "de": 1.3, "it": 1.3, "pt": 1.3, "nl": 1.3,
+    "pl": 1.5, "cs": 1.5, "sv": 1.2, "da": 1.2, "no": 1.2, "fi": 1.6, "hu": 1.6, "ro": 1.4, "tr": 1.6,
+    "id": 1.3, "ms": 1.3, "vi": 1.5, "zh": 1.2, "zh_cn": 1.2, "zh_tw": 1.3, "ja": 1.5, "ko": 1.6,
+    "ru": 2.0, "uk": 2.2, "bg": 2.0, "sr": 2.0, "el": 2.5, "he": 2.0, "ar": 2.0, "fa": 2.0,
+    "hi": 3.0, "bn": 3.0, "ta": 3.5, "th": 2.5,}
+
 #在这个列表中的文本不翻译，直接使用原来的文本
 EXCLUDED_LIST = ['.', '...']
 
@@ -73,6 +141,31 @@ def createAiAgent(cfgFile=None):
     cfgFile = cfgFile or CONFIG_JSON
     with open(cfgFile, 'r', encoding='utf-8') as f:
         cfg = json.load(f)
+    agent = createOneAgent(cfg)
+    #providers: 用于对冲请求的其他服务商或者模型列表，每一项没有提供的参数使用上层的值
+    hedges = cfg.get('providers')
+    if not hedges:
+        return agent
+    base = {key: value for key, value in cfg.items() if key != 'providers'}
+    agents = [agent] + [createOneAgent({**base, **item}) for item in hedges]
+    return HedgedAgent(agents, percentile=cfg.get('hedge_percentile', 90), statsFile=HEDGE_STATS_JSON)
+
+#--async: 请求改为在asyncio事件循环中使用异步长连接池发送，翻译流程不变，工作线程等待请求的结果
+#对冲请求时每个服务商各自使用一个事件循环
+def asyncAgent(agent):
+    if isinstance(agent, HedgedAgent):
+        agent.agents = [ai_providers.AsyncBridge(e) for e in agent.agents]
+        return agent
+    return ai_providers.AsyncBridge(agent)
+
+#关闭 asyncAgent() 创建的事件循环和异步连接
+def closeAsyncAgent(agent):
+    for e in getattr(agent, 'agents', [agent]):
+        if isinstance(e, ai_providers.AsyncBridge):
+            e.close()
+
+#根据一个配置字典创建SimpleAiProvider实例
+def createOneAgent(cfg):
     name = cfg.get('provider')
     model = cfg.get('model')
     apiKey = cfg.get('api_key')
@@ -82,84 +175,624 @@ def createAiAgent(cfgFile=None):
         raise ValueError('Some parameter is missing')
     singleTurn = bool(chatType == 'single_turn')
     return ai_providers.SimpleAiProvider(name=name, model=model, apiKey=apiKey, apiHost=apiHost, 
-        singleTurn=singleTurn)
+        singleTurn=singleTurn, compressRequests=bool(cfg.get('compress_requests')))
 
 #翻译一个po文件，保存为同一个文件
 #fileName: 需要翻译的po文件
 #agent: SimpleAiProvider实例
 #dstLang/srcLang: 目标语言代码/源语言
 #outFile: 如果需要将翻译写到另外的文件，指定这个参数
-#refPoFile: 需要用作参考的已经手工翻译的其他语种的po文件，可以让AI更准确的翻译
-#refLang: 参考po文件的语种
+#refPoFile: 需要用作参考的已经手工翻译的其他语种的po文件，可以让AI更准确的翻译，多个文件时为列表
+#refLang: 参考po文件的语种，多个文件时为和refPoFile对应的列表，或者所有文件共用的一个语种
+#refIndex: Compendium实例，参考翻译索引，多次运行之间共享，没有提供时使用临时的内存索引
 #fuzzify: 是否标识刚翻译的词条为fuzzy
 #excluded: 需要排除的翻译文本列表
 #fields: 为了让AI更准确的翻译，提供材料所在领域，为一个字符串列表
+#workers: 同时进行中的请求数量，大于1时并发翻译多个批次
+#tm: TranslationMemory实例，如果提供，则先从翻译记忆库中查找，仅翻译查不到的文本
+#resume: 是否从上次中断的翻译日志中恢复，日志文件为输出文件名加上 .journal 后缀
+#  为False时如果存在非空的日志文件，不翻译并提示使用 --resume 或者删除日志
+#stream: 是否使用流式响应，收到一个翻译就立即更新
+#fmt: 请求格式，json/id/placeholder，auto为根据stats中记录的成功率自动选择
+#stats: FormatStats实例，记录每个模型使用不同格式时的成功率
+#bulk: 是否使用服务商的离线批量任务接口，任务id保存在输出文件名加上 .bulk 后缀的状态文件中
+#bulkWait: 是否等待批量任务完成，为False时仅提交或者查询一次状态，下次运行时继续
+#large: 是否使用流式读写po文件(StreamCatalog)，适合超大的po文件，仅在内存中保留需要翻译的条目
+#glossary: Glossary实例，每个批次中出现的术语加入提示词，没有使用术语译文的翻译重新翻译一次
 def translateFile(fileName, agent, dstLang, srcLang=None, outFile=None, refPoFile='', 
-    refLang=None, fuzzify=False, excluded=None, fields=None):
-    print(f'{LANGUAGE_CODES.get(dstLang, dstLang)}: translating by {str(agent)}')
+    refLang=None, fuzzify=False, excluded=None, fields=None, workers=1, tm=None, resume=False, stream=False,
+    fmt='auto', stats=None, bulk=False, bulkWait=True, large=False, refIndex=None, glossary=None):
+    translateFiles({dstLang: fileName}, agent, srcLang=srcLang, outFiles={dstLang: outFile} if outFile else None,
+        refPoFile=refPoFile, refLang=refLang, fuzzify=fuzzify, excluded=excluded, fields=fields, workers=workers,
+        tm=tm, resume=resume, stream=stream, fmt=fmt, stats=stats, bulk=bulk, bulkWait=bulkWait, 
+        large=large, refIndex=refIndex, glossary=glossary)
+
+#翻译一个目录下的所有po文件，目录结构为 localeDir/<lang>/LC_MESSAGES/*.po
+#同一个语种的多个po文件中相同的文本只翻译一次，翻译结果更新到所有包含此文本的po文件
+#dstLangs: 目标语言代码列表
+#其他参数和 translateFile() 一致，日志文件为 localeDir/.autopo-<lang>.journal，批量任务状态文件为 localeDir/.autopo.bulk
+def translateTree(localeDir, agent, dstLangs, **kwargs):
+    fileNames = treeFiles(localeDir, dstLangs)
+    if fileNames:
+        journalFiles = {lang: os.path.join(localeDir, f'.autopo-{lang}.journal') for lang in fileNames}
+        translateFiles(fileNames, agent, journalFiles=journalFiles, bulkFile=os.path.join(localeDir, '.autopo.bulk'),
+            **kwargs)
+
+#返回目录下每个语种的po文件 {lang: [fileName,...]}，没有po文件的语种不在字典中
+def treeFiles(localeDir, dstLangs):
+    fileNames = {}
+    for lang in dstLangs:
+        files = sorted(glob.glob(os.path.join(localeDir, lang, '**', '*.po'), recursive=True))
+        if files:
+            fileNames[lang] = files
+        else:
+            print(f'No po files found for {lang} in {localeDir}')
+    return fileNames
+
+#翻译多个po文件，可以同时翻译多个语种，每个语种可以对应多个po文件
+#多个语种时一次请求同时翻译所有语种，源文本和系统提示词只需要发送一次
+#同一个语种的多个po文件中相同的文本只翻译一次，最后仅保存有修改的po文件
+#fileNames: 字典 {dstLang: fileName 或 [fileName,...]}
+#outFiles: 字典 {dstLang: outFile 或 [outFile,...]}，如果需要将翻译写到另外的文件，指定这个参数
+#journalFiles: 字典 {dstLang: journalFile}，默认为此语种第一个输出文件名加上 .journal 后缀
+#bulkFile: 离线批量任务的状态文件，默认为第一个输出文件名加上 .bulk 后缀
+#其他参数和 translateFile() 一致，多个语种时仅支持json格式
+def translateFiles(fileNames, agent, srcLang=None, outFiles=None, refPoFile='', refLang=None, 
+    fuzzify=False, excluded=None, fields=None, workers=1, tm=None, resume=False, stream=False, journalFiles=None,
+    fmt='auto', stats=None, bulk=False, bulkWait=True, bulkFile=None, large=False, refIndex=None, glossary=None):
+    dstLangs = list(fileNames.keys())
+    print('{}: translating by {}'.format(', '.join(LANGUAGE_CODES.get(e, e) for e in dstLangs), str(agent)))
     srcLang = srcLang or 'en'
-    outFile = outFile or fileName
+    toList = lambda x: [x] if isinstance(x, str) else list(x)
+    fileNames = {lang: toList(files) for lang, files in fileNames.items()}
+    outFiles = {lang: toList((outFiles or {}).get(lang) or files) for lang, files in fileNames.items()}
+    journalFiles = {lang: (journalFiles or {}).get(lang) or (outFiles[lang][0] + '.journal') for lang in dstLangs}
+
+    #没有指定 --resume 时不覆盖上次中断留下的日志，避免已经翻译的结果丢失
+    unfinished = [name for name in journalFiles.values() if TranslationJournal.unfinished(name)] if not resume else []
+    for name in unfinished:
+        print(f'Found an unfinished journal {name}, use --resume to continue or delete it to start over')
+    if unfinished:
+        return
+    journals = {lang: TranslationJournal(journalFiles[lang], resume) for lang in dstLangs}
+
+    #catalogs每个元素为 (po, outFile, pending)，pending为 [(entry, msgstr, fuzzy),...]，用于判断是否有修改
+    catalogs = []
+    objDics = {}
+    multiFiles = any(len(files) > 1 for files in fileNames.values())
+    for dstLang in dstLangs:
+        pos = []
+        for fileName, outFile in zip(fileNames[dstLang], outFiles[dstLang]):
+            if (len(dstLangs) > 1) or multiFiles:
+                print(f'  {LANGUAGE_CODES.get(dstLang, dstLang)}: {fileName}')
+            po = StreamCatalog(fileName) if large else polib.pofile(fileName)
+            pending = [e for e in po.untranslated_entries() + po.fuzzy_entries() if e.msgid]
+            catalogs.append((po, outFile, [(e, e.msgstr, e.fuzzy) for e in pending]))
+            pos.append(po)
+        objDics[dstLang] = prepareEntries(pos, agent, dstLang, srcLang, fuzzify, excluded, fields, tm, 
+            journals[dstLang])
+
+    #参考翻译在翻译每个批次时才从索引中查询
+    addRefs = None
+    refPoFiles = toList(refPoFile) if refPoFile else []
+    refLangs = toList(refLang) if refLang else []
+    if refPoFiles and refLangs:
+        refIndex = refIndex or Compendium(':memory:')
+        sources = indexReferences(refIndex, refPoFiles, refLangs)
+        addRefs = makeRefLookup(refIndex, sources, agent, fields)
+        refLangs = list(dict.fromkeys(lang for fileName, lang in sources))
+        refLang = refLangs[0] if len(refLangs) == 1 else refLangs
+    if glossary:
+        print(f'  Glossary: {glossary.fileName}, ' + ', '.join(f'{lang} {num} terms' 
+            for lang, num in glossary.languages().items() if lang in map(str.lower, dstLangs)))
+
+    #所有语种待翻译文本的并集，多个语种时每个批次仅请求其中的文本需要的语种
+    toTr = dict.fromkeys((key for objDic in objDics.values() for key in objDic), '')
+    if len(dstLangs) > 1:
+        fmt = 'json'
+    elif fmt == 'auto':
+        fmt = stats.choose(agent.model, list(TR_FORMATS)) if stats else 'id'
+    print(f'  Request format: {fmt}')
+    batches = buildBatches(toTr, agent, dstLangs=dstLangs, fields=fields, echoKeys=(fmt == 'json'))
+
+    #离线批量模式先将所有批次提交为一个批量任务，任务完成后使用任务的结果代替实时请求
+    bulkFile = bulkFile or (outFiles[dstLangs[0]][0] + '.bulk')
+    if bulk and batches:
+        #和实时翻译时构建完全相同的消息，任务完成后才能按照消息找到对应的结果
+        def bulkMessage(batch):
+            masked, unmask = maskBatch(addRefs(batch) if addRefs else batch)
+            if len(dstLangs) > 1:
+                langs = [lang for lang in dstLangs if any(key in objDics[lang] for key in batch)]
+                return buildMultiMessage(masked, langs, srcLang, refLang, fields, 
+                    glossary.find(batch, langs) if glossary else None, batchContexts(unmask))
+            return TR_BUILDERS[fmt](masked, dstLangs[0], srcLang, refLang, fields, 
+                glossary.find(batch, dstLangs[0]) if glossary else None, batchContexts(unmask))
+        agent = runBulkJob(agent, bulkFile, [bulkMessage(batch) for batch in batches], bulkWait)
+        if not agent: #任务还没有完成，这次运行没有任何翻译结果
+            for journal in journals.values():
+                journal.remove()
+            return
+
+    if len(dstLangs) > 1:
+        translator = functools.partial(translateMultiBatch, agent, srcLang=srcLang, refLang=refLang, 
+            objDics=objDics, fuzzify=fuzzify, fields=fields, tm=tm, journals=journals, addRefs=addRefs, 
+            glossary=glossary)
+    else:
+        dstLang = dstLangs[0]
+        translator = functools.partial(translateBatch, agent, dstLang=dstLang, srcLang=srcLang, refLang=refLang, 
+            objDic=objDics[dstLang], fuzzify=fuzzify, fields=fields, tm=tm, journal=journals[dstLang], 
+            stream=stream, fmt=fmt, stats=stats, addRefs=addRefs, glossary=glossary)
+    translateBatches(batches, translator, workers, makeCheckpoint([(po, outFile) for po, outFile, pending in catalogs if pending]))
+    if stats:
+        stats.save()
+    if len(agent.endpoints) > 1:
+        printEndpointStats(agent)
+    hedged = agent.agent if isinstance(agent, BulkReplayAgent) else agent
+    if isinstance(hedged, HedgedAgent):
+        printHedgeStats(hedged)
+        hedged.saveStats()
+
+    for po, outFile, pending in catalogs:
+        cnt = sum(1 for e, msgstr, fuzzy in pending if (e.msgstr != msgstr) or (e.fuzzy != fuzzy))
+        if (len(dstLangs) > 1) or multiFiles:
+            print(f'  {outFile}:')
+        saveCatalog(po, outFile, cnt)
+    for journal in journals.values():
+        journal.remove()
+    if bulk and os.path.exists(bulkFile):
+        os.remove(bulkFile)
+
+#打印每个 host/key 组合的请求统计和熔断状态，方便找出有问题的中转服务器或api key
+def printEndpointStats(agent):
+    print('  Endpoints:')
+    for item in agent.endpointStats():
+        latency = f"{item['latency']:.2f}s" if item['latency'] is not None else '-'
+        state = item['state'] + (f" ({item['openFor']}s)" if item['openFor'] else '')
+        print(f"    {item['host']} {item['key']}: {state}, requests {item['requests']}, errors {item['errors']}, "
+            f"429 {item['throttled']}, latency {latency}, rpm {item['rpm']}")
+
+#打印对冲请求的统计，wins为提供了最终结果的次数，hedge wins为作为对冲请求胜出的次数
+def printHedgeStats(agent):
+    print(f'  Hedged requests: {agent.hedged}')
+    for item in agent.hedgeStats():
+        fmtTime = lambda t: f'{t:.2f}s' if t is not None else '-'
+        print(f"    {item['provider']}: requests {item['requests']}, errors {item['errors']}, wins {item['wins']}, "
+            f"hedge wins {item['hedgeWins']}, p50 {fmtTime(item['p50'])}, p90 {fmtTime(item['p90'])}")
+
+#将参考po文件加入参考翻译索引，文件没有变化时不需要重新解析
+#refPoFiles/refLangs: 参考po文件列表和对应的语种列表，只有一个语种时所有文件都使用这个语种
+#返回 [(fileName, lang),...]，用于 makeRefLookup()
+def indexReferences(refIndex, refPoFiles, refLangs):
+    sources = []
+    for idx, fileName in enumerate(refPoFiles):
+        lang = refLangs[idx] if len(refLangs) > 1 else refLangs[0]
+        updated, num = refIndex.update(fileName)
+        print(f'  Reference {lang}: {fileName}, {num} entries' + (' (indexed)' if updated else ''))
+        sources.append((fileName, lang))
+    return sources
+
+#创建为一个批次加入参考翻译的函数，在翻译每个批次前调用，仅查询这个批次的文本
+#只有一个参考语种时值为参考译文，多个参考语种时为 {语种: 参考译文} 字典
+#参考翻译按照批次中的顺序加入，超出输入token预算的部分不再加入
+def makeRefLookup(refIndex, sources, agent, fields=None):
+    estimate = ai_providers.estimateTokens
+    refLangs = list(dict.fromkeys(lang for fileName, lang in sources))
+    limit = inputLimit(agent, fields)
+    def addRefs(batch):
+        found = refIndex.lookup(list(dict.fromkeys(str(key) for key, value in batch.items() if not value)), sources)
+        budget = limit - sum(estimate(key) + ENTRY_OVERHEAD for key in batch)
+        ret = {}
+        for key, value in batch.items():
+            refs = found.get(str(key))
+            if refs and not value:
+                ref = refs.get(refLangs[0], '') if len(refLangs) == 1 else refs
+                size = estimate(ref if isinstance(ref, str) else json.dumps(ref, ensure_ascii=False))
+                if size + ENTRY_OVERHEAD <= budget:
+                    value = ref
+                    budget -= size + ENTRY_OVERHEAD
+            ret[key] = value
+        return ret
+    return addRefs
+
+#返回参考语种在提示词中的名字，多个参考语种时参考翻译为以语言代码为键的字典
+def refLangName(refLang):
+    if not refLang:
+        return ''
+    elif isinstance(refLang, str):
+        return LANGUAGE_CODES.get(refLang, refLang)
+    elif len(refLang) == 1:
+        return LANGUAGE_CODES.get(refLang[0], refLang[0])
+    return ', '.join(f'{LANGUAGE_CODES.get(e, e)} ({e})' for e in refLang)
+
+#找出同一个语种的多个po文件中需要翻译的条目，相同的文本(并且上下文msgctxt相同)合并在一起
+#排除列表里面的文本和翻译记忆库里面能找到的文本直接填充，不需要再翻译
+#pos: 同一个语种的polib.POFile或StreamCatalog实例列表
+#journal: TranslationJournal实例，恢复中断的翻译时，日志里面已经有的翻译直接填充
+#返回 objDic，为待翻译字符串和entry对象列表的对应关系 {msgid: [entry,...]}，有上下文的条目键为 MsgKey 实例
+def prepareEntries(pos, agent, dstLang, srcLang, fuzzify=False, excluded=None, fields=None, tm=None, 
+    journal=None):
     excluded = (excluded or []) + EXCLUDED_LIST
-    refTrDic = {}
-    if refPoFile and refLang: #参考翻译
-        refPo = polib.pofile(refPoFile)
-        refTrDic = dict([(e.msgid, e.msgstr) for e in refPo.translated_entries() if e.msgid and e.msgstr])
-
-    objDic = {} #待翻译字符串和entry对象的对应关系
-    po = polib.pofile(fileName)
-    entries = po.untranslated_entries() + po.fuzzy_entries()
-    objDic = dict([(e.msgid, e) for e in entries if e.msgid])
-
-    #开始翻译
-    toTr = {key: refTrDic.get(key, '') for key in objDic}
-    batch = {}
-    currLen = 0
-    totalCnt = 0
+    entries = [e for po in pos for e in po.untranslated_entries() + po.fuzzy_entries() if e.msgid]
+
+    #先从翻译记忆库中查找，同时将人工校对过的翻译保存到记忆库中
+    #和记忆库中AI翻译的结果相同的已翻译条目是之前由本工具写入的，不会被当作人工校对过的翻译
+    filled = {} #{(msgid, msgctxt): msgstr}
+    if tm:
+        for po in pos:
+            tm.store([(e.msgid, e.msgctxt, e.msgstr) for e in po.translated_entries()], srcLang, dstLang, 
+                reviewed=True)
+        keys = list(dict.fromkeys((e.msgid, e.msgctxt or '') for e in entries))
+        filled = tm.lookup(keys, srcLang, dstLang, agent.model, fields)
+        print(f'  Found in translation memory: {len(filled)}')
+    if journal and journal.records:
+        resumed = {(e.msgid, e.msgctxt or '') for e in entries} & journal.records.keys()
+        filled.update((key, journal.records[key]) for key in resumed)
+        print(f'  Resumed from journal: {len(resumed)}')
+
+    objDic = {}
+    for e in entries:
+        msgstr = filled.get((e.msgid, e.msgctxt or '')) or (e.msgid if e.msgid in excluded else '')
+        if msgstr:
+            e.msgstr = msgstr
+            e.fuzzy = fuzzify
+        else:
+            objDic.setdefault(MsgKey(e.msgid, e.msgctxt) if e.msgctxt else e.msgid, []).append(e)
+    if len(pos) > 1:
+        print(f'  Entries to translate: {sum(len(v) for v in objDic.values())}, unique: {len(objDic)}')
+    return objDic
+
+#有上下文(msgctxt)的待翻译文本，仍然是原文字符串，比较和哈希时包括上下文
+#这样同样的文本在不同的上下文中分别翻译，没有上下文的条目直接使用msgid字符串作为键
+class MsgKey(str):
+    def __new__(cls, msgid, msgctxt=''):
+        obj = super().__new__(cls, msgid)
+        obj.msgctxt = msgctxt or ''
+        return obj
+
+    def __eq__(self, other):
+        if not isinstance(other, str):
+            return NotImplemented
+        return str.__eq__(self, other) and (getattr(other, 'msgctxt', '') == self.msgctxt)
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    def __hash__(self):
+        return hash((str(self), self.msgctxt))
+
+    def __repr__(self):
+        return f'MsgKey({str.__repr__(self)}, {self.msgctxt!r})'
+
+#返回批次中有上下文的文本 {替换占位符后的文本: msgctxt}，加入到提示词中
+#unmask: maskBatch() 返回的 {替换后的文本: (原来的键, tokens)}
+def batchContexts(unmask):
+    return {mkey: key.msgctxt for mkey, (key, tokens) in unmask.items() if getattr(key, 'msgctxt', '')}
+
+#将待翻译的字典分为多个批次，返回字典列表
+#按照估计的token数量打包，每个批次同时满足模型的输入上下文长度和最大输出长度限制
+#agent: SimpleAiProvider实例，使用其 context_size/output_size
+#dstLangs: 一次请求翻译的语种列表，根据每个语种的 LANGUAGE_EXPANSION 估计输出长度
+#fields: 领域列表，影响系统提示词的长度
+#echoKeys: AI返回的结果中是否包含原文键(json格式)，id/placeholder格式仅返回编号和译文
+#同样的文本有多个上下文时，每个批次中只放入一个，其余的放到后面的批次中，AI返回的结果以文本为键
+def buildBatches(toTr, agent, dstLangs=None, fields=None, echoKeys=True):
+    texts = set()
+    dups = {}
     for key, value in toTr.items():
-        if key in excluded:
-            objDic[key].msgstr = key
-            objDic[key].fuzzy = fuzzify
-            totalCnt += 1
-            continue
+        if str(key) in texts:
+            dups[key] = value
+        texts.add(str(key))
+    if dups:
+        toTr = {key: value for key, value in toTr.items() if key not in dups}
 
-        batch[key] = value
-        currLen += len(key) + len(value)
-        if currLen > BATCH_SIZE:
-            cnt = translateBatch(**locals())
-            batch = {}
-            currLen = 0
-            if cnt:
-                totalCnt += cnt
-            else:
+    outLimit = agent.output_size * OUTPUT_USAGE
+    inLimit = inputLimit(agent, fields)
+    sizes = entrySizes(toTr, dstLangs, echoKeys)
+
+    #先从大到小排序，每个批次先放入最大的条目，再用最小的条目填满剩余空间
+    keys = sorted(sizes, key=lambda k: sizes[k][1], reverse=True)
+    batches = []
+    head, tail = 0, len(keys) - 1
+    while head <= tail:
+        batch = {}
+        inUsed = outUsed = 0
+        while head <= tail:
+            inSize, outSize = sizes[keys[head]]
+            if batch and ((inUsed + inSize > inLimit) or (outUsed + outSize > outLimit)):
                 break
+            batch[keys[head]] = toTr[keys[head]]
+            inUsed += inSize
+            outUsed += outSize
+            head += 1
+        while head <= tail:
+            inSize, outSize = sizes[keys[tail]]
+            if (inUsed + inSize > inLimit) or (outUsed + outSize > outLimit):
+                break
+            batch[keys[tail]] = toTr[keys[tail]]
+            inUsed += inSize
+            outUsed += outSize
+            tail -= 1
+        batches.append(batch)
+    return batches + (buildBatches(dups, agent, dstLangs, fields, echoKeys) if dups else [])
+
+#返回每个条目估计的token数量 {key: (输入token, 输出token)}，输出包括原文键(或编号)和每个语种的译文
+def entrySizes(toTr, dstLangs=None, echoKeys=True):
+    estimate = ai_providers.estimateTokens
+    expansion = sum(LANGUAGE_EXPANSION.get(lang.lower(), DEFAULT_EXPANSION) for lang in (dstLangs or ['']))
+    sizes = {}
+    for key, value in toTr.items():
+        keyTokens = estimate(key) + ENTRY_OVERHEAD
+        ctxTokens = (estimate(key.msgctxt) + keyTokens) if getattr(key, 'msgctxt', '') else 0 #提示词中的上下文说明
+        sizes[key] = (keyTokens + estimate(value) + ctxTokens, 
+            keyTokens * expansion + (keyTokens if echoKeys else ENTRY_OVERHEAD))
+    return sizes
 
-    #剩余部分
-    if batch:
-        cnt = translateBatch(**locals())
-        if cnt:
-            totalCnt += cnt
+#每个批次的输入(待翻译文本和参考翻译)最多可以使用的token数量，扣除了提示词和输出需要的部分
+def inputLimit(agent, fields=None):
+    overhead = ai_providers.estimateTokens(SYS_PROMPT + TR_MULTI_PROMPT + TR_MULTI_REF + ''.join(fields or []))
+    return max(500, agent.context_size - agent.output_size - overhead)
 
-    if totalCnt:
-        for e in po.obsolete_entries():
-            po.remove(e)
-        po.save(outFile)
-        po = polib.pofile(outFile) #重新读取一次
+#保存翻译后的po文件，同时删除过时的条目
+#cnt: 已经翻译的条目数量，为0则不保存
+def saveCatalog(po, outFile, cnt):
+    if cnt:
+        if isinstance(po, polib.POFile): #一次过滤，逐个remove()每次都需要查找列表；StreamCatalog保存时自动删除
+            po[:] = [e for e in po if not e.obsolete]
+        savePoAtomic(po, outFile)
 
-    print(f'  Number of translated: {totalCnt}, percent of translated: {po.percent_translated()}%')
+    print(f'  Number of translated: {cnt}, percent of translated: {po.percent_translated()}%')
+
+#先保存到临时文件再替换，避免保存过程中断导致po文件损坏
+def savePoAtomic(po, outFile):
+    tmpFile = outFile + '.tmp'
+    po.save(tmpFile)
+    os.replace(tmpFile, outFile)
+
+#创建一个定时保存po文件的函数，在每个批次翻译完成后调用，至少间隔 CHECKPOINT_INTERVAL 秒保存一次
+#catalogs: [(po, outFile),...]
+def makeCheckpoint(catalogs):
+    lastSave = time.monotonic()
+    def checkpoint():
+        nonlocal lastSave
+        if time.monotonic() - lastSave >= CHECKPOINT_INTERVAL:
+            for po, outFile in catalogs:
+                savePoAtomic(po, outFile)
+            lastSave = time.monotonic()
+    return checkpoint
+
+#翻译多个批次，workers>1时使用线程池并发请求，每个批次完成后立即更新objDic
+#服务不可用时取消尚未开始的批次，已经在进行中的批次仍然会更新
+#某个批次没有翻译任何条目(比如每个条目都被检查丢弃)不影响其他批次
+#batches: 字典列表
+#translator: 翻译一个批次的函数，参数为一个批次的字典，返回已经翻译的条目数量(整数或Counter)，服务不可用时返回None
+#checkpoint: 每个批次完成后在当前线程调用的函数，用于定时保存
+#超出 --max-cost/--max-tokens 时停止发起新的请求，返回已经翻译的条目数量，由调用者保存po文件
+#返回已经翻译的条目数量
+def translateBatches(batches, translator, workers=1, checkpoint=None):
+    totalCnt = 0
+    stopped = False
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        #工作线程继承当前的上下文(服务模式下用于区分任务的输出)
+        futures = [executor.submit(contextvars.copy_context().run, translator, batch) for batch in batches]
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                cnt = future.result()
+            except ai_providers.BudgetExceeded as e:
+                if not stopped:
+                    print(f'  {e}, stopping')
+                    stopped = True
+                for f in futures:
+                    f.cancel()
+                continue
+            if cnt is None:
+                for f in futures:
+                    f.cancel()
+                continue
+            if cnt:
+                totalCnt = (totalCnt + cnt) if totalCnt else cnt
+            if checkpoint:
+                checkpoint()
+    return totalCnt
 
-#翻译某一批次的文本
+#翻译某一批次的文本，可能在工作线程中调用，各个批次的objDic键不会重叠
 #agent: SimpleAiProvider实例
 #batch: 要翻译的字典，键为待翻译字符串
 #dstLang/srcLang: 目标语言代码/源语言
 #refLang: 参考翻译文本的语种，如果存在的话
-#objDic: 键对应到entry实例的字典
+#objDic: 键对应到entry实例列表的字典
 #fuzzify: 是否标识刚翻译的词条为fuzzy
 #fields: 为了让AI更准确的翻译，提供材料所在领域，为一个字符串列表
+#tm: TranslationMemory实例，如果提供，翻译结果同时保存到翻译记忆库
+#journal: TranslationJournal实例，如果提供，翻译结果立即写入日志
+#stream: 是否使用流式响应，收到一个翻译就立即更新到对应的entry，即使响应中断也能保留已经收到的部分
+#fmt: 请求格式，为 TR_FORMATS 中的一个键
+#stats: FormatStats实例，如果提供，记录每次请求的成功率
+#addRefs: makeRefLookup() 返回的函数，如果提供，翻译前为这个批次加入参考翻译
+#glossary: Glossary实例，如果提供，这个批次中出现的术语加入提示词
 #返回已经翻译的条目数量
-def translateBatch(agent, batch, dstLang, srcLang, refLang, objDic, fuzzify=False, fields=None, **kwages):
-    print(f'  Translating a batch: {len(batch)}')
-    ret = translateJson(agent, batch, dstLang, srcLang, refLang, fields)
+def translateBatch(agent, batch, dstLang, srcLang, refLang, objDic, fuzzify=False, fields=None, tm=None, 
+    journal=None, stream=False, fmt='json', stats=None, addRefs=None, glossary=None, **kwages):
+    translator = TR_FORMATS[fmt]
+    batch = addRefs(batch) if addRefs else batch
+    retried = set() #因为没有使用术语译文而重新翻译过的键
+    def translateOnce(batch):
+        print(f'  Translating a batch: {len(batch)}')
+        masked, unmask = maskBatch(batch)
+        terms = glossary.find(batch, dstLang) if glossary else None
+        streamed = {}
+        def onPair(mkey, value):
+            ret = validateTranslations(unmaskResult({mkey: value}, unmask), objDic, quiet=True)
+            ret, unused = checkTerms(ret, glossary, dstLang, retried, quiet=True)
+            for key, value in ret.items():
+                if value and (key in objDic):
+                    for entry in objDic[key]:
+                        entry.msgstr = value
+                        entry.fuzzy = fuzzify
+                    streamed[key] = value
+
+        ret = translator(agent, masked, dstLang, srcLang, refLang, fields, onPair if stream else None, terms,
+            batchContexts(unmask))
+        if (ret is None) and not streamed:
+            return None, list(batch)
+        ret = {**streamed, **validateTranslations(unmaskResult(ret or {}, unmask), objDic)}
+        ret, unused = checkTerms(ret, glossary, dstLang, retried)
+        cnt = applyTranslation(ret, agent, dstLang, srcLang, objDic, fuzzify, fields, tm, journal)
+        markFuzzy(unused, objDic)
+        missing = [key for key in batch if not ret.get(key)]
+        if stats:
+            stats.record(agent.model, fmt, len(batch), len(batch) - len(missing))
+        return cnt, missing
+
+    return translateWithRecovery(batch, translateOnce, {'model': agent.model, 'format': fmt, 'lang': dstLang})
+
+#同时翻译某一批次的文本到多个语种，参数和 translateBatch() 类似
+#objDics: 字典 {dstLang: objDic}
+#journals: 字典 {dstLang: TranslationJournal}
+#返回Counter实例，为每个语种已经翻译的条目数量
+def translateMultiBatch(agent, batch, srcLang, refLang, objDics, fuzzify=False, fields=None, tm=None, 
+    journals=None, addRefs=None, glossary=None):
+    batch = addRefs(batch) if addRefs else batch
+    dstLangs = [lang for lang, objDic in objDics.items() if any(key in objDic for key in batch)]
+    retried = {lang: set() for lang in dstLangs}
+    pending = {key: [lang for lang in dstLangs if key in objDics[lang]] for key in batch} #每个键还没有翻译的语种
+    #重试时按照还缺失的语种分组，每组仅请求这些语种
+    def translateOnce(batch):
+        groups = {}
+        for key in batch:
+            if pending[key]:
+                groups.setdefault(tuple(pending[key]), []).append(key)
+        cnt = Counter()
+        failed = False
+        for langs, keys in groups.items():
+            print(f'  Translating a batch: {len(keys)} x {len(langs)}')
+            masked, unmask = maskBatch({key: batch[key] for key in keys})
+            terms = glossary.find(keys, list(langs)) if glossary else None
+            ret = translateJsonMulti(agent, masked, list(langs), srcLang, refLang, fields, terms, batchContexts(unmask))
+            if ret is None:
+                failed = True
+                continue
+            ret = unmaskResult(ret, unmask)
+            for dstLang in langs:
+                objDic = objDics[dstLang]
+                langRet = {k: v.get(dstLang, '') for k, v in ret.items() if isinstance(v, dict) and k in objDic}
+                langRet = validateTranslations(langRet, objDic)
+                langRet, unused = checkTerms(langRet, glossary, dstLang, retried[dstLang])
+                cnt[dstLang] += applyTranslation(langRet, agent, dstLang, srcLang, objDic, fuzzify, fields, tm,
+                    (journals or {}).get(dstLang))
+                markFuzzy(unused, objDic)
+                for key in keys:
+                    if langRet.get(key):
+                        pending[key].remove(dstLang)
+        missing = [key for key in batch if pending[key]]
+        return (None if (failed and not cnt) else +cnt), missing
+
+    info = {'model': agent.model, 'format': 'multi', 'lang': ','.join(dstLangs)}
+    return translateWithRecovery(batch, translateOnce, info)
+
+#翻译一个批次，部分失败时仅重新翻译缺失的条目，完全失败时将批次一分为二分别重试，直到单个条目
+#单个条目失败时再重试一次，这样一个有问题的文本只会影响它自己，不会导致整个批次甚至整个文件的翻译失败
+#translateOnce: 翻译一个批次的函数，返回 (已经翻译的条目数量, 没有翻译成功的键列表)
+#  如果是请求本身失败(服务不可用)，已经翻译的条目数量为None，这种情况下不再重试
+#info: 记录批次指标时使用的 model/format/lang
+#retried: 单个条目是否已经重试过
+#返回已经翻译的条目数量(整数或Counter)，服务不可用并且没有翻译任何条目时返回None
+def translateWithRecovery(batch, translateOnce, info=None, retried=False):
+    cnt, missing = measureBatch(batch, translateOnce, info)
+    if cnt is None:
+        return None
+    elif not missing:
+        return cnt
+    elif cnt and (len(missing) < len(batch)): #部分成功，重新翻译缺失的条目，缺失的条目没有减少时按照完全失败处理
+        print(f'  Retrying {len(missing)} missing entries')
+        subCnt = translateWithRecovery({key: batch[key] for key in missing}, translateOnce, info)
+        return (cnt + subCnt) if subCnt else cnt
+    elif len(batch) > 1: #完全失败，分成两半
+        keys = list(batch)
+        half = len(keys) // 2
+        print(f'  Splitting a failed batch: {len(batch)}')
+        cnt1 = translateWithRecovery({key: batch[key] for key in keys[:half]}, translateOnce, info)
+        cnt2 = translateWithRecovery({key: batch[key] for key in keys[half:]}, translateOnce, info)
+        return addCounts(cnt1, cnt2)
+    elif not retried:
+        print(f'  Retrying a failed entry: {next(iter(batch))[:50]}')
+        return translateWithRecovery(batch, translateOnce, info, retried=True)
+    else:
+        print(f'  Failed to translate: {next(iter(batch))[:50]}')
+        return cnt
+
+#合并两部分的翻译数量(整数或Counter)，两部分都没有翻译任何条目并且其中一部分服务不可用时返回None
+def addCounts(cnt1, cnt2):
+    if not cnt1 and not cnt2:
+        return None if (cnt1 is None) or (cnt2 is None) else cnt1
+    return (cnt1 + cnt2) if (cnt1 and cnt2) else (cnt1 or cnt2)
+
+#调用 translateOnce 翻译一个批次，设置了 currentMetrics 时记录一个 batch 事件
+#包括翻译成功和丢弃(缺失或者被拒绝)的条目数量，以及等待/退避/网络/处理各自的时间
+def measureBatch(batch, translateOnce, info=None):
+    metrics = ai_providers.currentMetrics.get()
+    if not metrics:
+        return translateOnce(batch)
+    with metrics.batch() as totals:
+        cnt, missing = translateOnce(batch)
+    metrics.record('batch', **(info or {'model': '', 'format': '', 'lang': ''}), entries=len(batch), 
+        translated=len(batch) - len(missing), dropped=len(missing), failed=cnt is None, **totals)
+    return cnt, missing
+
+#检查AI返回的翻译，使用原文的首尾空白，占位符/标签不一致的翻译被丢弃，之后作为缺失的条目重新翻译
+#quiet: 不打印被丢弃的翻译，流式响应时使用，最后还会再检查一次完整的结果
+#返回通过检查的翻译字典
+def validateTranslations(ret, objDic, quiet=False):
+    valid = {}
+    for key, value in ret.items():
+        if not (value and isinstance(value, str) and (key in objDic)): #由 applyTranslation() 报告
+            valid[key] = value
+            continue
+        value = fixWhitespace(key, value)
+        reason = checkTranslation(key, value, objDic[key][0].flags)
+        if reason:
+            if not quiet:
+                print(f'  Rejected translation ({reason}): {key[:50]}')
+        else:
+            valid[key] = value
+    return valid
+
+#检查翻译是否使用了术语表中的术语译文，第一次没有使用时丢弃翻译，之后作为缺失的条目重新翻译
+#重新翻译后仍然没有使用的(比如需要变格的语种)，保留翻译，但是标识为fuzzy，等待人工校对
+#retried: 已经因为术语重新翻译过的键，同一个批次的多次翻译之间共享
+#quiet: 流式响应时使用，仅过滤，不记录也不打印，最后还会再检查一次完整的结果
+#返回 (通过检查的翻译字典, 需要标识为fuzzy的键列表)
+def checkTerms(ret, glossary, dstLang, retried, quiet=False):
+    if not glossary:
+        return ret, []
+    valid = {}
+    unused = []
+    for key, value in ret.items():
+        missing = glossary.missing(key, value, dstLang) if (value and isinstance(value, str)) else None
+        if not missing:
+            valid[key] = value
+        elif key in retried:
+            valid[key] = value
+            unused.append(key)
+            if not quiet:
+                print(f'  Glossary terms not used ({", ".join(missing)}), marked as fuzzy: {key[:50]}')
+        elif not quiet:
+            retried.add(key)
+            print(f'  Rejected translation (glossary: {", ".join(missing)}): {key[:50]}')
+    return valid, unused
+
+#将条目标识为fuzzy
+def markFuzzy(keys, objDic):
+    for key in keys:
+        for entry in objDic.get(key, []):
+            entry.fuzzy = True
+
+#将AI返回的翻译字典更新到对应的entry，返回已经翻译的文本数量(相同的文本只计数一次)
+def applyTranslation(ret, agent, dstLang, srcLang, objDic, fuzzify=False, fields=None, tm=None, journal=None):
     cnt = 0
+    tmItems = []
     for k, v in ret.items():
         if not k:
             print('  Found a empty key')
@@ -167,146 +800,716 @@ def translateBatch(agent, batch, dstLang, srcLang, refLang, objDic, fuzzify=Fals
         elif not v:
             print(f'  Found a empty value for key in translated: {k}')
             continue
-        elif entry := objDic.get(k):
-            entry.msgstr = v
-            entry.fuzzy = fuzzify
+        elif entries := objDic.get(k):
+            for entry in entries:
+                entry.msgstr = v
+                entry.fuzzy = fuzzify
+                tmItems.append((entry.msgid, entry.msgctxt, v))
             cnt += 1
         else:
             print(f'  The key in translated is modified? {k}')
+    if journal and tmItems:
+        journal.append(tmItems)
+    if tm and tmItems:
+        tm.store(tmItems, srcLang, dstLang, agent.model, fields)
     return cnt
 
+#流式响应的增量解析器，从不断到达的文本中解析出已经完整的json键值对
+#仅支持值为字符串的单层字典，每解析出一个键值对就调用 onPair(key, value)
+class JsonPairParser:
+    PAIR_PAT = re.compile(r'\s*[{,]\s*"((?:[^"\\]|\\.)*)"\s*:\s*"((?:[^"\\]|\\.)*)"', re.DOTALL)
+
+    def __init__(self, onPair):
+        self.onPair = onPair
+        self.reset()
+
+    def reset(self):
+        self.buf = ''
+        self.pos = -1 #第一个 { 的位置，之前的文本为AI添加的额外字符
+
+    def feed(self, text):
+        self.buf += text
+        if self.pos < 0:
+            self.pos = self.buf.find('{')
+            if self.pos < 0:
+                return
+        while match := self.PAIR_PAT.match(self.buf, self.pos):
+            self.pos = match.end()
+            try:
+                key, value = json.loads(f'["{match.group(1)}","{match.group(2)}"]')
+            except ValueError:
+                continue
+            self.onPair(key, value)
+
+#发送请求，失败后重试，agent.chat() 内部会按照速率限制器自动等待
+#429错误由速率限制器根据 Retry-After 等响应头处理，其他错误使用带随机抖动的指数退避
+#返回响应文本，全部失败返回空字符串
+#parser: JsonPairParser实例，如果提供，则使用流式响应，每次请求前重置解析状态
+def chatWithRetry(agent, msg, parser=None):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            if parser:
+                parser.reset()
+                return agent.chat(msg, onText=parser.feed)
+            return agent.chat(msg)
+        except ai_providers.BudgetExceeded: #重试也不会成功，由 translateBatches() 停止整个翻译
+            raise
+        except Exception as e:
+            gaveUp = attempt >= MAX_RETRIES
+            rateLimited = isinstance(e, ai_providers.HttpResponseError) and (e.status == 429)
+            delay = 0 if (rateLimited or gaveUp) else ai_providers.backoffDelay(attempt)
+            if metrics := ai_providers.currentMetrics.get():
+                metrics.record('retry', provider=agent.name, model=agent.model, host=agent.host, attempt=attempt,
+                    status=getattr(e, 'status', None), error=type(e).__name__, message=str(e)[:200], 
+                    delay=round(delay, 3), gaveUp=gaveUp)
+            if gaveUp:
+                print(f'Error [{agent.host}]: {str(e)}, breaking')
+                return ''
+            print(f'Error [{agent.host}]: {str(e)}, retrying in {delay:.1f}s')
+            time.sleep(delay)
+    return ''
+
 #使用json方法翻译一个字典
 #agent: SimpleAiProvider实例
 #dic: 要翻译的字典，键为待翻译字符串
 #dstLang/srcLang: 目标语言代码/源语言
 #refLang: 参考翻译文本的语种，如果存在的话
 #fields: 为了让AI更准确的翻译，提供材料所在领域，为一个字符串列表
-#返回翻译后的字典
-def translateJson(agent, dic, dstLang, srcLang, refLang=None, fields=None):
+#onPair: 如果提供，则使用流式响应，每收到一个完整的键值对就调用 onPair(key, value)
+#terms: 这个批次中出现的术语 {源术语: 译文}，加入到提示词中
+#contexts: 有上下文(msgctxt)的文本 {文本: msgctxt}，加入到提示词中
+#返回翻译后的字典，请求失败返回None，返回的json无效时尽量从中提取有效的键值对
+def translateJson(agent, dic, dstLang, srcLang, refLang=None, fields=None, onPair=None, terms=None, contexts=None):
+    msg = buildJsonMessage(dic, dstLang, srcLang, refLang, fields, terms, contexts)
+    respTxt = chatWithRetry(agent, msg, JsonPairParser(onPair) if onPair else None)
+    if not respTxt:
+        print('Response is empty')
+        return None
+    return parseJsonDict(respTxt)
+
+#构建json方法的请求消息，参数和 translateJson() 一致
+def buildJsonMessage(dic, dstLang, srcLang, refLang=None, fields=None, terms=None, contexts=None):
     fields = ' in fields "{}"'.format('/'.join(fields)) if fields else ''
     msg = [{"role": "system", "content": SYS_PROMPT.format(fields=fields)},
         {"role": "user", "content": ''}]
     text = json.dumps(dic, separators=(',', ':'), ensure_ascii=False)
     src = LANGUAGE_CODES.get(srcLang, srcLang)
     dst = LANGUAGE_CODES.get(dstLang, dstLang)
-    refLang = LANGUAGE_CODES.get(refLang, refLang)
+    refLang = refLangName(refLang)
     if refLang:
         msg[1]['content'] = TR_REF_PROMPT.format(text=text, src=src, dst=dst, refLang=refLang)
     else:
         msg[1]['content'] = TR_PROMPT.format(text=text, src=src, dst=dst)
-    
-    interval = (60 / agent.rpm) if (agent.rpm > 0) else 20 #两次请求直接的间隔
+    msg[1]['content'] += termsPrompt(terms) + contextsPrompt(contexts)
+    return msg
+
+#返回加入到请求消息中的术语说明，没有术语时返回空字符串
+#terms: {源术语: 译文}，多个语种时为 {源术语: {语种: 译文}}
+def termsPrompt(terms):
+    if not terms:
+        return ''
+    lines = []
+    for term, target in terms.items():
+        if isinstance(target, dict):
+            target = '; '.join(f'{lang}: {value}' for lang, value in target.items())
+        lines.append(f'- {term}: {target}')
+    return TR_TERMS_PROMPT.format(terms='\n'.join(lines))
+
+#返回加入到请求消息中的上下文说明，没有上下文时返回空字符串
+#contexts: {文本: msgctxt}
+#labels: {文本: 提示词中代表这个文本的编号或占位符}，为空时使用json格式的文本
+def contextsPrompt(contexts, labels=None):
+    if not contexts:
+        return ''
+    label = lambda text: (labels or {}).get(text) or json.dumps(text, ensure_ascii=False)
+    return TR_CTX_PROMPT.format(contexts='\n'.join(f'- {label(text)}: {ctxt}' for text, ctxt in contexts.items()))
+
+#使用编号方法翻译一个字典，每个文本使用一个数字编号，AI仅返回 {编号: 译文}，不需要重复原文
+#参数和返回值与 translateJson() 一致
+def translateById(agent, dic, dstLang, srcLang, refLang=None, fields=None, onPair=None, terms=None, contexts=None):
+    msg = buildIdMessage(dic, dstLang, srcLang, refLang, fields, terms, contexts)
+    ids = {str(idx): key for idx, key in enumerate(dic, 1)}
+    def onIdPair(idx, value):
+        if idx in ids:
+            onPair(ids[idx], value)
+
+    respTxt = chatWithRetry(agent, msg, JsonPairParser(onIdPair) if onPair else None)
+    if not respTxt:
+        print('Response is empty')
+        return None
+    ret = parseJsonDict(respTxt)
+    return {ids[idx]: value for idx, value in ret.items() if (idx in ids) and isinstance(value, str)}
+
+#构建编号方法的请求消息，编号从1开始，参数和 translateById() 一致
+def buildIdMessage(dic, dstLang, srcLang, refLang=None, fields=None, terms=None, contexts=None):
+    fields = ' in fields "{}"'.format('/'.join(fields)) if fields else ''
+    ids = {str(idx): key for idx, key in enumerate(dic, 1)}
+    text = json.dumps(ids, separators=(',', ':'), ensure_ascii=False)
+    refs = {idx: dic[key] for idx, key in ids.items() if dic[key]}
+    src = LANGUAGE_CODES.get(srcLang, srcLang)
+    dst = LANGUAGE_CODES.get(dstLang, dstLang)
+    refLang = refLangName(refLang)
+    ref = ''
+    if refLang and refs:
+        ref = TR_ID_REF.format(refLang=refLang)
+        text += '\n\nReference dictionary:\n' + json.dumps(refs, separators=(',', ':'), ensure_ascii=False)
+    return [{"role": "system", "content": SYS_PROMPT.format(fields=fields)},
+        {"role": "user", "content": TR_ID_PROMPT.format(text=text, src=src, dst=dst, ref=ref) + termsPrompt(terms) +
+            contextsPrompt(contexts, {key: idx for idx, key in ids.items()})}]
+
+#从AI返回的文本中解析出json字典
+#有部分AI不严格遵守指令要求，json前后可能有额外字符，这里简单提取里面的json字典
+#返回的json无效时尽量从中提取有效的键值对
+#如果响应因为达到最大输出长度而被截断，直接提取完整的键值对，缺失的条目由 translateWithRecovery() 重新翻译
+def parseJsonDict(respTxt):
+    if getattr(respTxt, 'truncated', False):
+        ret = salvagePairs(respTxt)
+        print(f'  Response truncated ({respTxt.finishReason}), kept {len(ret)} complete pairs')
+        return ret
+
+    startBraces = respTxt.find('{')
+    endBraces = respTxt.rfind('}')
+    if startBraces != -1 and endBraces != -1:
+        respTxt = respTxt[startBraces:endBraces + 1]
+
     try:
-        respTxt = agent.chat(msg)
-        time.sleep(interval)
-    except Exception as e:
-        print(f'Error: {str(e)}, retrying')
-        time.sleep(interval + 30)
+        ret = json.loads(respTxt)
+        if isinstance(ret, dict):
+            return ret
+    except:
+        pass
+    ret = salvagePairs(respTxt)
+    print('  Received json is invalid, salvaged {} pairs: \n{}\n'.format(len(ret), respTxt[:100]))
+    return ret
+
+#从无效的json文本中提取出格式完整的 "key": "value" 键值对，返回字典
+def salvagePairs(text):
+    ret = {}
+    for match in re.finditer(r'"((?:[^"\\]|\\.)*)"\s*:\s*"((?:[^"\\]|\\.)*)"', text, re.DOTALL):
         try:
-            respTxt = agent.chat(msg) #再失败就直接退出
-            time.sleep(interval)
-        except Exception as e:
-            print(f'Error again: {str(e)}, breaking')
-            return {}
+            key, value = json.loads(f'["{match.group(1)}","{match.group(2)}"]')
+        except ValueError:
+            continue
+        ret[key] = value
+    return ret
 
+#使用json方法将一个字典同时翻译为多个语种
+#dstLangs: 目标语言代码列表
+#其他参数和 translateJson() 一致
+#返回翻译后的字典 {key: {dstLang: translation}}，请求失败返回None
+def translateJsonMulti(agent, dic, dstLangs, srcLang, refLang=None, fields=None, terms=None, contexts=None):
+    msg = buildMultiMessage(dic, dstLangs, srcLang, refLang, fields, terms, contexts)
+    respTxt = chatWithRetry(agent, msg)
     if not respTxt:
-        print('Response is empty, breaking')
-        return {}
+        print('Response is empty')
+        return None
+    elif getattr(respTxt, 'truncated', False):
+        ret = salvageObjects(respTxt)
+        print(f'  Response truncated ({respTxt.finishReason}), kept {len(ret)} complete items')
+        return ret
 
-    #处理这一批次的翻译结果
-    #print(respTxt) #TODO
-    #有部分AI不严格遵守指令要求，json前后可能有额外字符，这里简单提取里面的json字典
     startBraces = respTxt.find('{')
     endBraces = respTxt.rfind('}')
     if startBraces != -1 and endBraces != -1:
         respTxt = respTxt[startBraces:endBraces + 1]
 
     try:
-        return json.loads(respTxt)
+        ret = json.loads(respTxt)
+        if isinstance(ret, dict):
+            return ret
     except:
-        print('  Received json is invalid: \n{}\n'.format(respTxt[:100]))
-        return {}
+        pass
+    ret = salvageObjects(respTxt)
+    print('  Received json is invalid, salvaged {} items: \n{}\n'.format(len(ret), respTxt[:100]))
+    return ret
+
+#从无效的json文本中提取出格式完整的 "key": {...} 键值对(值为单层字典)，返回字典
+def salvageObjects(text):
+    ret = {}
+    for match in re.finditer(r'"((?:[^"\\]|\\.)*)"\s*:\s*(\{(?:[^{}"]|"(?:[^"\\]|\\.)*")*\})', text, re.DOTALL):
+        try:
+            key = json.loads(f'"{match.group(1)}"')
+            value = json.loads(match.group(2))
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            ret[key] = value
+    return ret
+
+#构建同时翻译多个语种的请求消息，参数和 translateJsonMulti() 一致
+def buildMultiMessage(dic, dstLangs, srcLang, refLang=None, fields=None, terms=None, contexts=None):
+    fields = ' in fields "{}"'.format('/'.join(fields)) if fields else ''
+    text = json.dumps(dic, separators=(',', ':'), ensure_ascii=False)
+    src = LANGUAGE_CODES.get(srcLang, srcLang)
+    dst = ', '.join(f'{LANGUAGE_CODES.get(e, e)} ({e})' for e in dstLangs)
+    refLang = refLangName(refLang)
+    ref = TR_MULTI_REF.format(refLang=refLang) if refLang else ''
+    return [{"role": "system", "content": SYS_PROMPT.format(fields=fields)},
+        {"role": "user", "content": TR_MULTI_PROMPT.format(text=text, src=src, dst=dst, 
+            codes=', '.join(dstLangs), ref=ref) + termsPrompt(terms) + contextsPrompt(contexts)}]
 
 #使用占位符方法翻译一个字典
 #agent: SimpleAiProvider实例
 #dic: 要翻译的字典，键为待翻译字符串，值为空
 #dstLang/srcLang: 目标语言代码/源语言
-#refLang: 参考翻译文本的语种，如果存在的话
+#refLang: 参考翻译文本的语种，dic的值为参考翻译，和id格式一样以编号为键附加在文本之后
+#onPair: 为了和 translateJson() 的参数一致，占位符方法不支持流式解析
 #fields: 为了让AI更准确的翻译，提供材料所在领域，为一个字符串列表
-#返回翻译后的字典
-def translateByPlaceholder(agent, dic, dstLang, srcLang, fields=None):
+#terms: 这个批次中出现的术语 {源术语: 译文}
+#contexts: 有上下文(msgctxt)的文本 {文本: msgctxt}
+#返回翻译后的字典，请求失败返回None
+def translateByPlaceholder(agent, dic, dstLang, srcLang, refLang=None, fields=None, onPair=None, terms=None,
+    contexts=None):
+    msg = buildPlaceholderMessage(dic, dstLang, srcLang, refLang, fields, terms, contexts)
+    hldMap = dict(enumerate(dic))
+    respTxt = chatWithRetry(agent, msg)
+    if not respTxt:
+        print('Response is empty, breaking')
+        return None
+
+    #处理这一批次的翻译结果
+    #print(respTxt) #TODO
+    #根据占位符，提取翻译字符串
+    pat = r'{{\s*id\s*_\s*(\d+)\s*}}(.*?)(?={{\s*id\s*_\s*\d+\s*}}|$)'
+    matches = re.findall(pat, respTxt, re.DOTALL)
+    if getattr(respTxt, 'truncated', False) and matches: #最后一段可能不完整
+        print(f'  Response truncated ({respTxt.finishReason}), dropping the last item')
+        matches.pop()
+    ret = {}
+    for match in matches:
+        item = hldMap.get(int(match[0]))
+        tred = match[1].strip()
+        if item and tred and ((tred != item) or isIdentityAllowed(item)):
+            ret[item] = tred
+    return ret
+
+#较短的文本或者没有字母的文本(数字/符号/占位符)，译文和原文相同是正常的，不当作没有翻译
+def isIdentityAllowed(text):
+    return (len(text.split()) <= IDENTITY_MAX_WORDS) or not re.search(r'[^\W\d_]', text)
+
+#构建占位符方法的请求消息，参数和 translateByPlaceholder() 一致
+def buildPlaceholderMessage(dic, dstLang, srcLang, refLang=None, fields=None, terms=None, contexts=None):
     fields = ' in fields "{}"'.format('/'.join(fields)) if fields else ''
     msg = [{"role": "system", "content": SYS_PROMPT.format(fields=fields)},
         {"role": "user", "content": ''}]
     
     #构建翻译字符串，每一段使用占位符标识
-    hldMap = {}
     textArr = []
     for idx, item in enumerate(dic):
-        hldMap[idx] = item
         textArr.append(f'{{{{id_{idx}}}}}\n{item}')
     text = '\n\n'.join(textArr)
     
+    refs = {f'id_{idx}': value for idx, (item, value) in enumerate(dic.items()) if value}
+    refLang = refLangName(refLang)
+    ref = ''
+    if refLang and refs:
+        ref = TR_PH_REF.format(refLang=refLang)
+        text += '\n\nReference dictionary:\n' + json.dumps(refs, separators=(',', ':'), ensure_ascii=False)
+
     src = LANGUAGE_CODES.get(srcLang, srcLang)
     dst = LANGUAGE_CODES.get(dstLang, dstLang)
-    msg[1]['content'] = TR_PH_PROMPT.format(text=text, src=src, dst=dst)
-    
-    interval = (60 / agent.rpm) if (agent.rpm > 0) else 20 #两次请求直接的间隔
-    try:
-        respTxt = agent.chat(msg)
-        time.sleep(interval)
-    except Exception as e:
-        print(f'Error [{agent.host}]: {str(e)}, retrying')
-        time.sleep(interval + 30)
+    msg[1]['content'] = TR_PH_PROMPT.format(text=text, src=src, dst=dst, ref=ref) + termsPrompt(terms) + contextsPrompt(
+        contexts, {item: f'{{{{id_{idx}}}}}' for idx, item in enumerate(dic)})
+    return msg
+
+#支持的请求格式，参数和返回值一致
+TR_FORMATS = {'json': translateJson, 'id': translateById, 'placeholder': translateByPlaceholder}
+#每种请求格式对应的消息构建函数，离线批量任务使用
+TR_BUILDERS = {'json': buildJsonMessage, 'id': buildIdMessage, 'placeholder': buildPlaceholderMessage}
+
+#plan 子命令，不发起任何网络请求，估计翻译需要的批次/token/时间/费用，用于选择服务商和key的数量
+#按照翻译时完全相同的方法准备条目(排除列表/翻译记忆库)和分批，每个 AI_LIST 中的模型分别计算
+#配置文件中的服务商使用配置的host和key数量，其他服务商使用 --keys 个key
+#返回错误信息，成功返回空字符串
+def planTranslation(args):
+    dstLangs = [e.strip() for e in args.dest.split(',') if e.strip()]
+    if args.tree:
+        fileNames = treeFiles(args.file, dstLangs)
+    elif (len(dstLangs) > 1) and ('{lang}' not in args.file):
+        return 'You have to use {lang} in the file path for multiple target languages'
+    else:
+        fileNames = {lang: [args.file.replace('{lang}', lang)] for lang in dstLangs}
+    if not fileNames:
+        return 'No po files to plan'
+    dstLangs = list(fileNames)
+    srcLang = args.src or 'en'
+
+    configured = []
+    if args.config or os.path.exists(CONFIG_JSON):
         try:
-            respTxt = agent.chat(msg) #再失败就直接退出
-            time.sleep(interval)
+            agent = createAiAgent(args.config)
         except Exception as e:
-            print(f'Error again [{agent.host}]: {str(e)}, breaking')
-            return {}
+            return f'Failed to load the config file: {e}'
+        configured = getattr(agent, 'agents', [agent])
 
-    if not respTxt:
-        print('Response is empty, breaking')
-        return {}
+    #翻译记忆库的查找结果和模型有关，使用配置文件中的模型，人工校对过的翻译所有模型都可以使用
+    tm = TranslationMemory(args.tm, reviewedOnly=args.tm_reviewed_only) if args.tm else None
+    try:
+        objDics = {}
+        for lang in dstLangs:
+            pos = [polib.pofile(fileName) for fileName in fileNames[lang]]
+            model = configured[0] if configured else SimpleNamespace(model='')
+            print(f'{LANGUAGE_CODES.get(lang, lang)}: ' + ', '.join(fileNames[lang]))
+            objDics[lang] = prepareEntries(pos, model, lang, srcLang, tm=tm)
+            if len(pos) == 1: #多个文件时 prepareEntries() 已经打印
+                print(f'  Entries to translate: {sum(len(v) for v in objDics[lang].values())}')
+    finally:
+        if tm:
+            tm.close()
+    toTr = dict.fromkeys((key for objDic in objDics.values() for key in objDic), '')
+    if not toTr:
+        return 'Nothing to translate'
+    glossary = Glossary(args.glossary) if args.glossary else None
+    stats = FormatStats(args.format_stats) if args.format == 'auto' else None
 
-    #处理这一批次的翻译结果
-    #print(respTxt) #TODO
-    #根据占位符，提取翻译字符串
-    pat = r'{{\s*id\s*_\s*(\d+)\s*}}(.*?)(?={{\s*id\s*_\s*\d+\s*}}|$)'
-    matches = re.findall(pat, respTxt, re.DOTALL)
-    ret = {}
-    for match in matches:
-        item = hldMap.get(int(match[0]))
-        tred = match[1].strip()
-        if item and tred and tred != item:
-            ret[item] = tred
-    return ret
+    providers = [e.strip().lower() for e in args.provider.split(',')] if args.provider else list(ai_providers.AI_LIST)
+    plans = []
+    for name in providers:
+        if name not in ai_providers.AI_LIST:
+            return f'Unsupported provider: {name}'
+        base = next((agent for agent in configured if agent.name == name), None)
+        for item in ai_providers.AI_LIST[name]['models']:
+            agent = next((e for e in configured if (e.name == name) and (e.model == item['name'])), None)
+            if not agent: #同一个服务商的其他模型使用配置的host和key
+                apiKey = ';'.join(base.apiKeys) if base else ';'.join(['plan'] * max(1, args.keys))
+                apiHost = ';'.join(host.geturl() for host, conn in base.connPools) if base else None
+                agent = ai_providers.SimpleAiProvider(name, apiKey, model=item['name'], apiHost=apiHost)
+            fmt = 'json' if len(dstLangs) > 1 else args.format
+            if fmt == 'auto':
+                fmt = stats.choose(agent.model, list(TR_FORMATS))
+            plan = planModel(agent, toTr, dstLangs, srcLang, fmt, glossary, args.workers)
+            plan['configured'] = agent in configured
+            plans.append(plan)
+            agent.close()
+
+    plans.sort(key=lambda e: e['time'])
+    print(f'Unique texts: {len(toTr)}, workers: {args.workers}, * = configured')
+    print(f'  {"provider/model":<44} {"format":<11} {"requests":>8} {"input":>9} {"output":>9} {"keys":>4} '
+        f'{"rpm":>6} {"tpm":>9} {"time":>9} {"cost":>9}')
+    for e in plans:
+        cost = f"${e['cost']:.4f}" if e['cost'] is not None else '-'
+        note = ' (daily limit)' if e['days'] else ''
+        print(f"{'*' if e['configured'] else ' '} {e['model']:<44} {e['format']:<11} {e['requests']:>8} "
+            f"{e['input']:>9} {e['output']:>9} {e['endpoints']:>4} {e['rpm']:>6} {e['tpm'] or '-':>9} "
+            f"{formatDuration(e['time']):>9} {cost:>9}{note}")
+    return ''
+
+#估计使用一个模型翻译的请求数量/token数量/时间/费用
+#时间取速率限制(rpm/tpm)需要的时间和按照并发数计算的请求延迟两者中较大的一个
+def planModel(agent, toTr, dstLangs, srcLang, fmt, glossary=None, workers=1):
+    echoKeys = (fmt == 'json')
+    batches = buildBatches(toTr, agent, dstLangs=dstLangs, echoKeys=echoKeys)
+    sizes = entrySizes(toTr, dstLangs, echoKeys)
+    inTokens = outTokens = 0
+    latencies = []
+    for batch in batches:
+        masked, unmask = maskBatch(batch)
+        if len(dstLangs) > 1:
+            msg = buildMultiMessage(masked, dstLangs, srcLang, None, None, 
+                glossary.find(batch, dstLangs) if glossary else None, batchContexts(unmask))
+        else:
+            msg = TR_BUILDERS[fmt](masked, dstLangs[0], srcLang, None, None, 
+                glossary.find(batch, dstLangs[0]) if glossary else None, batchContexts(unmask))
+        outSize = int(sum(sizes[key][1] for key in batch))
+        inTokens += agent.estimateRequest(msg)[0]
+        outTokens += outSize
+        latencies.append(PLAN_LATENCY + outSize / PLAN_OUTPUT_SPEED)
+
+    requests = len(batches)
+    endpoints = len(agent.endpoints)
+    rpm = agent.rpm
+    tpm = sum(limiter.tpm for limiter in agent.limiters.values())
+    tpd = sum(limiter.tpd for limiter in agent.limiters.values())
+    total = inTokens + outTokens
+    rateTime = max((requests - 1) * 60 / rpm, (max(0, total - tpm) * 60 / tpm) if tpm else 0)
+    concurrency = min(max(1, workers), requests)
+    avgLatency = sum(latencies) / len(latencies) if latencies else 0
+    wallTime = max(rateTime + avgLatency, sum(latencies) / concurrency, max(latencies, default=0))
+    days = int(total // tpd) if tpd else 0 #超出每天的token限制，需要等待第二天
+    wallTime += days * ai_providers.RateLimiter.DAY
+    return {'model': str(agent), 'format': fmt if len(dstLangs) == 1 else f'json x{len(dstLangs)}', 
+        'requests': requests, 'input': inTokens, 'output': outTokens, 'endpoints': endpoints, 'rpm': int(rpm), 
+        'tpm': int(tpm), 'time': wallTime, 'days': days, 
+        'cost': agent.cost(inTokens, outTokens) if agent.price else None}
+
+#将秒数格式化为 1h05m/3m20s/45s
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    elif seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
 
 #分析命令行参数
-def getArg():
+#argv: 为None时使用命令行参数
+def getArg(argv=None):
+    return createArgParser().parse_args(argv)
+
+#翻译命令的参数解析器，服务模式下也用来检查任务的参数
+def createArgParser():
     parser = argparse.ArgumentParser()
-    parser.add_argument("file", help="Specify the po file for translation")
-    parser.add_argument("-d", "--dest", metavar="LANG", help="Specify the target language", required=True)
-    parser.add_argument("-o", "--output", metavar="FILE", help="Output to another file")
+    parser.add_argument("file", help="Specify the po file for translation, use {lang} in the path for multiple languages")
+    parser.add_argument("-t", "--tree", action="store_true", 
+        help="Treat file as a locale directory and translate all <lang>/LC_MESSAGES/*.po in it")
+    parser.add_argument("-d", "--dest", metavar="LANG", required=True, 
+        help="Specify the target language, separate multiple languages with commas")
+    parser.add_argument("-o", "--output", metavar="FILE", help="Output to another file, {lang} is supported")
     parser.add_argument("-s", "--src", metavar="LANG", help="Specify the source language")
-    parser.add_argument("-r", "--refpo", metavar="FILE", help="Specify a reference po file")
-    parser.add_argument("-R", "--reflang", metavar="LANG", help="Specify the reference language")
+    parser.add_argument("-r", "--refpo", metavar="FILE", action="append", 
+        help="Specify a reference po file, can be used multiple times")
+    parser.add_argument("-R", "--reflang", metavar="LANG", action="append", 
+        help="Specify the reference language of each --refpo, or one language for all of them")
+    parser.add_argument("--ref-index", metavar="FILE", default=COMPENDIUM_DB, 
+        help="SQLite index of the reference po files, only changed files are parsed again (default: %(default)s)")
+    parser.add_argument("-g", "--glossary", metavar="FILE", 
+        help="CSV/TSV glossary (first column source terms, one column per target language) to keep terms consistent")
     parser.add_argument("-c", "--config", metavar="FILE", help="Specify a configuration file")
-    return parser.parse_args()
+    parser.add_argument("-w", "--workers", metavar="NUM", type=int, default=1, 
+        help="Number of concurrent requests (default: 1)")
+    parser.add_argument("--resume", action="store_true", 
+        help="Resume an interrupted translation from the journal file next to the output file")
+    parser.add_argument("--stream", action="store_true", 
+        help="Use streaming responses and apply each translation as soon as it arrives")
+    parser.add_argument("--async", dest="async_io", action="store_true", 
+        help="Send requests from an asyncio event loop with pooled keep-alive connections")
+    parser.add_argument("-f", "--format", choices=['auto', 'json', 'id', 'placeholder'], default='auto',
+        help="Request format, auto picks the one with the best success rate for the model (default: auto)")
+    parser.add_argument("--format-stats", metavar="FILE", default=FORMAT_STATS_JSON, 
+        help="File recording the success rate of each request format per model (default: %(default)s)")
+    parser.add_argument("--bulk", action="store_true", 
+        help="Submit all batches as one provider batch job (openai/anthropic), cheaper but not interactive")
+    parser.add_argument("--no-wait", action="store_true", 
+        help="With --bulk, submit or check the job once and exit, run again later to apply the results")
+    parser.add_argument("--large", action="store_true", 
+        help="Stream the po files instead of loading them whole, for very large catalogs")
+    parser.add_argument("--server", metavar="ADDR", 
+        help="Submit the job to a running 'autopo.py serve' (host:port or unix:/path) instead of translating here")
+    parser.add_argument("--priority", metavar="NUM", type=int, default=0, 
+        help="With --server, jobs with a higher priority run first (default: 0)")
+    parser.add_argument("--max-cost", metavar="USD", type=float, default=0, 
+        help="Stop cleanly before the estimated spend exceeds USD, translated entries are saved (default: unlimited)")
+    parser.add_argument("--max-tokens", metavar="NUM", type=int, default=0, 
+        help="Stop cleanly before the number of used tokens exceeds NUM (default: unlimited)")
+    parser.add_argument("--metrics", metavar="FILE", 
+        help="Append a JSON-lines event for every AI request, retry and batch to FILE")
+    parser.add_argument("--metrics-prom", metavar="FILE", 
+        help="Write a Prometheus text-format summary of the requests and batches to FILE at the end")
+    parser.add_argument("--tm", metavar="FILE", help="Use a SQLite translation memory file")
+    parser.add_argument("--tm-reviewed-only", action="store_true", 
+        help="Only reuse human-reviewed (non-fuzzy) translations from the translation memory")
+    parser.add_argument("--tm-max-entries", metavar="NUM", type=int, default=0, 
+        help="Maximum number of entries kept in the translation memory (default: unlimited)")
+    parser.add_argument("--tm-max-age", metavar="DAYS", type=int, default=0, 
+        help="Remove translation memory entries unused for DAYS days (default: never)")
+    return parser
+
+#服务模式下客户端提交的参数字典转换为任务参数，参数值不经过argparse解析，避免被当作命令行选项
+#只接受命令行中存在的选项(server/priority/help除外)，参数值按照选项的类型检查，为None时使用默认值
+#返回 (args, error)，参数不正确时args为None
+def jobArgs(params):
+    parser = createArgParser()
+    args = parser.parse_args(['file', '-d', 'lang'])
+    actions = {action.dest: action for action in parser._actions
+        if action.dest not in ('help', 'server', 'priority')}
+    for name, value in params.items():
+        action = actions.get(name)
+        if not action:
+            return None, f'Unknown parameter: {name}'
+        elif value is None:
+            continue
+        elif action.nargs == 0: #store_true
+            valid = isinstance(value, bool)
+        elif isinstance(action, argparse._AppendAction):
+            valid = isinstance(value, list) and all(isinstance(e, str) for e in value)
+        elif action.type in (int, float):
+            valid = isinstance(value, int if action.type is int else (int, float)) and not isinstance(value, bool)
+            value = action.type(value) if valid else value
+        else:
+            valid = isinstance(value, str)
+        if not valid or (action.choices and value not in action.choices):
+            return None, f'Invalid value for {name}: {value!r}'
+        setattr(args, name, value)
+    if not (isinstance(params.get('file'), str) and isinstance(params.get('dest'), str)):
+        return None, 'file and dest are required'
+    return args, ''
+
+def getServeArg(argv):
+    parser = argparse.ArgumentParser(prog='autopo.py serve', 
+        description='Run as a translation service sharing AI connections and rate limits across jobs')
+    parser.add_argument("-l", "--listen", metavar="ADDR", default=DEFAULT_ADDRESS, 
+        help=f"Listen address, host:port or unix:/path/to/socket (default: {DEFAULT_ADDRESS})")
+    parser.add_argument("-c", "--config", metavar="FILE", help="Default configuration file for jobs without one")
+    parser.add_argument("-j", "--jobs", metavar="NUM", type=int, default=2, 
+        help="Number of jobs running at the same time (default: 2)")
+    return parser.parse_args(argv)
+
+def getPlanArg(argv):
+    parser = argparse.ArgumentParser(prog='autopo.py plan', 
+        description='Estimate requests, tokens, time and cost of a translation for each provider/model, offline')
+    parser.add_argument("file", help="Specify the po file, use {lang} in the path for multiple languages")
+    parser.add_argument("-t", "--tree", action="store_true", 
+        help="Treat file as a locale directory and plan all <lang>/LC_MESSAGES/*.po in it")
+    parser.add_argument("-d", "--dest", metavar="LANG", required=True, 
+        help="Specify the target language, separate multiple languages with commas")
+    parser.add_argument("-s", "--src", metavar="LANG", help="Specify the source language")
+    parser.add_argument("-c", "--config", metavar="FILE", 
+        help="Configuration file, its provider uses the configured hosts and keys")
+    parser.add_argument("-p", "--provider", metavar="NAME", 
+        help="Only plan these providers, separated by commas (default: all)")
+    parser.add_argument("-k", "--keys", metavar="NUM", type=int, default=1, 
+        help="Number of api keys assumed for providers not in the configuration file (default: 1)")
+    parser.add_argument("-w", "--workers", metavar="NUM", type=int, default=1, 
+        help="Number of concurrent requests (default: 1)")
+    parser.add_argument("-f", "--format", choices=['auto', 'json', 'id', 'placeholder'], default='auto',
+        help="Request format, auto picks the one with the best success rate for the model (default: auto)")
+    parser.add_argument("--format-stats", metavar="FILE", default=FORMAT_STATS_JSON, 
+        help="File recording the success rate of each request format per model (default: %(default)s)")
+    parser.add_argument("-g", "--glossary", metavar="FILE", help="Glossary file, its terms are added to requests")
+    parser.add_argument("--tm", metavar="FILE", help="Entries found in this translation memory are not sent")
+    parser.add_argument("--tm-reviewed-only", action="store_true", 
+        help="Only count human-reviewed (non-fuzzy) translations from the translation memory")
+    return parser.parse_args(argv)
+
+#将命令行参数中的文件路径转换为绝对路径，服务模式下服务进程的当前目录和客户端不同
+def absArgPaths(args):
+    for name in ('file', 'output', 'config', 'refpo', 'tm', 'format_stats', 'ref_index', 'glossary', 
+        'metrics', 'metrics_prom'):
+        value = getattr(args, name)
+        if isinstance(value, list):
+            setattr(args, name, [os.path.abspath(e) for e in value])
+        elif value:
+            setattr(args, name, os.path.abspath(value))
+    return args
+
+#按照命令行参数(或者服务模式下任务的参数)执行翻译
+#args: getArg() 返回的参数，文件路径为绝对路径
+#agent: SimpleAiProvider实例，服务模式下多个任务共享
+#stats: FormatStats实例
+#返回错误信息，成功返回空字符串
+def runTranslation(args, agent, stats):
+    outFile = args.output
+    refPoFile = args.refpo
+    refLang = args.reflang
+    if bool(refPoFile) != bool(refLang):
+        return 'You have to provide both --refpo and --reflang'
+    elif refLang and (len(refLang) not in (1, len(refPoFile))):
+        return 'You have to provide one --reflang for each --refpo, or only one for all of them'
+
+    dstLangs = [e.strip() for e in args.dest.split(',') if e.strip()]
+    if (len(dstLangs) > 1) and ('{lang}' not in args.file) and not args.tree:
+        return 'You have to use {lang} in the file path for multiple target languages'
+    if args.bulk and (agent.name not in agent.BULK_PROVIDERS):
+        return f'--bulk is only supported by: {", ".join(agent.BULK_PROVIDERS)}'
+
+    glossary = None
+    if args.glossary:
+        try:
+            glossary = Glossary(args.glossary)
+        except Exception as e:
+            return f'Failed to load the glossary {args.glossary}: {e}'
+
+    if args.max_cost and not agent.price:
+        print(f'Warning: no price known for {agent.model}, --max-cost is ignored')
+
+    tm = TranslationMemory(args.tm, maxEntries=args.tm_max_entries, maxAge=args.tm_max_age, 
+        reviewedOnly=args.tm_reviewed_only) if args.tm else None
+    refIndex = Compendium(args.ref_index) if refPoFile else None
+    #每个任务单独计算用量，服务模式下多个任务共享agent但是不共享上限
+    budget = ai_providers.SpendBudget(args.max_cost, args.max_tokens)
+    budgetToken = ai_providers.currentBudget.set(budget)
+    try:
+        metrics = Metrics(args.metrics, args.metrics_prom) if (args.metrics or args.metrics_prom) else None
+    except Exception as e:
+        print(f'Failed to open the metrics file {args.metrics}: {e}')
+        metrics = None
+    metricsToken = ai_providers.currentMetrics.set(metrics)
+    try:
+        if args.tree:
+            translateTree(args.file, agent=agent, dstLangs=dstLangs, srcLang=args.src, refPoFile=refPoFile, 
+                refLang=refLang, workers=args.workers, tm=tm, resume=args.resume, stream=args.stream, 
+                fmt=args.format, stats=stats, bulk=args.bulk, bulkWait=not args.no_wait,
+                large=args.large, refIndex=refIndex, glossary=glossary)
+        elif len(dstLangs) > 1:
+            fileNames = {lang: args.file.replace('{lang}', lang) for lang in dstLangs}
+            outFiles = {lang: outFile.replace('{lang}', lang) for lang in dstLangs} if outFile else None
+            translateFiles(fileNames=fileNames, outFiles=outFiles, agent=agent, srcLang=args.src,
+                refPoFile=refPoFile, refLang=refLang, workers=args.workers, tm=tm, resume=args.resume, 
+                stream=args.stream, fmt=args.format, stats=stats, bulk=args.bulk, bulkWait=not args.no_wait,
+                large=args.large, refIndex=refIndex, glossary=glossary)
+        else:
+            translateFile(fileName=args.file.replace('{lang}', dstLangs[0]), agent=agent, dstLang=dstLangs[0], 
+                outFile=outFile.replace('{lang}', dstLangs[0]) if outFile else None, srcLang=args.src,
+                refPoFile=refPoFile, refLang=refLang, workers=args.workers, tm=tm, resume=args.resume,
+                stream=args.stream, fmt=args.format, stats=stats, bulk=args.bulk, bulkWait=not args.no_wait,
+                large=args.large, refIndex=refIndex, glossary=glossary)
+    finally:
+        ai_providers.currentBudget.reset(budgetToken)
+        ai_providers.currentMetrics.reset(metricsToken)
+        if metrics:
+            metrics.close()
+        if tm:
+            tm.close()
+        if refIndex:
+            refIndex.close()
+    if budget.requests:
+        cost = f', estimated cost ${budget.cost:.4f}' if agent.price else ''
+        print(f'Usage: {budget.requests} requests, {budget.tokens} tokens{cost}')
+    return ''
+
+#服务模式，AI服务实例和统计数据按照文件名缓存，所有任务共享同一个连接和速率限制
+class JobRunner:
+    def __init__(self, cfgFile=None):
+        self.cfgFile = cfgFile
+        self.agents = {}
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    #执行一个任务，params为客户端提交的命令行参数字典，没有提供的参数使用默认值
+    def __call__(self, params):
+        args, error = jobArgs(params)
+        if error:
+            return error
+        args.config = args.config or self.cfgFile
+        args.server = None
+        with self._lock:
+            key = (args.config, args.async_io)
+            if key not in self.agents:
+                agent = createAiAgent(args.config)
+                self.agents[key] = asyncAgent(agent) if args.async_io else agent
+            if args.format_stats not in self.stats:
+                self.stats[args.format_stats] = FormatStats(args.format_stats)
+            agent = self.agents[key]
+            stats = self.stats[args.format_stats]
+        return runTranslation(args, agent, stats)
 
 if __name__ == "__main__":
     print('Use AI services to automatically translate PO files.')
     print(f'Version: v{__Version__}')
 
-    args = getArg()
-    outFile = os.path.abspath(args.output) if args.output else None
-    cfgFile = os.path.abspath(args.config) if args.config else None
-    refPoFile = os.path.abspath(args.refpo) if args.refpo else None
-    refLang = args.reflang
-    if bool(refPoFile) != bool(refLang):
-        print('You have to provide both --refpo and --reflang')
+    if sys.argv[1:2] == ['serve']:
+        args = getServeArg(sys.argv[2:])
+        cfgFile = os.path.abspath(args.config) if args.config else None
+        TranslationServer(JobRunner(cfgFile), args.listen, args.jobs).serveForever()
         sys.exit(0)
 
-    agent = createAiAgent(cfgFile)
-    translateFile(fileName=args.file, outFile=outFile, agent=agent, dstLang=args.dest, srcLang=args.src,
-        refPoFile=refPoFile, refLang=args.reflang)
+    if sys.argv[1:2] == ['plan']:
+        error = planTranslation(getPlanArg(sys.argv[2:]))
+        if error:
+            print(error)
+        sys.exit(1 if error else 0)
+
+    args = absArgPaths(getArg())
+    if args.server:
+        params = {name: value for name, value in vars(args).items() if name not in ('server', 'priority')}
+        state = submitJob(args.server, params, args.priority)
+        sys.exit(0 if state == 'done' else 1)
+
+    agent = createAiAgent(args.config)
+    agent = asyncAgent(agent) if args.async_io else agent
+    try:
+        error = runTranslation(args, agent, FormatStats(args.format_stats))
+    finally:
+        closeAsyncAgent(agent)
+    if error:
+        print(error)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#端到端基准测试，使用本地的模拟AI服务(mock_provider.py)翻译合成的po文件，完全离线运行
+#每个场景报告 每秒翻译条目数/请求数/重试次数/请求延迟的p50和p95，并且和保存的基线比较，找出性能退化
+#用法:
+#  python bench/bench.py                 运行默认场景，和 bench/baseline.json 比较
+#  python bench/bench.py faults stream   只运行指定的场景
+#  python bench/bench.py --all           包括10万条目的大文件场景
+#  python bench/bench.py --save-baseline 将这次的结果保存为基线
+#Author: cdhigh <https://github.com/cdhigh>
+import os, sys, io, json, time, random, shutil, argparse, tempfile, threading, contextlib
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchDir))
+import polib
+import ai_providers, autopo
+from mock_provider import MockProvider
+
+BASELINE_JSON = os.path.join(benchDir, 'baseline.json')
+SEED = 20241017
+KEYS = 16 #每个场景使用的api key数量，AI_LIST中的初始rpm很低，模拟服务返回速率限制响应头后才会提高
+TOLERANCE = 0.25 #每秒翻译条目数低于基线的这个比例，或者请求数高于基线的这个比例，判定为性能退化
+
+#测试场景
+#entries: 合成的po文件的条目数量
+#provider/model: 使用的服务商和模型，模型的上下文和最大输出长度决定了批次大小
+#latency/tokenRate/faults: 模拟服务的延迟分布、输出速度和故障概率，参考 MockProvider
+#dest: 目标语言，多个语种时一次请求同时翻译
+#workers/fmt/stream/large: 和 autopo.py 的命令行参数一致
+#slow: 耗时较长，只有使用 --all 或者指定场景名字时才运行
+SCENARIOS = {
+    'small': {'entries': 100, 'model': 'gpt-4o-mini'},
+    'batches': {'entries': 2000, 'model': 'gpt-3.5-turbo-instruct', 'workers': 4, 'latency': 'lognormal:0.1,0.5'},
+    'faults': {'entries': 2000, 'model': 'gpt-3.5-turbo-instruct', 'workers': 4, 'latency': 'lognormal:0.1,0.5',
+        'faults': {'429': 0.05, 'drop': 0.03, 'malformed': 0.05, 'truncated': 0.05, 'modified': 0.05}},
+    'json': {'entries': 1000, 'model': 'gpt-3.5-turbo-instruct', 'workers': 4, 'fmt': 'json'},
+    'placeholder': {'entries': 1000, 'model': 'gpt-3.5-turbo-instruct', 'workers': 4, 'fmt': 'placeholder'},
+    'stream': {'entries': 1000, 'model': 'gpt-3.5-turbo-instruct', 'workers': 4, 'stream': True,
+        'tokenRate': 2000},
+    'multi': {'entries': 1000, 'model': 'gpt-3.5-turbo', 'workers': 4, 'dest': ['fr', 'de', 'es']},
+    'google': {'entries': 2000, 'provider': 'google', 'model': 'gemini-1.5-flash', 'workers': 4,
+        'latency': 'lognormal:0.2,0.5'},
+    'anthropic': {'entries': 1000, 'provider': 'anthropic', 'model': 'claude-2', 'workers': 4, 'fmt': 'json'},
+    'large': {'entries': 100000, 'model': 'gpt-4o-mini', 'workers': 8, 'large': True, 'latency': 'fixed:0.02',
+        'slow': True},
+}
+
+WORDS = ('file', 'folder', 'book', 'library', 'device', 'settings', 'user', 'account', 'password', 'server',
+    'connection', 'download', 'upload', 'format', 'cover', 'author', 'title', 'series', 'tag', 'publisher',
+    'search', 'result', 'error', 'warning', 'message', 'window', 'dialog', 'button', 'option', 'preference',
+    'open', 'close', 'save', 'delete', 'remove', 'add', 'edit', 'convert', 'send', 'receive', 'select', 'choose',
+    'new', 'old', 'current', 'default', 'custom', 'empty', 'invalid', 'missing', 'selected', 'available',
+    'the', 'a', 'this', 'that', 'your', 'all', 'some', 'no', 'more', 'less', 'to', 'from', 'in', 'on', 'with')
+PLACEHOLDERS = ('%s', '%d', '%(name)s', '%(count)d', '{}', '{0}', '{name}', '{count:d}', '<b>', '</b>')
+
+#生成一个随机的待翻译文本，包括单词、短语、带占位符/标签的句子、多句的段落和带首尾空白的文本
+def randomText(rnd):
+    kind = rnd.random()
+    words = lambda n: ' '.join(rnd.choice(WORDS) for _ in range(n))
+    if kind < 0.15:
+        return rnd.choice(WORDS).capitalize()
+    elif kind < 0.45:
+        return words(rnd.randint(2, 5)).capitalize()
+    elif kind < 0.75:
+        text = words(rnd.randint(4, 12)).split()
+        text.insert(rnd.randint(0, len(text)), rnd.choice(PLACEHOLDERS[:8]))
+        if rnd.random() < 0.3:
+            start = rnd.randint(0, len(text) - 1)
+            text[start] = f'<b>{text[start]}</b>'
+        return ' '.join(text).capitalize() + rnd.choice(('.', ':', '?', '!', ''))
+    elif kind < 0.95:
+        return ' '.join(words(rnd.randint(6, 16)).capitalize() + '.' for _ in range(rnd.randint(2, 5)))
+    return rnd.choice(('  ', '\n', ' ')) + words(rnd.randint(2, 4)) + rnd.choice((' ', ':\n', '  '))
+
+#生成一个包含num个未翻译条目的po文件，约2%的条目和前面的条目msgid相同但是msgctxt不同
+def makeCatalog(fileName, num, seed=SEED):
+    rnd = random.Random(seed + num)
+    seen = set()
+    lines = ['msgid ""', 'msgstr ""', '"Content-Type: text/plain; charset=UTF-8\\n"', '']
+    recent = []
+    while len(seen) < num:
+        if recent and (rnd.random() < 0.02):
+            msgid, msgctxt = rnd.choice(recent), f'context{len(seen)}'
+        else:
+            msgid, msgctxt = randomText(rnd), None
+        if (msgid, msgctxt) in seen:
+            continue
+        seen.add((msgid, msgctxt))
+        recent = (recent + [msgid])[-100:]
+        lines.append(f'#: src/module{len(seen) % 97}.py:{len(seen)}')
+        if msgctxt:
+            lines.append(f'msgctxt "{polib.escape(msgctxt)}"')
+        lines.extend([f'msgid "{polib.escape(msgid)}"', 'msgstr ""', ''])
+    with open(fileName, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+
+#记录每次chat请求的延迟和失败次数，其他属性转发给实际的agent
+class MeasuredAgent:
+    def __init__(self, agent):
+        self.agent = agent
+        self.latencies = []
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.agent, name)
+
+    def __repr__(self):
+        return repr(self.agent)
+
+    def chat(self, message, onText=None):
+        start = time.monotonic()
+        try:
+            ret = self.agent.chat(message, onText)
+        except Exception:
+            with self._lock:
+                self.calls += 1
+                self.errors += 1
+            raise
+        with self._lock:
+            self.calls += 1
+            self.latencies.append(time.monotonic() - start)
+        return ret
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] if samples else 0
+
+#运行一个场景，返回结果字典
+def runScenario(name, spec, workDir, verbose=False):
+    dstLangs = spec.get('dest', ['fr'])
+    fileNames = {}
+    for lang in dstLangs:
+        fileNames[lang] = os.path.join(workDir, f'{name}-{lang}.po')
+        makeCatalog(fileNames[lang], spec['entries'])
+
+    mock = MockProvider(latency=spec.get('latency', 'fixed:0.05'), tokenRate=spec.get('tokenRate', 0),
+        faults=spec.get('faults'), seed=SEED).start()
+    provider = ai_providers.SimpleAiProvider(spec.get('provider', 'openai'),
+        ';'.join(f'bench-key-{idx}' for idx in range(KEYS)), model=spec['model'], apiHost=mock.address)
+    agent = MeasuredAgent(provider)
+    output = sys.stdout if verbose else io.StringIO()
+    start = time.monotonic()
+    try:
+        with contextlib.redirect_stdout(output):
+            autopo.translateFiles(fileNames, agent, workers=spec.get('workers', 1), stream=spec.get('stream', False),
+                fmt=spec.get('fmt', 'id'), large=spec.get('large', False))
+    finally:
+        elapsed = time.monotonic() - start
+        provider.close()
+        mock.stop()
+
+    translated = sum(len(polib.pofile(fileName).translated_entries()) for fileName in fileNames.values())
+    total = spec['entries'] * len(dstLangs)
+    return {'entries': total, 'translated': translated, 'seconds': round(elapsed, 3),
+        'entries_per_sec': round(translated / elapsed, 1), 'requests': mock.stats['requests'],
+        'retries': agent.errors, 'faults': sum(mock.stats[e] for e in mock.faults),
+        'p50': round(percentile(agent.latencies, 50), 3), 'p95': round(percentile(agent.latencies, 95), 3)}
+
+#和基线比较，返回性能退化的描述列表
+def compareBaseline(name, result, baseline, tolerance=TOLERANCE):
+    base = baseline.get(name)
+    if not base:
+        return []
+    problems = []
+    if result['translated'] < base['translated']:
+        problems.append(f"translated {result['translated']} < {base['translated']}")
+    if result['entries_per_sec'] < base['entries_per_sec'] * (1 - tolerance):
+        problems.append(f"entries/s {result['entries_per_sec']} < {base['entries_per_sec']}")
+    if result['requests'] > base['requests'] * (1 + tolerance) + 1:
+        problems.append(f"requests {result['requests']} > {base['requests']}")
+    return problems
+
+def getArg(argv=None):
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark against a local mock AI provider')
+    parser.add_argument("scenarios", nargs='*', metavar="SCENARIO",
+        help=f"Scenarios to run (default: all except slow ones): {', '.join(SCENARIOS)}")
+    parser.add_argument("--all", action="store_true", help="Also run the slow scenarios")
+    parser.add_argument("--baseline", metavar="FILE", default=BASELINE_JSON,
+        help="Baseline results to compare with (default: bench/baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+        help=f"Allowed slowdown before reporting a regression (default: {TOLERANCE})")
+    parser.add_argument("--keep", metavar="DIR", help="Keep the generated po files in DIR")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the output of autopo")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = getArg()
+    unknown = [e for e in args.scenarios if e not in SCENARIOS]
+    if unknown:
+        print(f'Unknown scenarios: {", ".join(unknown)}')
+        sys.exit(2)
+    names = args.scenarios or [name for name, spec in SCENARIOS.items() if args.all or not spec.get('slow')]
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    workDir = args.keep or tempfile.mkdtemp(prefix='autopo-bench-')
+    os.makedirs(workDir, exist_ok=True)
+    results = {}
+    regressions = 0
+    print(f'{"scenario":<12} {"entries":>8} {"transl":>8} {"seconds":>8} {"entries/s":>10} {"requests":>8} '
+        f'{"retries":>7} {"faults":>6} {"p50":>6} {"p95":>6}  vs baseline')
+    try:
+        for name in names:
+            ret = results[name] = runScenario(name, SCENARIOS[name], workDir, args.verbose)
+            base = baseline.get(name)
+            change = f"{(ret['entries_per_sec'] / base['entries_per_sec'] - 1) * 100:+.0f}%" if base else '-'
+            problems = compareBaseline(name, ret, baseline, args.tolerance)
+            regressions += bool(problems)
+            print(f"{name:<12} {ret['entries']:>8} {ret['translated']:>8} {ret['seconds']:>8.2f} "
+                f"{ret['entries_per_sec']:>10.1f} {ret['requests']:>8} {ret['retries']:>7} {ret['faults']:>6} "
+                f"{ret['p50']:>6.2f} {ret['p95']:>6.2f}  {change}" +
+                (f"  REGRESSION: {'; '.join(problems)}" if problems else ''))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({**baseline, **results}, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+    sys.exit(1 if regressions else 0)
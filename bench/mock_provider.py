@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#本地模拟的AI服务，兼容 openai(chat/completions)/google(generateContent)/anthropic(v1/complete) 接口，用于基准测试
+#也支持离线批量任务接口 openai(v1/files + v1/batches) 和 anthropic(v1/messages/batches)，用于测试 --bulk
+#按照请求中的提示词识别 json/id/placeholder/多语种 格式，返回格式正确的"译文"(在原文前加上 [语种] 前缀)
+#可以模拟延迟分布、429、连接中断、无效的json、被截断的响应、被修改的键，所有故障按照概率随机发生
+#单独运行: python bench/mock_provider.py --port 8899 --latency lognormal:0.3,0.5 --rate-429 0.05
+#Author: cdhigh <https://github.com/cdhigh>
+import re, json, time, random, socket, argparse, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+FAULTS = ('429', 'drop', 'malformed', 'truncated', 'modified')
+
+#根据延迟分布的描述创建一个返回延迟秒数的函数
+#spec: fixed:0.1 / uniform:0.05,0.5 / lognormal:中位数,sigma / 0.1
+def parseLatency(spec, rnd=random):
+    kind, _, args = (spec or '0').partition(':')
+    if not args:
+        kind, args = 'fixed', kind
+    values = [float(e) for e in args.split(',')]
+    if kind == 'fixed':
+        return lambda: values[0]
+    elif kind == 'uniform':
+        return lambda: rnd.uniform(values[0], values[1])
+    elif kind == 'lognormal':
+        median, sigma = values[0], (values[1] if len(values) > 1 else 0.5)
+        return lambda: rnd.lognormvariate(0, sigma) * median
+    raise ValueError(f'Unknown latency distribution: {spec}')
+
+#估计token数量，和 ai_providers.estimateTokens() 的量级一致即可
+def countTokens(text):
+    return len(text) // 4 + 1
+
+#模拟的"翻译"，保留首尾空白、占位符和标记，这样译文可以通过 checkTranslation() 的检查
+def fakeTranslate(text, lang):
+    stripped = text.strip()
+    if not stripped:
+        return text
+    start = text.find(stripped)
+    return f'{text[:start]}[{lang}] {stripped}{text[start + len(stripped):]}'
+
+class MockProvider:
+    #latency: 延迟分布，参考 parseLatency()
+    #tokenRate: 每秒输出的token数量，0为不模拟生成时间
+    #faults: 每种故障的概率 {'429': 0.05, 'drop': 0.02, ...}
+    #rpm/tpm: 通过 x-ratelimit-* 响应头告知客户端的速率限制
+    #seed: 随机数种子，相同的种子和相同的请求顺序产生相同的故障
+    #batchPolls: 批量任务提交后，前几次查询状态时返回仍在处理中
+    #batchErrors: 批量任务中每个请求失败的概率，失败的请求不返回结果
+    def __init__(self, host='127.0.0.1', port=0, latency='fixed:0.05', tokenRate=0, faults=None, rpm=100000,
+        tpm=100000000, seed=None, batchPolls=1, batchErrors=0):
+        self.latency = latency
+        self.tokenRate = tokenRate
+        self.faults = {name: (faults or {}).get(name, 0) for name in FAULTS}
+        self.rpm = rpm
+        self.tpm = tpm
+        self.rnd = random.Random(seed)
+        self.sampleLatency = parseLatency(latency, self.rnd)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'ok': 0, **{name: 0 for name in FAULTS}, 'batches': 0, 'batchRequests': 0}
+        self.batchPolls = batchPolls
+        self.batchErrors = batchErrors
+        self.files = {} #{file_id: 文本}，上传的请求文件和生成的结果文件
+        self.batches = {} #{job_id: {'api':, 'requests': [(custom_id, prompt),...], 'polls':, 'output':}}
+        self.httpd = ThreadingHTTPServer((host, port), self._makeHandler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    #在后台线程中运行
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def serveForever(self):
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    #随机选择这个请求的故障，没有故障返回None
+    def _pickFault(self):
+        with self._lock:
+            self.stats['requests'] += 1
+            for name in FAULTS:
+                if self.faults[name] and (self.rnd.random() < self.faults[name]):
+                    self.stats[name] += 1
+                    return name
+            self.stats['ok'] += 1
+            return None
+
+    def _sampleLatency(self):
+        with self._lock:
+            return self.sampleLatency()
+
+    #根据提示词生成回答文本，modify为True时修改其中一个键
+    def answer(self, prompt, modify=False):
+        dst = re.search(r'target language \(([^)]*)\)', prompt)
+        dst = dst.group(1) if dst else 'xx'
+        if 'Text block:' in prompt: #占位符格式
+            text = prompt.split('Text block:\n', 1)[1]
+            text = re.split(r'\n(?:Reference dictionary:|Use these translations for the following terms|'
+                r'Some texts are used in a specific context)', text, 1)[0]
+            items = re.findall(r'({{id_\d+}})\n(.*?)(?=\n\n{{id_\d+}}|\s*$)', text, re.DOTALL)
+            return '\n\n'.join(f'{hld}\n{fakeTranslate(item, dst)}' for hld, item in items)
+
+        pos = prompt.find('JSON dictionary:\n')
+        dic, _ = json.JSONDecoder().raw_decode(prompt[pos + len('JSON dictionary:\n'):].lstrip())
+        codes = re.search(r'map each language code \(([^)]*)\)', prompt)
+        if codes: #多语种格式
+            codes = [e.strip() for e in codes.group(1).split(',')]
+            ret = {key: {code: fakeTranslate(key, code) for code in codes} for key in dic}
+        elif 'numeric ids' in prompt:
+            ret = {idx: fakeTranslate(text, dst) for idx, text in dic.items()}
+        else:
+            ret = {key: fakeTranslate(key, dst) for key in dic}
+        if modify and ret: #修改一个键，id格式使用一个不存在的编号
+            key = self.rnd.choice(sorted(ret))
+            newKey = f'{int(key) + 100000}' if key.isdigit() else (key.rstrip() + ' !')
+            ret[newKey] = ret.pop(key)
+        return json.dumps(ret, ensure_ascii=False)
+
+    #创建一个批量任务，requests: [(custom_id, prompt),...]，返回任务id
+    def createBatch(self, api, requests):
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['batchRequests'] += len(requests)
+            jobId = f'{"batch" if api == "openai" else "msgbatch"}_{len(self.batches) + 1}'
+            self.batches[jobId] = {'api': api, 'requests': requests, 'polls': 0, 'output': None}
+        return jobId
+
+    #查询一次批量任务的状态，前 batchPolls 次返回False，之后生成结果并返回True，任务不存在时返回None
+    def pollBatch(self, jobId):
+        with self._lock:
+            job = self.batches.get(jobId)
+            if job is None:
+                return None
+            job['polls'] += 1
+            if job['polls'] <= self.batchPolls:
+                return False
+            if job['output'] is None:
+                job['output'] = f'file-out-{jobId}'
+                self.files[job['output']] = '\n'.join(json.dumps(self._batchResult(job['api'], cid, prompt), 
+                    ensure_ascii=False) for cid, prompt in job['requests'])
+            return True
+
+    #批量任务中一个请求的结果行，在持有锁的时候调用
+    def _batchResult(self, api, cid, prompt):
+        try:
+            text = None if (self.batchErrors and (self.rnd.random() < self.batchErrors)) else self.answer(prompt)
+        except (ValueError, IndexError):
+            text = None
+        if api == 'openai':
+            if text is None:
+                return {'custom_id': cid, 'response': {'status_code': 500, 'body': {'error': {'message': 'mock'}}}}
+            return {'custom_id': cid, 'response': {'status_code': 200, 'body': {'choices': [{'message': 
+                {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}]}}}
+        if text is None:
+            return {'custom_id': cid, 'result': {'type': 'errored', 'error': {'type': 'api_error'}}}
+        return {'custom_id': cid, 'result': {'type': 'succeeded', 'message': {'content': [{'type': 'text', 
+            'text': text}], 'stop_reason': 'end_turn'}}}
+
+    def _makeHandler(self):
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def sendJson(self, data, status=200, headers=None):
+                body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def limitHeaders(self):
+                return {'x-ratelimit-limit-requests': str(server.rpm),
+                    'x-ratelimit-remaining-requests': str(server.rpm - 1), 'x-ratelimit-reset-requests': '60s',
+                    'x-ratelimit-limit-tokens': str(server.tpm),
+                    'x-ratelimit-remaining-tokens': str(server.tpm - 1), 'x-ratelimit-reset-tokens': '60s'}
+
+            def sendText(self, text, status=200):
+                body = text.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/jsonl')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                if path == '/stats':
+                    with server._lock:
+                        return self.sendJson(dict(server.stats))
+                elif match := re.fullmatch(r'/v1/batches/([^/]+)', path):
+                    ended = server.pollBatch(match.group(1))
+                    if ended is None:
+                        return self.sendJson({'error': {'message': 'No such batch'}}, 404)
+                    data = {'id': match.group(1), 'object': 'batch', 'status': 'completed' if ended else 'in_progress'}
+                    if ended:
+                        data['output_file_id'] = server.batches[match.group(1)]['output']
+                    return self.sendJson(data)
+                elif match := re.fullmatch(r'/v1/files/([^/]+)/content', path):
+                    if match.group(1) not in server.files:
+                        return self.sendJson({'error': {'message': 'No such file'}}, 404)
+                    return self.sendText(server.files[match.group(1)])
+                elif match := re.fullmatch(r'/v1/messages/batches/([^/]+)', path):
+                    ended = server.pollBatch(match.group(1))
+                    if ended is None:
+                        return self.sendJson({'error': {'message': 'No such batch'}}, 404)
+                    return self.sendJson({'id': match.group(1), 'type': 'message_batch', 
+                        'processing_status': 'ended' if ended else 'in_progress'})
+                elif match := re.fullmatch(r'/v1/messages/batches/([^/]+)/results', path):
+                    job = server.batches.get(match.group(1))
+                    if not (job and job['output']):
+                        return self.sendJson({'error': {'message': 'Batch has not ended'}}, 404)
+                    return self.sendText(server.files[job['output']])
+                self.sendJson({'error': 'not found'}, 404)
+
+            #openai上传批量任务的jsonl文件，multipart/form-data格式
+            def uploadFile(self, raw):
+                boundary = self.headers.get('Content-Type', '').partition('boundary=')[2].strip('"')
+                for part in raw.split(b'--' + boundary.encode('utf-8')):
+                    head, _, content = part.partition(b'\r\n\r\n')
+                    if b'name="file"' in head:
+                        with server._lock:
+                            fileId = f'file-{len(server.files) + 1}'
+                            server.files[fileId] = content.rstrip(b'\r\n').decode('utf-8')
+                        return self.sendJson({'id': fileId, 'object': 'file', 'purpose': 'batch'})
+                self.sendJson({'error': {'message': 'No file in the upload'}}, 400)
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                path = urlsplit(self.path).path
+                if path == '/v1/files':
+                    return self.uploadFile(raw)
+                body = json.loads(raw or b'{}')
+                if path == '/v1/batches':
+                    content = server.files.get(body.get('input_file_id'))
+                    if content is None:
+                        return self.sendJson({'error': {'message': 'No such file'}}, 400)
+                    items = [json.loads(line) for line in content.splitlines() if line.strip()]
+                    jobId = server.createBatch('openai', [(item['custom_id'], '\n'.join(str(e.get('content', '')) 
+                        for e in item['body'].get('messages', []))) for item in items])
+                    return self.sendJson({'id': jobId, 'object': 'batch', 'status': 'validating', 
+                        'input_file_id': body['input_file_id']})
+                elif path == '/v1/messages/batches':
+                    jobId = server.createBatch('anthropic', [(item['custom_id'], '\n'.join([item['params'].get(
+                        'system', '')] + [str(e.get('content', '')) for e in item['params'].get('messages', [])]))
+                        for item in body.get('requests', [])])
+                    return self.sendJson({'id': jobId, 'type': 'message_batch', 'processing_status': 'in_progress'})
+                elif path.endswith('chat/completions'):
+                    api = 'openai'
+                    prompt = '\n'.join(str(e.get('content', '')) for e in body.get('messages', []))
+                elif ':generateContent' in path or ':streamGenerateContent' in path:
+                    api = 'google'
+                    prompt = '\n'.join(p.get('text', '') for c in body.get('contents', []) for p in c.get('parts', []))
+                elif path.endswith('v1/complete'):
+                    api = 'anthropic'
+                    prompt = body.get('prompt', '').rsplit('\n\nAssistant:', 1)[0]
+                else:
+                    return self.sendJson({'error': 'not found'}, 404)
+
+                fault = server._pickFault()
+                latency = server._sampleLatency()
+                if fault == '429':
+                    return self.sendJson({'error': {'message': 'Rate limit reached'}}, 429,
+                        {'retry-after-ms': '50', **self.limitHeaders()})
+                elif fault == 'drop': #不返回任何响应直接断开
+                    time.sleep(latency)
+                    self.close_connection = True
+                    try:
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    return
+
+                try:
+                    text = server.answer(prompt, modify=(fault == 'modified'))
+                except (ValueError, IndexError) as e:
+                    return self.sendJson({'error': {'message': f'Mock cannot parse the prompt: {e}'}}, 400)
+                finish = 'stop'
+                if fault == 'malformed': #去掉一个引号，json无效但是大部分键值对仍然完整
+                    idx = text.find('"', len(text) // 2)
+                    text = (text[:idx] + text[idx + 1:]) if idx > 0 else text[:-1]
+                elif fault == 'truncated':
+                    text = text[:int(len(text) * 0.6)]
+                    finish = 'length'
+                outTokens = countTokens(text)
+                time.sleep(latency + (outTokens / server.tokenRate if server.tokenRate else 0))
+                inTokens = countTokens(prompt)
+                if body.get('stream') or ':streamGenerateContent' in path:
+                    return self.sendStream(api, text, finish, inTokens, outTokens)
+                if api == 'openai':
+                    data = {'choices': [{'message': {'role': 'assistant', 'content': text}, 'finish_reason': finish}],
+                        'usage': {'prompt_tokens': inTokens, 'completion_tokens': outTokens}}
+                elif api == 'google':
+                    data = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'},
+                        'finishReason': 'MAX_TOKENS' if finish == 'length' else 'STOP'}],
+                        'usageMetadata': {'promptTokenCount': inTokens, 'candidatesTokenCount': outTokens}}
+                else:
+                    data = {'completion': text, 'stop_reason': 'max_tokens' if finish == 'length' else 'stop_sequence'}
+                self.sendJson(data, 200, self.limitHeaders())
+
+            #以SSE格式分段发送
+            def sendStream(self, api, text, finish, inTokens, outTokens):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                for name, value in self.limitHeaders().items():
+                    self.send_header(name, value)
+                self.end_headers()
+                chunks = [text[idx:idx + 40] for idx in range(0, len(text), 40)]
+                events = []
+                for idx, chunk in enumerate(chunks):
+                    last = (idx == len(chunks) - 1)
+                    if api == 'openai':
+                        event = {'choices': [{'delta': {'content': chunk}, 'finish_reason': finish if last else None}]}
+                        if last:
+                            event['usage'] = {'prompt_tokens': inTokens, 'completion_tokens': outTokens}
+                    elif api == 'google':
+                        event = {'candidates': [{'content': {'parts': [{'text': chunk}]}}]}
+                        if last:
+                            event['candidates'][0]['finishReason'] = 'MAX_TOKENS' if finish == 'length' else 'STOP'
+                            event['usageMetadata'] = {'promptTokenCount': inTokens, 'candidatesTokenCount': outTokens}
+                    else:
+                        event = {'completion': chunk, 'stop_reason': None}
+                        if last:
+                            event['stop_reason'] = 'max_tokens' if finish == 'length' else 'stop_sequence'
+                    events.append('data: ' + json.dumps(event, ensure_ascii=False) + '\n\n')
+                if api == 'openai':
+                    events.append('data: [DONE]\n\n')
+                try:
+                    for event in events:
+                        data = event.encode('utf-8')
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                    self.wfile.write(b'0\r\n\r\n')
+                except OSError:
+                    pass
+        return Handler
+
+def getArg(argv=None):
+    parser = argparse.ArgumentParser(description='Mock AI provider (openai/google/anthropic) for benchmarks')
+    parser.add_argument("--host", default='127.0.0.1', help="Listen address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8899, help="Listen port (default: 8899)")
+    parser.add_argument("--latency", default='fixed:0.05',
+        help="Latency distribution, fixed:S, uniform:MIN,MAX or lognormal:MEDIAN,SIGMA (default: fixed:0.05)")
+    parser.add_argument("--token-rate", type=float, default=0,
+        help="Output tokens per second added to the latency, 0 to disable (default: 0)")
+    for name in FAULTS:
+        parser.add_argument(f"--rate-{name}", type=float, default=0, metavar="P",
+            help=f"Probability of a {name} fault per request (default: 0)")
+    parser.add_argument("--seed", type=int, help="Random seed")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = getArg()
+    faults = {name: getattr(args, f'rate_{name}') for name in FAULTS}
+    mock = MockProvider(args.host, args.port, args.latency, args.token_rate, faults, seed=args.seed)
+    print(f'Mock provider listening on {mock.address}, latency {args.latency}, faults {faults}')
+    mock.serveForever()
@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#pytest的公共配置，测试可以直接导入 bench/mock_provider.py，使用本地模拟的AI服务
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench'))
+from mock_provider import MockProvider
+
+#在本地随机端口启动的模拟AI服务，测试结束后关闭
+@pytest.fixture
+def mock():
+    provider = MockProvider(latency='fixed:0.01').start()
+    yield provider
+    provider.stop()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#ai_providers.py 的测试，使用 bench/mock_provider.py 模拟的AI服务
+import time, json, asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import polib
+import ai_providers, autopo
+from tr_hedge import HedgedAgent
+from mock_provider import MockProvider
+
+def makeMessage(*texts):
+    return autopo.buildJsonMessage({text: '' for text in texts}, 'fr', 'en')
+
+#AI_LIST中的初始rpm很低，使用多个key，这样并发的请求不需要等待速率限制器
+def makeAgent(mock, keys=16):
+    return ai_providers.SimpleAiProvider('openai', ';'.join(f'sk-test{i}' for i in range(keys)), apiHost=mock.address)
+
+#多个请求在同一个事件循环中并发进行，总时间接近一个请求的延迟
+def testAsyncConcurrency():
+    mock = MockProvider(latency='fixed:0.3').start()
+    agent = makeAgent(mock)
+    async def run():
+        start = time.monotonic()
+        rets = await asyncio.gather(*(agent.achat(makeMessage(f'text {i}')) for i in range(8)))
+        elapsed = time.monotonic() - start
+        await agent.aclose()
+        return rets, elapsed
+    try:
+        rets, elapsed = asyncio.run(run())
+    finally:
+        mock.stop()
+    assert [json.loads(ret) for ret in rets] == [{f'text {i}': f'[French] text {i}'} for i in range(8)]
+    assert elapsed < 1.8 #依次请求需要 2.4 秒
+    assert agent.usage['requests'] == 8
+
+#流式响应分段调用onText，最后返回完整的文本
+def testAsyncStream(mock):
+    agent = makeAgent(mock)
+    chunks = []
+    async def run():
+        ret = await agent.achat(makeMessage(*(f'a longer text number {i}' for i in range(5))), chunks.append)
+        await agent.aclose()
+        return ret
+    ret = asyncio.run(run())
+    assert len(chunks) > 1
+    assert ''.join(chunks) == ret
+    assert ret.finishReason == 'stop'
+    assert len(json.loads(ret)) == 5
+
+#服务器超过 timeout 没有响应时抛出 TimeoutError，超时的连接不会放回连接池
+def testAsyncTimeout():
+    mock = MockProvider(latency='fixed:1').start()
+    agent = makeAgent(mock)
+    agent.timeout = 0.2
+    async def run():
+        try:
+            with pytest.raises(TimeoutError):
+                await agent.achat(makeMessage('Open'))
+            return len(agent.asyncPools[0].idle)
+        finally:
+            await agent.aclose()
+    try:
+        assert asyncio.run(run()) == 0
+    finally:
+        mock.stop()
+
+#aclose() 关闭所有空闲的长连接
+def testAclose(mock):
+    agent = makeAgent(mock)
+    async def run():
+        await agent.achat(makeMessage('Open'))
+        pool = agent.asyncPools[0]
+        assert len(pool.idle) == 1
+        writer = pool.idle[0][1]
+        await agent.aclose()
+        return pool, writer
+    pool, writer = asyncio.run(run())
+    assert agent.asyncPools == {}
+    assert pool.idle == []
+    assert writer.is_closing()
+
+#AsyncBridge: 多个线程通过同一个事件循环发送请求
+def testAsyncBridge(mock):
+    bridge = ai_providers.AsyncBridge(makeAgent(mock))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        rets = list(executor.map(lambda i: bridge.chat(makeMessage(f'text {i}')), range(8)))
+    assert [json.loads(ret) for ret in rets] == [{f'text {i}': f'[French] text {i}'} for i in range(8)]
+    assert bridge.model == bridge.agent.model
+    assert bridge.agent.asyncPools
+    bridge.close()
+    assert bridge.loop.is_closed()
+    assert bridge.agent.asyncPools == {}
+
+#--async: 翻译流程使用 AsyncBridge
+def testTranslateFileAsync(mock, tmp_path):
+    fileName = str(tmp_path / 'messages.po')
+    po = polib.POFile()
+    for i in range(20):
+        po.append(polib.POEntry(msgid=f'text {i}', msgstr=''))
+    po.save(fileName)
+    agent = autopo.asyncAgent(makeAgent(mock))
+    try:
+        autopo.translateFile(fileName, agent, 'fr', fmt='json', workers=4, stream=True)
+    finally:
+        autopo.closeAsyncAgent(agent)
+    assert all(e.msgstr == f'[French] {e.msgid}' for e in polib.pofile(fileName))
+
+#对冲请求和 --async 一起使用时，仍然输出并且保存对冲统计
+def testAsyncHedgeStatsSaved(mock, tmp_path):
+    fileName = str(tmp_path / 'messages.po')
+    po = polib.POFile()
+    po.append(polib.POEntry(msgid='text', msgstr=''))
+    po.save(fileName)
+    statsFile = str(tmp_path / 'hedge_stats.json')
+    agent = autopo.asyncAgent(HedgedAgent([makeAgent(mock), makeAgent(mock)], statsFile=statsFile))
+    try:
+        autopo.translateFile(fileName, agent, 'fr', fmt='json')
+    finally:
+        autopo.closeAsyncAgent(agent)
+    with open(statsFile, encoding='utf-8') as f:
+        assert json.load(f)['openai/gpt-4o-mini']['requests'] >= 1
+
+#每个host和每个key的组合都是一个endpoint，总的初始速率和以前一样为 rpm * max(host数量, key数量)
+def testEndpointCrossProduct():
+    agent = ai_providers.SimpleAiProvider('openai', 'sk-a;sk-b;sk-c', apiHost='relay1.local;relay2.local')
+    pairs = {(ep.hostIdx, ep.key) for ep in agent.endpoints}
+    assert pairs == {(h, k) for h in (0, 1) for k in ('sk-a', 'sk-b', 'sk-c')}
+    assert agent.rpm == agent._rpm * 3
+
+#响应头中的速率限制是针对key的，经过不同host使用同一个key的请求共享这个限制
+def testRateLimitSharedPerKey():
+    agent = ai_providers.SimpleAiProvider('openai', ';'.join(f'sk-{i}' for i in range(6)),
+        apiHost='relay1.local;relay2.local;relay3.local')
+    assert len(agent.endpoints) == 18 and len(agent.limiters) == 6
+    for ep in agent.endpoints:
+        assert ep.limiter is agent.limiters[ep.key]
+        ep.limiter.update(200, {'x-ratelimit-limit-requests': '100', 'x-ratelimit-reset-requests': '1s'})
+    assert agent.rpm == 600
+    #一个host上的429使这个key在所有host上都暂停
+    ep = agent.endpoints[0]
+    ep.limiter.update(429, {'retry-after': '30'})
+    assert all(e.limiter.readyIn() > 20 for e in agent.endpoints if e.key == ep.key)
+    assert all(e.limiter.readyIn() < 20 for e in agent.endpoints if e.key != ep.key)
+
+#一个中转服务器熔断后，所有key仍然可以通过其他服务器使用；一个key失效后，所有服务器仍然可以使用其他key
+@pytest.mark.parametrize('dead, expected', [
+    (lambda ep: ep.hostIdx == 0, {(1, 'sk-a'), (1, 'sk-b')}),
+    (lambda ep: ep.key == 'sk-a', {(0, 'sk-b'), (1, 'sk-b')})])
+def testDeadHostOrKeyIsIsolated(dead, expected):
+    agent = ai_providers.SimpleAiProvider('openai', 'sk-a;sk-b', apiHost='relay1.local;relay2.local')
+    for ep in agent.endpoints:
+        if dead(ep):
+            ep.health._open(60)
+    used = set()
+    for i in range(20):
+        ep, wait = agent._reserveEndpoint()
+        ep.health.cancel()
+        used.add((ep.hostIdx, ep.key))
+    assert used == expected
+
+#每个模型的最大输出明显小于上下文长度，每个批次的输入不会只剩下最低限度
+def testOutputBelowContext():
+    for name, item in ai_providers.AI_LIST.items():
+        for model in item['models']:
+            assert model.get('output', ai_providers.DEFAULT_OUTPUT_SIZE) <= model['context'] * 0.6, model['name']
+    agent = ai_providers.SimpleAiProvider('groq', 'gsk-test', model='llama3-8b-8192')
+    assert autopo.inputLimit(agent) > 4000
+
+#发送的 max_tokens 加上提示词不超过上下文长度
+def testMaxTokensClamped():
+    agent = ai_providers.SimpleAiProvider('groq', 'gsk-test', model='llama3-8b-8192')
+    small = [{'role': 'user', 'content': 'Translate "Open"'}]
+    assert agent._openai_request(small).payload['max_tokens'] == agent.output_size
+    large = [{'role': 'user', 'content': 'Open the file. ' * 1800}]
+    estIn = agent.estimateRequest(large)[0]
+    maxTokens = agent._openai_request(large).payload['max_tokens']
+    assert maxTokens < agent.output_size and estIn + maxTokens <= agent.context_size
+
+#每天的token额度用完时不会没有输出地等待到第二天，而是和超出 --max-cost 一样停止
+def testDailyLimitStops(capsys):
+    agent = ai_providers.SimpleAiProvider('groq', 'gsk-test', model='llama3-8b-8192')
+    limiter = agent.limiters['gsk-test']
+    #服务器告知每天的额度和重置时间，窗口按照服务器的重置时间计算
+    limiter.update(200, {'x-ratelimit-limit-tokens': '100000', 'x-ratelimit-remaining-tokens': '500',
+        'x-ratelimit-reset-tokens': '2h'})
+    assert limiter.tpd == 100000 and limiter.dayUsed == 99500
+    assert 7100 < limiter.dayStart + limiter.DAY - time.monotonic() <= 7200
+    start = time.monotonic()
+    with pytest.raises(ai_providers.RateLimitExceeded):
+        agent.acquireEndpoint(1000)
+    assert time.monotonic() - start < 1
+    assert autopo.translateBatches([{'a': ''}], lambda batch: agent.acquireEndpoint(1000)) == 0
+    assert 'stopping' in capsys.readouterr().out
+
+#较长的等待打印提示
+def testLongWaitNotice(capsys, monkeypatch):
+    monkeypatch.setattr(ai_providers, 'RATE_WAIT_NOTICE', 0.05)
+    agent = ai_providers.SimpleAiProvider('openai', 'sk-test')
+    agent.limiters['sk-test'].rpm = 6000
+    agent.limiters['sk-test'].update(429, {'retry-after-ms': '100'})
+    agent.acquireEndpoint()
+    assert 'waiting' in capsys.readouterr().out
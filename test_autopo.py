@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#autopo.py 的测试，翻译批次的调度和失败恢复
+import re, json, time, threading
+import polib
+import autopo
+
+#一个批次没有翻译任何条目时，其他批次仍然继续翻译
+def testEmptyBatchDoesNotStopOthers():
+    batches = [{f'text {i}': ''} for i in range(6)]
+    done = []
+    def translator(batch):
+        done.append(batch)
+        return 0 if 'text 1' in batch else 1
+    assert autopo.translateBatches(batches, translator, workers=1) == 5
+    assert len(done) == 6
+
+#服务不可用时取消尚未开始的批次
+def testServiceFailureCancelsRemaining():
+    batches = [{f'text {i}': ''} for i in range(6)]
+    done = []
+    def translator(batch):
+        done.append(batch)
+        if 'text 0' in batch:
+            return None
+        time.sleep(0.1) #主线程在这段时间内取消排队中的批次
+        return 1
+    assert autopo.translateBatches(batches, translator, workers=1) <= 1
+    assert len(done) <= 2
+
+#每个批次完成后都调用checkpoint，包括没有翻译任何条目的批次
+def testCheckpointAfterEachBatch():
+    calls = []
+    autopo.translateBatches([{'a': ''}, {'b': ''}], lambda batch: 0, checkpoint=lambda: calls.append(1))
+    assert len(calls) == 2
+
+#translateWithRecovery: 一个总是失败的条目不影响同一个批次中的其他条目
+def testRecoveryIsolatesBadEntry():
+    batch = {f'text {i}': '' for i in range(8)}
+    lock = threading.Lock()
+    translated = set()
+    def translateOnce(batch):
+        if 'text 5' in batch: #整个批次都没有结果
+            return 0, list(batch)
+        with lock:
+            translated.update(batch)
+        return len(batch), []
+    assert autopo.translateWithRecovery(batch, translateOnce) == 7
+    assert translated == set(batch) - {'text 5'}
+
+#translateWithRecovery: 单个失败的条目再重试一次，仍然失败时放弃，不影响其他条目
+def testRecoveryRetriesSingleEntryOnce():
+    batch = {f'text {i}': '' for i in range(41)}
+    attempts = []
+    def translateOnce(batch):
+        if 'text 7' in batch:
+            if len(batch) == 1:
+                attempts.append(1)
+            return 0, list(batch)
+        return len(batch), []
+    assert autopo.translateWithRecovery(batch, translateOnce) == 40
+    assert len(attempts) == 2
+
+#translateWithRecovery: 偶然失败的条目重试后成功
+def testRecoveryFlakyEntry():
+    attempts = []
+    def translateOnce(batch):
+        attempts.append(1)
+        return (0, list(batch)) if len(attempts) == 1 else (1, [])
+    assert autopo.translateWithRecovery({'text': ''}, translateOnce) == 1
+    assert len(attempts) == 2
+
+#translateWithRecovery: 请求本身失败时返回None，由调用者停止后续批次
+def testRecoveryServiceFailure():
+    assert autopo.translateWithRecovery({'a': '', 'b': ''}, lambda batch: (None, list(batch))) is None
+
+def testAddCounts():
+    assert autopo.addCounts(2, 3) == 5
+    assert autopo.addCounts(0, None) is None
+    assert autopo.addCounts(None, 0) is None
+    assert autopo.addCounts(0, 0) == 0
+    assert autopo.addCounts(None, 4) == 4
+
+#返回的"译文"包括提示词中这个文本的上下文，用于检查上下文是否发送给了AI
+class ContextEchoAgent:
+    model = 'echo'
+    name = 'echo'
+    host = 'localhost'
+    context_size = 8000
+    output_size = 2000
+    endpoints = []
+    def __init__(self):
+        self.prompts = []
+    def __str__(self):
+        return 'ContextEchoAgent'
+    def chat(self, message, onText=None):
+        prompt = message[1]['content']
+        self.prompts.append(prompt)
+        pos = prompt.find('JSON dictionary:\n') + len('JSON dictionary:\n')
+        dic, _ = json.JSONDecoder().raw_decode(prompt[pos:])
+        contexts = {json.loads(text): ctxt for text, ctxt in re.findall(r'^- (".*"): (.*)$', prompt, re.M)}
+        return json.dumps({key: f'{key} ({contexts.get(key, "-")})' for key in dic})
+
+def testMsgKey():
+    menu = autopo.MsgKey('Open', 'menu')
+    assert menu != 'Open' and str(menu) == 'Open'
+    assert menu == autopo.MsgKey('Open', 'menu')
+    assert menu != autopo.MsgKey('Open', 'door')
+    assert len({'Open': 1, menu: 2, autopo.MsgKey('Open', 'door'): 3}) == 3
+    assert menu not in {'Open': 1}
+
+#同样的文本在不同的上下文中分到不同的批次，每个批次中的文本不重复
+def testBatchesSplitContexts():
+    toTr = {'Open': '', autopo.MsgKey('Open', 'menu'): '', autopo.MsgKey('Open', 'door'): '', 'Close': ''}
+    batches = autopo.buildBatches(toTr, ContextEchoAgent())
+    assert sorted(len(batch) for batch in batches) == [1, 1, 2]
+    for batch in batches:
+        assert len({str(key) for key in batch}) == len(batch)
+    assert {key for batch in batches for key in batch} == set(toTr)
+
+#msgctxt不同的条目分别翻译，上下文加入到提示词中
+def testTranslateWithContexts(tmp_path):
+    fileName = str(tmp_path / 'messages.po')
+    po = polib.POFile()
+    po.append(polib.POEntry(msgid='Open', msgstr=''))
+    po.append(polib.POEntry(msgid='Open', msgctxt='menu', msgstr=''))
+    po.append(polib.POEntry(msgid='Open', msgctxt='door state', msgstr=''))
+    po.save(fileName)
+    for fmt in ('json', 'id'):
+        agent = ContextEchoAgent()
+        autopo.translateFile(fileName, agent, 'fr', fmt=fmt, outFile=fileName + f'.{fmt}.po')
+        ret = {e.msgctxt or '': e.msgstr for e in polib.pofile(fileName + f'.{fmt}.po')}
+        if fmt == 'json':
+            assert ret == {'': 'Open (-)', 'menu': 'Open (menu)', 'door state': 'Open (door state)'}
+        assert len(agent.prompts) == 3
+        assert any('door state' in prompt for prompt in agent.prompts)
+
+#translateWithRecovery: 每次都部分成功但缺失的条目没有减少时不会无限重试
+def testRecoveryNoProgress():
+    calls = []
+    def translateOnce(batch):
+        calls.append(len(batch))
+        return 1, list(batch)
+    autopo.translateWithRecovery({f'text {i}': '' for i in range(4)}, translateOnce)
+    assert len(calls) <= 16
+
+#同时翻译多个语种时，某个语种总是缺失的条目仅重新请求这个语种，并且重试次数有限
+class MultiAgent(ContextEchoAgent):
+    def chat(self, message, onText=None):
+        prompt = message[1]['content']
+        self.prompts.append(prompt)
+        codes = re.search(r'each language code \((.*?)\) to', prompt).group(1).split(', ')
+        pos = prompt.find('JSON dictionary:\n') + len('JSON dictionary:\n')
+        dic, _ = json.JSONDecoder().raw_decode(prompt[pos:])
+        return json.dumps({key: {code: f'{key} [{code}]' for code in codes if (key, code) != ('Open', 'de')}
+            for key in dic})
+
+def testMultiRetriesMissingLangs():
+    objDics = {lang: {'Open': [polib.POEntry(msgid='Open')], 'Save': [polib.POEntry(msgid='Save')]}
+        for lang in ('fr', 'de')}
+    agent = MultiAgent()
+    cnt = autopo.translateMultiBatch(agent, {'Open': '', 'Save': ''}, 'en', None, objDics)
+    assert cnt == {'fr': 2, 'de': 1}
+    assert 1 < len(agent.prompts) <= 4
+    for prompt in agent.prompts[1:]:
+        assert 'each language code (de) to' in prompt and '"Save"' not in prompt
+
+#占位符格式也发送参考翻译
+def testPlaceholderSendsRefs():
+    msg = autopo.buildPlaceholderMessage({'Open': 'Öffnen', 'Close': ''}, 'fr', 'en', 'de')
+    prompt = msg[1]['content']
+    assert 'German translations' in prompt
+    assert 'Reference dictionary:\n{"id_0":"Öffnen"}' in prompt
+
+#原样返回的短文本(比如 "OK")是有效的翻译，较长的文本原样返回时作为缺失的条目
+class EchoPlaceholderAgent(ContextEchoAgent):
+    def chat(self, message, onText=None):
+        prompt = message[1]['content']
+        text = prompt.split('Text block:\n', 1)[1].split('\n\nReference dictionary:', 1)[0]
+        return text
+
+def testPlaceholderIdentity():
+    dic = {'OK': '', 'URL': '', '42 %': '', 'Open the selected file in a new window': ''}
+    ret = autopo.translateByPlaceholder(EchoPlaceholderAgent(), dic, 'fr', 'en')
+    assert ret == {'OK': 'OK', 'URL': 'URL', '42 %': '42 %'}
+
+#--format placeholder 时参考po文件中的翻译也加入提示词
+class PrefixPlaceholderAgent(ContextEchoAgent):
+    def chat(self, message, onText=None):
+        prompt = message[1]['content']
+        self.prompts.append(prompt)
+        text = prompt.split('Text block:\n', 1)[1].split('\n\nReference dictionary:', 1)[0]
+        return re.sub(r'({{id_\d+}}\n)', r'\1fr: ', text)
+
+def testPlaceholderFileWithRefs(tmp_path):
+    fileName, refFile = str(tmp_path / 'fr.po'), str(tmp_path / 'de.po')
+    for name, msgstr in ((fileName, ''), (refFile, 'Öffnen')):
+        po = polib.POFile()
+        po.append(polib.POEntry(msgid='Open', msgstr=msgstr))
+        po.save(name)
+    agent = PrefixPlaceholderAgent()
+    autopo.translateFile(fileName, agent, 'fr', fmt='placeholder', refPoFile=refFile, refLang='de')
+    assert polib.pofile(fileName)[0].msgstr == 'fr: Open'
+    assert '"Öffnen"' in agent.prompts[0]
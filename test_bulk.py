@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#tr_bulk.py 和 SimpleAiProvider 批量任务接口的测试，使用 bench/mock_provider.py 模拟的 openai/anthropic 批量任务
+import os, json, time
+from types import SimpleNamespace
+import pytest
+import polib
+import ai_providers, autopo, tr_bulk
+from mock_provider import MockProvider
+
+PROVIDERS = ['openai', 'anthropic']
+
+@pytest.fixture
+def bulkMock():
+    provider = MockProvider(latency='fixed:0.01', batchPolls=1).start()
+    yield provider
+    provider.stop()
+
+@pytest.fixture(autouse=True)
+def noPollDelay(monkeypatch):
+    monkeypatch.setattr(tr_bulk, 'BULK_POLL_INTERVAL', 0)
+
+def makeAgent(name, mock):
+    return ai_providers.SimpleAiProvider(name, ';'.join(f'sk-test{i}' for i in range(16)), apiHost=mock.address)
+
+def makePo(fileName, num=30):
+    po = polib.POFile()
+    for i in range(num):
+        po.append(polib.POEntry(msgid=f'text {i}', msgstr=''))
+    po.save(fileName)
+
+def translated(fileName):
+    return {e.msgid: e.msgstr for e in polib.pofile(fileName) if e.msgstr}
+
+#提交、查询状态、获取结果
+@pytest.mark.parametrize('name', PROVIDERS)
+def testSubmitPollResults(name, bulkMock):
+    agent = makeAgent(name, bulkMock)
+    messages = {f'req-{i}': autopo.buildJsonMessage({f'text {i}': ''}, 'fr', 'en') for i in range(3)}
+    jobId = agent.submitBatch(messages)
+    assert jobId in bulkMock.batches
+    assert bulkMock.stats['batchRequests'] == 3
+    assert agent.batchStatus(jobId)[0] == 'running'
+    assert agent.batchStatus(jobId)[0] == 'ended'
+    results = agent.batchResults(jobId)
+    assert {cid: json.loads(text) for cid, text in results.items()} == {
+        f'req-{i}': {f'text {i}': f'[French] text {i}'} for i in range(3)}
+
+#批量任务的结果写入po文件，不发送实时请求，完成后删除状态文件
+@pytest.mark.parametrize('name', PROVIDERS)
+def testApplyResults(name, bulkMock, tmp_path):
+    fileName = str(tmp_path / 'messages.po')
+    makePo(fileName)
+    agent = makeAgent(name, bulkMock)
+    autopo.translateFile(fileName, agent, 'fr', fmt='json', bulk=True)
+    assert translated(fileName) == {f'text {i}': f'[French] text {i}' for i in range(30)}
+    assert bulkMock.stats['batches'] == 1
+    assert agent.usage['requests'] == 0
+    assert not os.path.exists(fileName + '.bulk')
+
+#批量任务中失败的请求使用实时请求重新翻译
+def testErroredResultsFallBack(tmp_path):
+    mock = MockProvider(latency='fixed:0.01', batchPolls=0, batchErrors=1.0).start()
+    try:
+        fileName = str(tmp_path / 'messages.po')
+        makePo(fileName, 5)
+        agent = makeAgent('openai', mock)
+        autopo.translateFile(fileName, agent, 'fr', fmt='json', bulk=True)
+    finally:
+        mock.stop()
+    assert len(translated(fileName)) == 5
+    assert agent.usage['requests'] >= 1
+
+#不等待任务完成时仅提交，下次运行继续同一个任务，不会重新提交
+@pytest.mark.parametrize('name', PROVIDERS)
+def testResumeWithoutWait(name, bulkMock, tmp_path):
+    fileName = str(tmp_path / 'messages.po')
+    makePo(fileName)
+    autopo.translateFile(fileName, makeAgent(name, bulkMock), 'fr', fmt='json', bulk=True, bulkWait=False)
+    assert not translated(fileName)
+    jobId = tr_bulk.loadState(fileName + '.bulk')['job']
+
+    autopo.translateFile(fileName, makeAgent(name, bulkMock), 'fr', fmt='json', bulk=True, bulkWait=False)
+    assert len(translated(fileName)) == 30
+    assert list(bulkMock.batches) == [jobId]
+    assert bulkMock.stats['batches'] == 1
+
+#等待任务完成的过程中被中断，重新运行时继续同一个任务
+@pytest.mark.parametrize('name', PROVIDERS)
+def testResumeAfterInterrupt(name, tmp_path, monkeypatch):
+    mock = MockProvider(latency='fixed:0.01', batchPolls=3).start()
+    try:
+        fileName = str(tmp_path / 'messages.po')
+        makePo(fileName)
+        def interrupt(seconds):
+            raise KeyboardInterrupt()
+        monkeypatch.setattr(tr_bulk, 'time', SimpleNamespace(time=time.time, sleep=interrupt))
+        with pytest.raises(KeyboardInterrupt):
+            autopo.translateFile(fileName, makeAgent(name, mock), 'fr', fmt='json', bulk=True)
+        assert tr_bulk.loadState(fileName + '.bulk')
+        monkeypatch.undo()
+        monkeypatch.setattr(tr_bulk, 'BULK_POLL_INTERVAL', 0)
+
+        autopo.translateFile(fileName, makeAgent(name, mock), 'fr', fmt='json', bulk=True)
+    finally:
+        mock.stop()
+    assert len(translated(fileName)) == 30
+    assert mock.stats['batches'] == 1
+    assert not os.path.exists(fileName + '.bulk')
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#tr_catalog.py 的测试，StreamCatalog 读写的结果和polib一致
+import polib
+import pytest
+from tr_catalog import StreamCatalog
+
+LONG_TEXT = ('This is a rather long sentence that does not fit on one line of the po file, so it has to be '
+    'wrapped over several lines exactly the way polib does it')
+
+#用polib生成原文件，包括各种条目
+#plural: 是否包括没有翻译的复数条目，StreamCatalog不翻译这些条目，保持原样
+def makeSource(fileName, plural=True):
+    po = polib.POFile(wrapwidth=78)
+    po.metadata = {'Project-Id-Version': 'test', 'Content-Type': 'text/plain; charset=UTF-8'}
+    po.append(polib.POEntry(msgid='Open', msgstr='Ouvrir', occurrences=[('main.py', '10')], comment='menu item'))
+    po.append(polib.POEntry(msgid='%(count)s files', msgstr='', flags=['python-format'],
+        occurrences=[('main.py', '12'), ('util.py', '3')]))
+    po.append(polib.POEntry(msgid='Save as', msgstr='Enregistrer', flags=['fuzzy'], previous_msgid='Save',
+        previous_msgctxt='menu', tcomment='translator note'))
+    po.append(polib.POEntry(msgid='Save', msgstr='Sauver', flags=['fuzzy', 'c-format']))
+    po.append(polib.POEntry(msgid='Open', msgctxt='door state', msgstr=''))
+    if plural:
+        po.append(polib.POEntry(msgid='One file', msgid_plural='%d files', msgstr_plural={0: '', 1: ''}))
+    po.append(polib.POEntry(msgid='One dir', msgid_plural='%d dirs', msgstr_plural={0: 'Un dossier', 1: '%d dossiers'}))
+    po.append(polib.POEntry(msgid=LONG_TEXT, msgstr=''))
+    po.append(polib.POEntry(msgid='Line one\nLine two', msgstr=''))
+    po.append(polib.POEntry(msgid='Tab\there "quoted" \\ text', msgstr=''))
+    po.append(polib.POEntry(msgid='Removed', msgstr='Supprimé', obsolete=True))
+    po.append(polib.POEntry(msgid='Removed fuzzy', msgstr='Supprimé', obsolete=True, flags=['fuzzy'],
+        previous_msgid='Removed'))
+    po.save(fileName)
+
+#翻译结果 {msgid: (msgstr, fuzzy)}
+TRANSLATIONS = {
+    '%(count)s files': ('%(count)s fichiers', False),
+    'Save as': ('Enregistrer sous', False),
+    'Save': ('Sauver', True),
+    'Open': ('Ouvert', True),
+    LONG_TEXT: ('Ceci est une phrase assez longue qui ne tient pas sur une ligne du fichier po, elle doit donc '
+        'être coupée sur plusieurs lignes exactement comme le fait polib', False),
+    'Line one\nLine two': ('Ligne un\nLigne deux', False),
+    'Tab\there "quoted" \\ text': ('Tab\tici "cité" \\ texte', False),
+}
+
+#和 translateFile() 一样修改需要翻译的条目，polib保存前删除过时的条目
+def translate(entries):
+    for entry in entries:
+        if entry.msgid in TRANSLATIONS and not entry.msgid_plural:
+            entry.msgstr, entry.fuzzy = TRANSLATIONS[entry.msgid]
+
+def readText(fileName):
+    with open(fileName, 'r', encoding='utf-8') as f:
+        return f.read()
+
+@pytest.mark.parametrize('modify', [False, True])
+def testRoundTripMatchesPolib(tmp_path, modify):
+    source = str(tmp_path / 'source.po')
+    makeSource(source)
+
+    po = polib.pofile(source)
+    catalog = StreamCatalog(source)
+    assert catalog.total == len([e for e in po if not e.obsolete])
+    assert catalog.percent_translated() == po.percent_translated()
+    assert ({(e.msgctxt, e.msgid) for e in catalog.untranslated_entries()} ==
+        {(e.msgctxt, e.msgid) for e in po.untranslated_entries() if not e.msgid_plural})
+    assert ({(e.msgctxt, e.msgid) for e in catalog.fuzzy_entries()} ==
+        {(e.msgctxt, e.msgid) for e in po.fuzzy_entries()})
+    assert ({(e.msgctxt, e.msgid) for e in catalog.translated_entries()} ==
+        {(e.msgctxt, e.msgid) for e in po.translated_entries()})
+
+    if modify:
+        translate(po.untranslated_entries() + po.fuzzy_entries())
+        translate(catalog.untranslated_entries() + catalog.fuzzy_entries())
+    po[:] = [e for e in po if not e.obsolete]
+    po.save(str(tmp_path / 'polib.po'))
+    catalog.save(str(tmp_path / 'stream.po'))
+    assert readText(tmp_path / 'stream.po') == readText(tmp_path / 'polib.po')
+    assert catalog.percent_translated() == po.percent_translated()
+
+    #保存后的文件再次读取，结果仍然一致
+    saved = polib.pofile(str(tmp_path / 'stream.po'))
+    assert [(e.msgctxt, e.msgid, e.msgstr, e.msgstr_plural, e.flags, e.previous_msgid) for e in saved] == \
+        [(e.msgctxt, e.msgid, e.msgstr, e.msgstr_plural, e.flags, e.previous_msgid) for e in po]
+
+#--large 和默认的polib读写翻译同一个文件，输出相同
+@pytest.mark.parametrize('fuzzify', [False, True])
+def testLargeMatchesPolib(tmp_path, fuzzify):
+    import autopo
+    from test_autopo import ContextEchoAgent
+    source = str(tmp_path / 'source.po')
+    makeSource(source, plural=False)
+    for large in (False, True):
+        autopo.translateFile(source, ContextEchoAgent(), 'fr', fmt='json', fuzzify=fuzzify, large=large,
+            outFile=str(tmp_path / f'large-{large}.po'))
+    assert readText(tmp_path / 'large-True.po') == readText(tmp_path / 'large-False.po')
+    assert 'Open (door state)' in readText(tmp_path / 'large-True.po')
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#tr_compendium.py 的测试
+import polib
+from tr_compendium import Compendium
+
+#索引文件所在的目录不存在时自动创建，参考文件没有变化时不重新导入
+def testIndexInNewDir(tmp_path):
+    refFile = str(tmp_path / 'de.po')
+    po = polib.POFile()
+    po.append(polib.POEntry(msgid='Open', msgstr='Öffnen'))
+    po.append(polib.POEntry(msgid='Save', msgstr=''))
+    po.save(refFile)
+    comp = Compendium(str(tmp_path / 'data' / 'compendium.db'))
+    assert comp.update(refFile) == (True, 1)
+    assert comp.update(refFile) == (False, 1)
+    assert comp.lookup(['Open', 'Save'], [(refFile, 'de')]) == {'Open': {'de': 'Öffnen'}}
+    comp.close()
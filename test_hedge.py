@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#tr_hedge.py 的测试
+from types import SimpleNamespace
+from tr_hedge import HedgedAgent
+
+#统计文件所在的目录不存在时自动创建，再次启动时读回统计数据
+def testStatsSavedInNewDir(tmp_path):
+    agents = [SimpleNamespace(name='openai', model='a'), SimpleNamespace(name='google', model='b')]
+    statsFile = str(tmp_path / 'data' / 'hedge_stats.json')
+    hedged = HedgedAgent(agents, statsFile=statsFile)
+    hedged.stats['openai/a']['latencies'].extend([1.0, 2.0])
+    hedged.stats['openai/a']['wins'] = 2
+    hedged.saveStats()
+    loaded = HedgedAgent(agents, statsFile=statsFile)
+    assert list(loaded.stats['openai/a']['latencies']) == [1.0, 2.0]
+    assert loaded.stats['openai/a']['wins'] == 2
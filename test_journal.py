@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#tr_journal.py 的测试，以及 translateFile() 对中断日志的处理
+import polib
+import autopo
+from tr_journal import TranslationJournal
+
+#不应该发出任何请求的agent，日志中已经有全部翻译
+class NoRequestAgent:
+    model = 'none'
+    context_size = 8000
+    output_size = 2000
+    endpoints = []
+    def __str__(self):
+        return 'NoRequestAgent'
+    def chat(self, *args, **kwargs):
+        raise AssertionError('unexpected request')
+
+def makePo(fileName):
+    po = polib.POFile()
+    po.append(polib.POEntry(msgid='Open', msgstr=''))
+    po.append(polib.POEntry(msgid='Open', msgctxt='menu', msgstr=''))
+    po.save(fileName)
+
+def testUnfinished(tmp_path):
+    fileName = str(tmp_path / 'a.journal')
+    assert not TranslationJournal.unfinished(fileName)
+    open(fileName, 'w').close()
+    assert not TranslationJournal.unfinished(fileName)
+    journal = TranslationJournal(fileName)
+    journal.append([('Open', '', 'Ouvrir')])
+    journal.close()
+    assert TranslationJournal.unfinished(fileName)
+    assert TranslationJournal.load(fileName) == {('Open', ''): 'Ouvrir'}
+
+#没有 --resume 时不覆盖已有的日志，po文件也不修改
+def testRefuseToOverwriteJournal(tmp_path, capsys):
+    fileName = str(tmp_path / 'messages.po')
+    makePo(fileName)
+    journal = TranslationJournal(fileName + '.journal')
+    journal.append([('Open', '', 'Ouvrir'), ('Open', 'menu', 'Ouvrir le fichier')])
+    journal.close()
+    autopo.translateFile(fileName, NoRequestAgent(), 'fr', fmt='json')
+    assert 'use --resume' in capsys.readouterr().out
+    assert len(TranslationJournal.load(fileName + '.journal')) == 2
+    assert not polib.pofile(fileName).translated_entries()
+
+#使用 --resume 时从日志中恢复，完成后删除日志
+def testResumeFromJournal(tmp_path):
+    fileName = str(tmp_path / 'messages.po')
+    makePo(fileName)
+    journal = TranslationJournal(fileName + '.journal')
+    journal.append([('Open', '', 'Ouvrir'), ('Open', 'menu', 'Ouvrir le fichier')])
+    journal.close()
+    autopo.translateFile(fileName, NoRequestAgent(), 'fr', fmt='json', resume=True)
+    po = polib.pofile(fileName)
+    assert {(e.msgctxt or '', e.msgstr) for e in po} == {('', 'Ouvrir'), ('menu', 'Ouvrir le fichier')}
+    assert not TranslationJournal.unfinished(fileName + '.journal')
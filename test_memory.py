@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#tr_memory.py 的测试
+from tr_memory import TranslationMemory
+
+#本工具翻译后写入po文件的条目再次收集时仍然是AI翻译，人工修改过的才是校对过的翻译
+def testMachineTranslationNotPromoted(tmp_path):
+    tm = TranslationMemory(str(tmp_path / 'tm.db'))
+    tm.store([('Open', '', 'Abrir'), ('Save', '', 'Guardar')], 'en', 'es', 'model-a')
+    assert tm.store([('Open', '', 'Abrir'), ('Save', '', 'Salvar'), ('Quit', '', 'Salir')], 'en', 'es',
+        reviewed=True) == 2
+
+    reviewed = TranslationMemory(str(tmp_path / 'tm.db'), reviewedOnly=True)
+    found = reviewed.lookup([('Open', ''), ('Save', ''), ('Quit', '')], 'en', 'es', 'model-b')
+    assert found == {('Save', ''): 'Salvar', ('Quit', ''): 'Salir'}
+    #同一个model仍然可以使用自己的AI翻译
+    assert tm.lookup([('Open', '')], 'en', 'es', 'model-a') == {('Open', ''): 'Abrir'}
+    reviewed.close()
+    tm.close()
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#tr_placeholders.py 的测试
+from tr_placeholders import maskBatch, unmaskResult, fixWhitespace, checkTranslation
+
+def testMaskRoundTrip():
+    batch = {'Hello %(name)s, <b>{count}</b> new': ''}
+    masked, unmask = maskBatch(batch)
+    mkey = next(iter(masked))
+    assert '%(name)s' not in mkey and '<b>' not in mkey
+    ret = unmaskResult({mkey: mkey.replace('Hello', 'Bonjour').replace('new', 'nouveaux')}, unmask)
+    assert ret == {'Hello %(name)s, <b>{count}</b> new': 'Bonjour %(name)s, <b>{count}</b> nouveaux'}
+
+#首尾空白使用原文的，不作为拒绝翻译的原因
+def testWhitespaceIsFixedNotRejected():
+    assert fixWhitespace('  Open\n', 'Ouvrir ') == '  Ouvrir\n'
+    assert checkTranslation('  Open\n', 'Ouvrir') == ''
+
+def testMismatches():
+    assert checkTranslation('<b>Open</b>', 'Ouvrir') == 'markup mismatch'
+    assert checkTranslation('{count} files', 'fichiers') == 'placeholder mismatch'
+    assert checkTranslation('%d files', 'fichiers') == 'format mismatch'
+    assert checkTranslation('%s of %d', '%d de %s', ['c-format']) == 'format order mismatch'
+    assert checkTranslation('100% sure', 'sûr à 100%') == ''
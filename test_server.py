@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#tr_server.py 和服务模式任务参数的测试
+import time, json, threading
+import autopo
+import tr_server
+from tr_server import TranslationServer, createHttpServer, submitJob
+
+#启动工作线程，不启动http服务
+def startWorkers(server):
+    for t in server.workers:
+        t.start()
+    return server
+
+def waitJob(job, timeout=5):
+    with job.cond:
+        job.cond.wait_for(lambda: job.ended, timeout)
+    return job.state
+
+#任务引发SystemExit时标记为失败，工作线程继续执行后面的任务
+def testWorkerSurvivesSystemExit():
+    def runner(params):
+        if params['dest'] == '-x':
+            raise SystemExit(2)
+        return ''
+    server = startWorkers(TranslationServer(runner, jobs=1))
+    bad = server.submit({'file': 'a.po', 'dest': '-x'})
+    good = server.submit({'file': 'a.po', 'dest': 'fr'})
+    assert waitJob(bad) == 'failed' and 'SystemExit' in bad.error
+    assert waitJob(good) == 'done'
+
+#参数值不经过argparse，以'-'开头的值不会被当作选项
+def testJobArgs():
+    args, error = autopo.jobArgs({'file': 'a.po', 'dest': '-x', 'workers': 3, 'max_cost': 1,
+        'refpo': ['b.po'], 'stream': True, 'output': None, 'format': 'json'})
+    assert not error
+    assert (args.dest, args.workers, args.max_cost, args.refpo, args.stream) == ('-x', 3, 1.0, ['b.po'], True)
+    assert args.output is None and args.format == 'json' and args.tm_max_age == 0
+
+def testJobArgsRejected():
+    for params in ({'dest': 'fr'}, {'file': 'a.po', 'dest': 1}, {'file': 'a.po', 'dest': 'fr', 'workers': '4'},
+        {'file': 'a.po', 'dest': 'fr', 'workers': 1.5}, {'file': 'a.po', 'dest': 'fr', 'stream': 'yes'},
+        {'file': 'a.po', 'dest': 'fr', 'format': 'xml'}, {'file': 'a.po', 'dest': 'fr', 'refpo': 'b.po'},
+        {'file': 'a.po', 'dest': 'fr', 'server': 'x:1'}, {'file': 'a.po', 'dest': 'fr', 'shell': 'ls'}):
+        args, error = autopo.jobArgs(params)
+        assert args is None and error, params
+    #参数错误时任务直接失败，不创建AI服务实例
+    assert autopo.JobRunner()({'file': 'a.po', 'dest': 'fr', 'workers': 'many'}).startswith('Invalid value')
+
+#结束的任务超过保留时间或者数量后从任务列表中删除，排队中的任务不删除
+def testEndedJobsEvicted(monkeypatch):
+    monkeypatch.setattr(tr_server, 'MAX_ENDED_JOBS', 3)
+    server = TranslationServer(lambda params: '')
+    queued = server.submit({'file': 'a.po', 'dest': 'fr'})
+    old = server.submit({'file': 'a.po', 'dest': 'fr'})
+    old.finish('done')
+    old.finished -= tr_server.JOB_RETENTION + 1
+    jobs = [server.submit({'file': 'a.po', 'dest': 'fr'}) for _ in range(5)]
+    for job in jobs:
+        job.finish('done')
+    server.submit({'file': 'a.po', 'dest': 'fr'})
+    assert queued.id in server.jobs and old.id not in server.jobs
+    assert [job.id in server.jobs for job in jobs] == [False, False, True, True, True]
+    assert len(set(server.jobs)) == len(server.jobs) == 5
+
+#通过http提交的任务失败时客户端收到失败状态，不会一直等待
+def testSubmitJobFailed():
+    server = startWorkers(TranslationServer(lambda params: autopo.getArg([params['file'], '-d', params['dest']]) and ''))
+    httpd = createHttpServer('127.0.0.1:0', server._makeHandler())
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        address = f'127.0.0.1:{httpd.server_address[1]}'
+        start = time.monotonic()
+        assert submitJob(address, {'file': 'a.po', 'dest': '-x'}) == 'failed'
+        assert submitJob(address, {'file': 'a.po', 'dest': 'fr'}) == 'done'
+        assert time.monotonic() - start < 5
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+#请求体不是json对象或者优先级不是整数时返回400，服务继续正常工作
+def testPostInvalidBody():
+    server = TranslationServer(lambda params: '')
+    httpd = createHttpServer('127.0.0.1:0', server._makeHandler())
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        address = f'127.0.0.1:{httpd.server_address[1]}'
+        for body in ('[]', '"x"', '{bad', '{"file": "a.po"}', '{"file": "a.po", "dest": "fr", "priority": "high"}',
+            '{"file": "a.po", "dest": "fr", "priority": 1.5}'):
+            conn = tr_server.connectServer(address)
+            conn.request('POST', '/jobs', body, {'Content-Type': 'application/json'})
+            resp = conn.getresponse()
+            assert resp.status == 400 and json.loads(resp.read())['error'], body
+            conn.close()
+        assert not server.jobs
+        conn = tr_server.connectServer(address)
+        conn.request('POST', '/jobs', '{"file": "a.po", "dest": "fr", "priority": 2}')
+        resp = conn.getresponse()
+        assert resp.status == 201 and server.jobs[json.loads(resp.read())['id']].priority == 2
+        conn.close()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#tr_stats.py 的测试
+from tr_stats import FormatStats
+
+#没有统计数据时使用预设成功率最高的格式，使用多了以后其他格式也会被尝试
+def testExploration(tmp_path):
+    stats = FormatStats(str(tmp_path / 'data' / 'format_stats.json'))
+    assert stats.choose('m') == 'id'
+    stats.record('m', 'id', 2000, 1980)
+    assert stats.choose('m') != 'id'
+
+    #尝试过的格式成功率低，又回到成功率高的格式
+    stats.record('m', 'json', 500, 300)
+    stats.record('m', 'placeholder', 500, 300)
+    assert stats.choose('m') == 'id'
+
+    stats.save()
+    assert FormatStats(stats.fileName).stats == stats.stats
+
+#每个模型分别统计
+def testPerModel():
+    stats = FormatStats(None)
+    stats.record('a', 'id', 5000, 5000)
+    assert stats.choose('b') == 'id'
+    assert stats.choose('a', ['id']) == 'id'
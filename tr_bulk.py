@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#离线批量翻译，将所有批次的请求一次性提交为服务商的批量任务(OpenAI Batch / Anthropic Message Batches)
+#任务id保存在状态文件中，程序中断或者没有等待任务完成时，下次运行会继续查询同一个任务
+#任务完成后使用 BulkReplayAgent 代替原来的agent，translateBatch() 的处理逻辑保持不变
+#Author: cdhigh <https://github.com/cdhigh>
+import os, json, time, hashlib
+
+BULK_POLL_INTERVAL = 60 #查询批量任务状态的间隔秒数
+
+#返回一个请求消息的摘要，用于将批量任务的结果对应到重新构建的请求
+def messageKey(message):
+    return hashlib.sha1(json.dumps(message, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+#在chat()时返回批量任务中相同请求的结果，没有结果的请求(比如失败后重新翻译缺失的条目)转发给原来的agent
+#其他属性全部转发给原来的agent
+class BulkReplayAgent:
+    #agent: SimpleAiProvider实例
+    #results: 字典 {messageKey: respTxt}
+    def __init__(self, agent, results):
+        self.agent = agent
+        self.results = results
+
+    def __getattr__(self, name):
+        return getattr(self.agent, name)
+
+    def __repr__(self):
+        return repr(self.agent)
+
+    #每个结果仅使用一次，重试时使用实时请求
+    def chat(self, message, onText=None):
+        respTxt = self.results.pop(messageKey(message), None)
+        if respTxt is None:
+            return self.agent.chat(message, onText)
+        if onText:
+            onText(respTxt)
+        return respTxt
+
+#提交或者继续一个批量任务
+#stateFile: 保存任务id的状态文件
+#messages: 所有批次的请求消息列表，重新运行时根据消息摘要匹配，所以po文件不变时可以继续上次的任务
+#wait: 是否等待任务完成，为False时仅提交或者查询一次状态
+#返回 BulkReplayAgent 实例，任务还没有完成时返回None
+#任务完成后状态文件仍然保留，翻译结果保存到po文件后再由调用者删除
+def runBulkJob(agent, stateFile, messages, wait=True):
+    state = loadState(stateFile)
+    if state and (state.get('provider') != agent.name or state.get('model') != agent.model):
+        print(f'  Ignoring bulk job {state.get("job")} created by {state.get("provider")}/{state.get("model")}')
+        state = None
+    if not state:
+        requests = {f'req-{idx}': msg for idx, msg in enumerate(messages)}
+        jobId = agent.submitBatch(requests)
+        state = {'provider': agent.name, 'model': agent.model, 'job': jobId, 'created': time.time(),
+            'requests': {cid: messageKey(msg) for cid, msg in requests.items()}}
+        saveState(stateFile, state)
+        print(f'  Submitted bulk job {jobId}: {len(requests)} requests')
+    jobId = state['job']
+
+    while True:
+        st, status = agent.batchStatus(jobId)
+        if st == 'ended':
+            break
+        elif st == 'failed':
+            print(f'  Bulk job {jobId} failed: {status}')
+            os.remove(stateFile)
+            return None
+        elif not wait:
+            print(f'  Bulk job {jobId} is {status}, run again later to apply the results')
+            return None
+        print(f'  Bulk job {jobId} is {status}, checking again in {BULK_POLL_INTERVAL}s')
+        time.sleep(BULK_POLL_INTERVAL)
+
+    keys = state['requests']
+    results = {keys[cid]: respTxt for cid, respTxt in agent.batchResults(jobId).items() if cid in keys}
+    print(f'  Bulk job {jobId} {status}: {len(results)}/{len(keys)} results')
+    return BulkReplayAgent(agent, results)
+
+#读取状态文件，不存在或者无效时返回None
+def loadState(stateFile):
+    if not os.path.exists(stateFile):
+        return None
+    try:
+        with open(stateFile, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state if state.get('job') else None
+    except (ValueError, AttributeError) as e:
+        print(f'  Invalid bulk state file {stateFile}: {e}')
+        return None
+
+#先保存到临时文件再替换
+def saveState(stateFile, state):
+    tmpFile = stateFile + '.tmp'
+    with open(tmpFile, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmpFile, stateFile)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#适用于超大po文件的流式读写，不使用polib一次性解析整个文件
+#读取时仅在内存中保留需要翻译的条目(紧凑的PoEntry)和它们的位置(第几个条目)，其他条目保存时从原文件逐个复制
+#保存时一次写入临时文件再替换，同时删除过时的条目和计算翻译统计，不需要重新读取
+#提供和 polib.POFile 相同名字的几个方法，可以直接替换 polib.pofile() 使用
+#不支持复数形式(msgid_plural)的条目，这些条目保持原样
+#Author: cdhigh <https://github.com/cdhigh>
+import re, textwrap
+from polib import escape, unescape
+
+#一个po条目的紧凑表示
+class PoEntry:
+    __slots__ = ('msgid', 'msgid_plural', 'msgctxt', 'msgstr', 'msgstr_plural', 'flags', 'obsolete', 'index',
+        'orig')
+
+    def __init__(self):
+        self.msgid = ''
+        self.msgid_plural = ''
+        self.msgctxt = None
+        self.msgstr = ''
+        self.msgstr_plural = {}
+        self.flags = []
+        self.obsolete = False
+        self.index = -1 #在文件中是第几个(非过时)条目，保存时使用
+        self.orig = None #读取时的 (msgstr, fuzzy)，保存时仅重新生成有修改的条目
+
+    def __repr__(self):
+        return f'PoEntry({self.msgid[:30]!r})'
+
+    @property
+    def fuzzy(self):
+        return 'fuzzy' in self.flags
+
+    @fuzzy.setter
+    def fuzzy(self, value):
+        if value and ('fuzzy' not in self.flags):
+            self.flags.insert(0, 'fuzzy')
+        elif not value and ('fuzzy' in self.flags):
+            self.flags.remove('fuzzy')
+
+    #和 polib.POEntry.translated() 的逻辑一致
+    def translated(self):
+        if self.obsolete or self.fuzzy:
+            return False
+        elif self.msgstr:
+            return True
+        elif self.msgstr_plural:
+            return all(self.msgstr_plural.values())
+        return False
+
+class StreamCatalog:
+    FIELD_PAT = re.compile(r'^(msgctxt|msgid_plural|msgid|msgstr(?:\[(\d+)\])?)\s+"(.*)"\s*$')
+
+    #fileName: po文件名
+    #wrapwidth: 生成msgstr时的换行宽度，和polib一致
+    def __init__(self, fileName, wrapwidth=78):
+        self.fileName = fileName
+        self.wrapwidth = wrapwidth
+        self.pending = {} #{index: PoEntry}，需要翻译的条目(未翻译或者fuzzy)
+        self.total = 0 #非过时条目的数量，不包括文件头
+        self.translatedNum = 0
+        for entry, lines in self.iterBlocks(fileName):
+            if entry.obsolete or not entry.msgid:
+                continue
+            self.total += 1
+            if entry.translated():
+                self.translatedNum += 1
+            elif not entry.msgid_plural:
+                entry.orig = (entry.msgstr, entry.fuzzy)
+                self.pending[entry.index] = entry
+
+    def __repr__(self):
+        return f'StreamCatalog({self.fileName})'
+
+    #逐个读取po文件的条目，返回生成器 (PoEntry, 原始文本行列表)，文件头的msgid为空字符串
+    @classmethod
+    def iterBlocks(cls, fileName):
+        index = 0
+        with open(fileName, 'r', encoding='utf-8') as f:
+            lines = []
+            hasMsgstr = False
+            for line in f:
+                line = line.rstrip('\r\n')
+                stripped = line.lstrip('#~ ') if line.startswith('#~') else line
+                #空行或者在msgstr之后出现注释/msgctxt/msgid都表示一个新的条目
+                if not line.strip() or (hasMsgstr and (stripped.startswith(('msgctxt', 'msgid')) or
+                    (line.startswith('#') and not line.startswith('#~ "')))):
+                    if hasMsgstr or lines:
+                        entry = cls._parseBlock(lines, index)
+                        if not entry.obsolete:
+                            index += 1
+                        yield entry, lines
+                    lines = [line] if line.strip() else []
+                    hasMsgstr = False
+                    continue
+                lines.append(line)
+                if stripped.startswith('msgstr'):
+                    hasMsgstr = True
+            if lines:
+                yield cls._parseBlock(lines, index), lines
+
+    #仅返回条目，和 iterBlocks() 一样逐个读取
+    @classmethod
+    def iterEntries(cls, fileName):
+        return (entry for entry, lines in cls.iterBlocks(fileName))
+
+    #解析一个条目的文本行
+    @classmethod
+    def _parseBlock(cls, lines, index):
+        entry = PoEntry()
+        entry.index = index
+        field = plural = None
+        hasField = False
+        for line in lines:
+            if line.startswith('#~'):
+                entry.obsolete = True
+                line = line[2:].lstrip()
+                if line.startswith('|'): #过时条目的 #~| previous msgid
+                    continue
+            elif line.startswith('#,'):
+                entry.flags.extend(f.strip() for f in line[2:].split(',') if f.strip())
+                continue
+            elif line.startswith('#'):
+                continue
+
+            if match := cls.FIELD_PAT.match(line):
+                field, plural, text = match.group(1), match.group(2), unescape(match.group(3))
+                hasField = True
+            elif line.startswith('"') and field:
+                text = unescape(line.strip()[1:-1])
+            else:
+                continue
+
+            if field == 'msgctxt':
+                entry.msgctxt = (entry.msgctxt or '') + text
+            elif field == 'msgid':
+                entry.msgid += text
+            elif field == 'msgid_plural':
+                entry.msgid_plural += text
+            elif plural is not None:
+                idx = int(plural)
+                entry.msgstr_plural[idx] = entry.msgstr_plural.get(idx, '') + text
+            else:
+                entry.msgstr += text
+        if not hasField: #只有注释的块
+            entry.obsolete = True
+        return entry
+
+    #和polib.POFile同名的方法
+    def untranslated_entries(self):
+        return [e for e in self.pending.values() if not e.translated() and not e.fuzzy]
+
+    def fuzzy_entries(self):
+        return [e for e in self.pending.values() if e.fuzzy]
+
+    #已经翻译的条目不保存在内存中，需要重新读取文件，仅用于一次性的遍历
+    def translated_entries(self):
+        return [e for e in self.iterEntries(self.fileName) if e.msgid and e.translated()]
+
+    def percent_translated(self):
+        return int(self.translatedNum * 100 / float(self.total)) if self.total else 100
+
+    #将原文件和修改过的条目一次写入另一个文件，同时删除过时的条目，更新翻译统计
+    #fileName: 输出文件名，可以和原文件相同，调用者负责先写到临时文件再替换
+    def save(self, fileName):
+        total = translatedNum = 0
+        with open(fileName, 'w', encoding='utf-8') as f:
+            first = True
+            for entry, lines in self.iterBlocks(self.fileName):
+                if entry.obsolete:
+                    continue
+                if (pending := self.pending.get(entry.index)) and (pending.msgid == entry.msgid):
+                    if (pending.msgstr, pending.fuzzy) != pending.orig:
+                        lines = self._renderBlock(lines, pending)
+                    entry = pending
+                if entry.msgid:
+                    total += 1
+                    translatedNum += entry.translated()
+                if not first:
+                    f.write('\n')
+                f.write('\n'.join(lines) + '\n')
+                first = False
+        self.total = total
+        self.translatedNum = translatedNum
+
+    #使用新的flags和msgstr重新生成一个条目的文本，其他行保持原样
+    def _renderBlock(self, lines, entry):
+        ret = []
+        flagsLine = ('#, ' + ', '.join(entry.flags)) if entry.flags else None
+        inMsgstr = False
+        for line in lines:
+            if line.startswith('#,'):
+                if flagsLine:
+                    ret.append(flagsLine)
+                    flagsLine = None
+                continue
+            elif line.startswith('msgstr'):
+                inMsgstr = True
+                continue
+            elif inMsgstr and line.startswith('"'):
+                continue
+            inMsgstr = False
+            if flagsLine and not line.startswith(('#.', '#:', '# ')) and line != '#':
+                ret.append(flagsLine)
+                flagsLine = None
+            ret.append(line)
+        ret.extend(self._renderField('msgstr', entry.msgstr))
+        return ret
+
+    #生成一个字段的文本行，换行规则和polib一致
+    def _renderField(self, name, text):
+        lines = text.splitlines(True)
+        if len(lines) > 1:
+            lines = [''] + lines
+        else:
+            escaped = escape(text)
+            specials = sum(text.count(c) for c in '\\\n\r\t\v\b\f"')
+            width = self.wrapwidth - len(name) - 3 + specials
+            if self.wrapwidth > 0 and len(text) > width:
+                lines = [''] + [unescape(item) for item in textwrap.wrap(escaped, self.wrapwidth - 2,
+                    drop_whitespace=False, break_long_words=False)]
+            else:
+                lines = [text]
+        return [f'{name} "{escape(lines[0])}"'] + [f'"{escape(line)}"' for line in lines[1:]]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#参考翻译索引，将多个参考po文件(其他语种的翻译或者汇编文件)的已翻译条目保存在SQLite数据库中，多次运行之间共享
+#每个文件记录修改时间和大小，文件没有变化时不需要重新解析，有变化时仅重新导入这个文件
+#翻译时按照批次查询，不需要一次性将所有参考翻译读入内存
+#Author: cdhigh <https://github.com/cdhigh>
+import os, sqlite3, threading
+from tr_catalog import StreamCatalog
+
+class Compendium:
+    LOOKUP_CHUNK = 500 #每次查询的msgid数量，SQLite的参数数量有上限
+
+    #dbFile: 数据库文件名，':memory:' 为仅在内存中使用的临时索引
+    def __init__(self, dbFile):
+        self.dbFile = dbFile
+        self._lock = threading.Lock() #translateBatch() 可能在多个线程中调用
+        if dbFile != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(dbFile)), exist_ok=True)
+        self.db = sqlite3.connect(dbFile, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL NOT NULL,
+            size INTEGER NOT NULL, entries INTEGER NOT NULL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS refs (msgid TEXT NOT NULL, path TEXT NOT NULL,
+            msgstr TEXT NOT NULL, PRIMARY KEY (msgid, path))""")
+        self.db.commit()
+
+    def __repr__(self):
+        return f'Compendium({self.dbFile})'
+
+    #如果参考文件有变化(或者还没有索引)，重新导入这个文件的所有已翻译条目
+    #fileName: po文件名，文件的语种在查询时指定
+    #返回 (是否重新导入, 条目数量)
+    def update(self, fileName):
+        path = os.path.abspath(fileName)
+        st = os.stat(path)
+        with self._lock:
+            row = self.db.execute("SELECT mtime, size, entries FROM files WHERE path=?", (path,)).fetchone()
+            if row and (row[0], row[1]) == (st.st_mtime, st.st_size):
+                return False, row[2]
+
+        #逐个读取条目，超大的参考文件也不需要全部加载到内存
+        rows = {}
+        for e in StreamCatalog.iterEntries(path):
+            if e.msgid and e.msgstr and e.translated():
+                rows.setdefault(e.msgid, e.msgstr) #相同的msgid(不同的msgctxt)只保留第一个
+        with self._lock:
+            self.db.execute("DELETE FROM refs WHERE path=?", (path,))
+            self.db.executemany("INSERT INTO refs VALUES (?,?,?)", ((k, path, v) for k, v in rows.items()))
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?)",
+                (path, st.st_mtime, st.st_size, len(rows)))
+            self.db.commit()
+        return True, len(rows)
+
+    #查询多个文本的参考翻译
+    #keys: msgid列表
+    #sources: [(fileName, lang),...]，同一个语种有多个文件时，排在前面的文件优先
+    #返回字典 {msgid: {lang: msgstr}}，没有参考翻译的msgid不在字典中
+    def lookup(self, keys, sources):
+        paths = [os.path.abspath(fileName) for fileName, lang in sources]
+        if not (keys and paths):
+            return {}
+        langOf = {path: lang for path, (fileName, lang) in zip(paths, sources)}
+        priority = {path: idx for idx, path in reversed(list(enumerate(paths)))}
+        found = {} #{msgid: {lang: (priority, msgstr)}}
+        keys = list(keys)
+        with self._lock:
+            for start in range(0, len(keys), self.LOOKUP_CHUNK):
+                chunk = keys[start:start + self.LOOKUP_CHUNK]
+                sql = "SELECT msgid, path, msgstr FROM refs WHERE msgid IN ({}) AND path IN ({})".format(
+                    ','.join('?' * len(chunk)), ','.join('?' * len(paths)))
+                for msgid, path, msgstr in self.db.execute(sql, chunk + paths):
+                    item = found.setdefault(msgid, {})
+                    lang = langOf[path]
+                    if (lang not in item) or (priority[path] < item[lang][0]):
+                        item[lang] = (priority[path], msgstr)
+        return {msgid: {lang: msgstr for lang, (_, msgstr) in item.items()} for msgid, item in found.items()}
+
+    def close(self):
+        with self._lock:
+            self.db.close()
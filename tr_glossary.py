@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#术语表，保证产品名称和专业术语的翻译一致
+#术语表文件为csv(或者tsv)格式，第一行为语言代码，第一列为源语言，其他列为各个目标语言的译文，空白表示没有译文
+#  en,fr,de
+#  e-book,livre numérique,E-Book
+#  Calibre,Calibre,Calibre
+#所有源语言术语编译为一个 Aho-Corasick 自动机，扫描一遍文本就能找到其中的所有术语，和术语数量无关
+#每个批次仅将其中出现的术语加入提示词，翻译后检查译文是否使用了要求的术语
+#Author: cdhigh <https://github.com/cdhigh>
+import csv
+
+#多模式字符串匹配，不区分大小写，术语的首尾为字母数字时要求是一个完整的单词
+class AhoCorasick:
+    #terms: 术语列表
+    def __init__(self, terms):
+        self.terms = list(dict.fromkeys(term.lower() for term in terms if term))
+        self.goto = [{}] #每个状态的转移 {字符: 下一个状态}
+        self.fail = [0]
+        self.output = [[]] #每个状态匹配到的术语索引，包括通过失败链接可以到达的状态
+        for idx, term in enumerate(self.terms):
+            state = 0
+            for ch in term:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = self.goto[state][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                state = nxt
+            self.output[state].append(idx)
+
+        #按照广度优先计算失败链接，每个状态的失败状态的深度更小，已经处理过
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                fail = self.fail[state]
+                while fail and (ch not in self.goto[fail]):
+                    fail = self.fail[fail]
+                self.fail[nxt] = self.goto[fail].get(ch, 0)
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def __len__(self):
+        return len(self.terms)
+
+    #返回文本中出现的所有术语(小写)，同一个术语只返回一次
+    def findAll(self, text):
+        text = text.lower()
+        found = set()
+        state = 0
+        for pos, ch in enumerate(text):
+            while state and (ch not in self.goto[state]):
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for idx in self.output[state]:
+                term = self.terms[idx]
+                start = pos + 1 - len(term)
+                if self.isWord(text, start, pos + 1, term):
+                    found.add(term)
+        return found
+
+    #术语的首尾如果是ASCII字母数字，则前后不能紧接着字母数字，避免 "cat" 匹配 "category"
+    #中日韩等没有空格分隔单词的文字不检查
+    @staticmethod
+    def isWord(text, start, end, term):
+        wordy = lambda ch: ch.isascii() and ch.isalnum()
+        if wordy(term[0]) and (start > 0) and text[start - 1].isalnum():
+            return False
+        if wordy(term[-1]) and (end < len(text)) and text[end].isalnum():
+            return False
+        return True
+
+class Glossary:
+    #fileName: 术语表文件名，.tsv 使用tab分隔，其他使用逗号分隔
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.srcLang = ''
+        self.targets = {} #{源术语(小写): {目标语言: 译文}}
+        self.names = {} #{源术语(小写): 术语表中的源术语}
+        self.load()
+        self.matcher = AhoCorasick(self.targets)
+
+    def __repr__(self):
+        return f'Glossary({self.fileName}, {len(self.targets)} terms)'
+
+    def __len__(self):
+        return len(self.targets)
+
+    def load(self):
+        delimiter = '\t' if self.fileName.lower().endswith('.tsv') else ','
+        with open(self.fileName, 'r', encoding='utf-8-sig', newline='') as f:
+            rows = [row for row in csv.reader(f, delimiter=delimiter) if row and not row[0].startswith('#')]
+        if not rows:
+            return
+        header = [e.strip() for e in rows[0]]
+        self.srcLang = header[0]
+        for row in rows[1:]:
+            term = row[0].strip()
+            if not term:
+                continue
+            self.names.setdefault(term.lower(), term)
+            item = self.targets.setdefault(term.lower(), {})
+            for lang, value in zip(header[1:], row[1:]):
+                if value.strip():
+                    item[lang.lower()] = value.strip()
+
+    #返回 {目标语言: 术语数量}
+    def languages(self):
+        ret = {}
+        for item in self.targets.values():
+            for lang in item:
+                ret[lang] = ret.get(lang, 0) + 1
+        return ret
+
+    #查找一个文本中出现并且有对应语种译文的术语，返回 {源术语: 译文}
+    def match(self, text, dstLang):
+        dstLang = dstLang.lower()
+        return {term: self.targets[term][dstLang] for term in self.matcher.findAll(text)
+            if dstLang in self.targets[term]}
+
+    #查找一个批次的文本中出现的术语，用于加入提示词
+    #dstLangs: 一个目标语种时返回 {源术语: 译文}，多个语种(列表)时返回 {源术语: {语种: 译文}}
+    def find(self, texts, dstLangs):
+        found = set()
+        for text in texts:
+            found.update(self.matcher.findAll(text))
+        if isinstance(dstLangs, str):
+            dstLang = dstLangs.lower()
+            return {self.names[term]: self.targets[term][dstLang] for term in sorted(found) 
+                if dstLang in self.targets[term]}
+        ret = {}
+        for term in sorted(found):
+            item = {lang: self.targets[term][lang.lower()] for lang in dstLangs if lang.lower() in self.targets[term]}
+            if item:
+                ret[self.names[term]] = item
+        return ret
+
+    #返回译文中缺少的术语译文列表，不区分大小写，全部使用时返回空列表
+    def missing(self, text, translation, dstLang):
+        translation = translation.lower()
+        return [target for term, target in self.match(text, dstLang).items() if target.lower() not in translation]
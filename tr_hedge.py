@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#对冲请求，降低个别很慢的请求(慢的中转服务器或者模型)对整体时间的影响
+#一个请求超过主服务商延迟的某个百分位数还没有返回时，将同一个请求发送给下一个服务商，使用最先返回的有效结果
+#没有办法中断已经发出的http请求，输掉的请求在后台线程中继续完成，结果被忽略
+#每个服务商的延迟样本和胜出次数保存在统计文件中，下次运行时直接使用，也用于调整配置
+#Author: cdhigh <https://github.com/cdhigh>
+import os, json, time, queue, threading, contextvars
+from collections import deque
+
+HEDGE_MIN_SAMPLES = 5 #延迟样本少于这个数量时使用默认的等待时间
+HEDGE_DEFAULT_DELAY = 30 #没有足够的延迟样本时，发出对冲请求前等待的秒数
+HEDGE_MIN_DELAY = 2 #发出对冲请求前至少等待的秒数，避免每个请求都发送两次
+HEDGE_SAMPLES = 200 #每个服务商保留的最近延迟样本数量
+
+#将一个请求按照需要依次发给多个服务商，其他属性全部转发给第一个(主)服务商
+class HedgedAgent:
+    #agents: SimpleAiProvider实例列表，第一个为主服务商，其他的按照顺序用于对冲
+    #percentile: 请求时间超过前一个服务商延迟的这个百分位数时发出对冲请求
+    #statsFile: 保存延迟样本和胜出次数的json文件
+    def __init__(self, agents, percentile=90, statsFile=None):
+        self.agents = agents
+        self.percentile = min(max(percentile, 1), 100)
+        self.statsFile = statsFile
+        self._lock = threading.Lock()
+        #{label: {'latencies': deque, 'requests': 0, 'wins': 0, 'hedgeWins': 0, 'errors': 0}}
+        self.stats = {self.label(agent): self._newItem() for agent in agents}
+        self.hedged = 0 #发出对冲请求的次数
+        self.loadStats()
+
+    def __getattr__(self, name):
+        return getattr(self.agents[0], name)
+
+    def __repr__(self):
+        return '{} (hedged by {})'.format(self.agents[0], ', '.join(str(agent) for agent in self.agents[1:]))
+
+    @staticmethod
+    def label(agent):
+        return f'{agent.name}/{agent.model}'
+
+    @staticmethod
+    def _newItem():
+        return {'latencies': deque(maxlen=HEDGE_SAMPLES), 'requests': 0, 'wins': 0, 'hedgeWins': 0, 'errors': 0}
+
+    #返回某个服务商延迟的百分位数，用于决定发出对冲请求前的等待时间
+    def hedgeDelay(self, agent):
+        with self._lock:
+            samples = sorted(self.stats[self.label(agent)]['latencies'])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        idx = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(HEDGE_MIN_DELAY, samples[idx])
+
+    #和 SimpleAiProvider.chat() 一样，返回最先到达的有效响应(非空并且没有异常)
+    #流式请求不对冲，因为两个响应的 onText 回调会交错在一起
+    def chat(self, message, onText=None):
+        if onText or (len(self.agents) == 1):
+            return self._call(self.agents[0], message, onText)
+
+        results = queue.Queue()
+        launched = 0
+        def launch():
+            nonlocal launched
+            agent = self.agents[launched]
+            launched += 1
+            ctx = contextvars.copy_context()
+            threading.Thread(target=ctx.run, args=(self._worker, agent, message, results), daemon=True).start()
+            return agent
+
+        last = launch()
+        errors = []
+        fallback = None
+        while True:
+            timeout = self.hedgeDelay(last) if launched < len(self.agents) else None
+            try:
+                agent, ret, exc = results.get(timeout=timeout)
+            except queue.Empty:
+                last = launch()
+                with self._lock:
+                    self.hedged += 1
+                continue
+
+            if (exc is None) and ret:
+                self._recordWin(agent)
+                return ret
+            errors.append(exc)
+            fallback = ret if fallback is None else fallback
+            if len(errors) < launched: #还有请求没有返回
+                continue
+            elif launched < len(self.agents): #已经发出的请求都失败了，不需要再等待
+                last = launch()
+                continue
+            elif all(errors):
+                raise errors[0]
+            return fallback
+
+    def _worker(self, agent, message, results):
+        try:
+            results.put((agent, self._call(agent, message), None))
+        except Exception as e:
+            results.put((agent, None, e))
+
+    #调用一个服务商并且记录延迟
+    def _call(self, agent, message, onText=None):
+        item = self.stats[self.label(agent)]
+        start = time.monotonic()
+        try:
+            ret = agent.chat(message, onText)
+        except Exception:
+            with self._lock:
+                item['requests'] += 1
+                item['errors'] += 1
+            raise
+        with self._lock:
+            item['requests'] += 1
+            item['latencies'].append(round(time.monotonic() - start, 3))
+        return ret
+
+    def _recordWin(self, agent):
+        with self._lock:
+            item = self.stats[self.label(agent)]
+            item['wins'] += 1
+            if agent is not self.agents[0]:
+                item['hedgeWins'] += 1
+
+    #返回每个服务商的统计，用于查看，p50/p90为延迟中位数和90百分位数
+    def hedgeStats(self):
+        ret = []
+        with self._lock:
+            for label, item in self.stats.items():
+                samples = sorted(item['latencies'])
+                pct = lambda p: samples[min(len(samples) - 1, int(len(samples) * p / 100))] if samples else None
+                ret.append({'provider': label, 'requests': item['requests'], 'errors': item['errors'],
+                    'wins': item['wins'], 'hedgeWins': item['hedgeWins'], 'p50': pct(50), 'p90': pct(90)})
+        return ret
+
+    def loadStats(self):
+        if not (self.statsFile and os.path.exists(self.statsFile)):
+            return
+        try:
+            with open(self.statsFile, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f'Failed to load hedge stats {self.statsFile}: {e}')
+            return
+        for label, saved in data.items():
+            item = self.stats.get(label)
+            if item:
+                item['latencies'].extend(saved.get('latencies', []))
+                for key in ('requests', 'wins', 'hedgeWins', 'errors'):
+                    item[key] = saved.get(key, 0)
+
+    #累计的统计数据，先保存到临时文件再替换，同一个文件中其他服务商的数据保留
+    def saveStats(self):
+        if not self.statsFile:
+            return
+        try:
+            data = {}
+            if os.path.exists(self.statsFile):
+                with open(self.statsFile, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            with self._lock:
+                for label, item in self.stats.items():
+                    data[label] = {**item, 'latencies': list(item['latencies'])}
+            os.makedirs(os.path.dirname(os.path.abspath(self.statsFile)), exist_ok=True)
+            tmpFile = self.statsFile + '.tmp'
+            with open(tmpFile, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmpFile, self.statsFile)
+        except Exception as e:
+            print(f'Failed to save hedge stats {self.statsFile}: {e}')
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#翻译日志，每个批次翻译完成后追加写入(json lines格式)，程序中断后可以用来恢复已经翻译的结果
+#Author: cdhigh <https://github.com/cdhigh>
+import os, json, threading
+
+class TranslationJournal:
+    #fileName: 日志文件名，一般为输出po文件名加上 .journal 后缀
+    #resume: 是否保留已有的日志以便恢复，为False则清空已有的日志，调用者应该先使用 unfinished() 检查
+    def __init__(self, fileName, resume=False):
+        self.fileName = fileName
+        self._lock = threading.Lock()
+        self.records = {} #{(msgid, msgctxt): msgstr}，从已有日志中读取的记录
+        if resume and os.path.exists(fileName):
+            self.records = self.load(fileName)
+        self.file = open(fileName, 'a' if resume else 'w', encoding='utf-8')
+
+    def __repr__(self):
+        return f'TranslationJournal({self.fileName})'
+
+    #日志文件是否存在并且不为空，即上次的翻译中断了还没有恢复
+    @staticmethod
+    def unfinished(fileName):
+        return os.path.isfile(fileName) and (os.path.getsize(fileName) > 0)
+
+    #读取日志文件，返回字典 {(msgid, msgctxt): msgstr}，最后一行可能因为中断而不完整，直接忽略
+    @staticmethod
+    def load(fileName):
+        records = {}
+        with open(fileName, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                    records[(item['msgid'], item.get('msgctxt') or '')] = item['msgstr']
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return records
+
+    #追加多个翻译结果并且立即写入磁盘
+    #items: [(msgid, msgctxt, msgstr),...]
+    def append(self, items):
+        lines = ''.join(json.dumps({'msgid': msgid, 'msgctxt': msgctxt or '', 'msgstr': msgstr},
+            ensure_ascii=False) + '\n' for msgid, msgctxt, msgstr in items)
+        with self._lock:
+            if self.file:
+                self.file.write(lines)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    #翻译结果已经全部保存到po文件后，日志就不需要了
+    def remove(self):
+        self.close()
+        if os.path.exists(self.fileName):
+            os.remove(self.fileName)
+
+    def close(self):
+        with self._lock:
+            if self.file:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#基于SQLite的翻译记忆库，保存已经翻译过的文本，不同的po文件/分支之间共享，避免重复请求AI服务
+#键为 (msgid, msgctxt, src, dst, model, fields)，人工校对过的翻译保存时model和fields为空字符串
+#Author: cdhigh <https://github.com/cdhigh>
+import os, time, sqlite3, threading
+
+class TranslationMemory:
+    #dbFile: 数据库文件名
+    #maxEntries: 最多保存的条目数量，超出后删除最久没有使用的条目，0为不限制
+    #maxAge: 条目最多保留的天数，超过这个天数没有使用的条目会被删除，0为不限制
+    #reviewedOnly: 仅使用人工校对过的翻译（po文件里面非fuzzy的条目），不使用AI翻译的结果
+    def __init__(self, dbFile, maxEntries=0, maxAge=0, reviewedOnly=False):
+        self.dbFile = dbFile
+        self.maxEntries = maxEntries
+        self.maxAge = maxAge
+        self.reviewedOnly = reviewedOnly
+        self._lock = threading.Lock() #translateBatch() 可能在多个线程中调用
+        dirName = os.path.dirname(os.path.abspath(dbFile))
+        os.makedirs(dirName, exist_ok=True)
+        self.db = sqlite3.connect(dbFile, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS tm (msgid TEXT NOT NULL, msgctxt TEXT NOT NULL,
+            src TEXT NOT NULL, dst TEXT NOT NULL, model TEXT NOT NULL, fields TEXT NOT NULL,
+            msgstr TEXT NOT NULL, reviewed INTEGER NOT NULL, created REAL NOT NULL, used REAL NOT NULL,
+            PRIMARY KEY (msgid, msgctxt, src, dst, model, fields))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tm_used ON tm (used)")
+        self.db.commit()
+
+    def __repr__(self):
+        return f'TranslationMemory({self.dbFile})'
+
+    #查询多个待翻译文本
+    #keys: [(msgid, msgctxt),...]
+    #fields: 领域列表，和翻译时传入的一致
+    #优先使用同一个model/fields的翻译，然后是人工校对过的翻译
+    #返回字典 {(msgid, msgctxt): msgstr}
+    def lookup(self, keys, src, dst, model, fields=None):
+        fields = '/'.join(fields or [])
+        ret = {}
+        now = time.time()
+        with self._lock:
+            for msgid, msgctxt in keys:
+                msgctxt = msgctxt or ''
+                sql = """SELECT msgstr, rowid FROM tm WHERE msgid=? AND msgctxt=? AND src=? AND dst=?
+                    AND ((model=? AND fields=?) OR reviewed=1)"""
+                if self.reviewedOnly:
+                    sql += " AND reviewed=1"
+                row = self.db.execute(sql + " ORDER BY reviewed DESC, used DESC LIMIT 1",
+                    (msgid, msgctxt, src, dst, model, fields)).fetchone()
+                if row:
+                    ret[(msgid, msgctxt)] = row[0]
+                    self.db.execute("UPDATE tm SET used=? WHERE rowid=?", (now, row[1]))
+            self.db.commit()
+        return ret
+
+    #保存多个翻译结果
+    #items: [(msgid, msgctxt, msgstr),...]
+    #reviewed: 是否为人工校对过的翻译，为True时忽略model和fields
+    #  记忆库中已经有相同译文的AI翻译时，这个条目是本工具写入po文件后没有修改过的，不作为人工校对过的翻译
+    def store(self, items, src, dst, model='', fields=None, reviewed=False):
+        fields = '' if reviewed else '/'.join(fields or [])
+        model = '' if reviewed else model
+        now = time.time()
+        rows = [(msgid, msgctxt or '', src, dst, model, fields, msgstr, int(reviewed), now, now)
+            for msgid, msgctxt, msgstr in items if msgid and msgstr]
+        with self._lock:
+            if reviewed:
+                rows = [row for row in rows if not self.db.execute("""SELECT 1 FROM tm WHERE msgid=? AND
+                    msgctxt=? AND src=? AND dst=? AND msgstr=? AND reviewed=0 LIMIT 1""",
+                    (row[0], row[1], src, dst, row[6])).fetchone()]
+            self.db.executemany("""INSERT INTO tm VALUES (?,?,?,?,?,?,?,?,?,?)
+                ON CONFLICT (msgid, msgctxt, src, dst, model, fields)
+                DO UPDATE SET msgstr=excluded.msgstr, reviewed=excluded.reviewed, used=excluded.used""", rows)
+            self.db.commit()
+        return len(rows)
+
+    #按照时间和数量限制删除过期的条目，返回删除的条目数量
+    def evict(self):
+        removed = 0
+        with self._lock:
+            if self.maxAge > 0:
+                cur = self.db.execute("DELETE FROM tm WHERE used<?", (time.time() - self.maxAge * 86400,))
+                removed += cur.rowcount
+            if self.maxEntries > 0:
+                cur = self.db.execute("""DELETE FROM tm WHERE rowid IN (SELECT rowid FROM tm
+                    ORDER BY used DESC LIMIT -1 OFFSET ?)""", (self.maxEntries,))
+                removed += cur.rowcount
+            self.db.commit()
+        return removed
+
+    def close(self):
+        if self.db:
+            self.evict()
+            self.db.close()
+            self.db = None
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#记录每个AI请求和每个翻译批次的指标，用于调整 rpm/批次大小 和找出慢的 host/key
+#每个事件作为一行json追加到事件日志，同时按照 provider/model/host/key 汇总，结束时写入Prometheus文本格式的文件
+#request 事件: 延迟，等待速率限制的时间，网络时间，收发的字节数，http状态码，估计和实际的token用量
+#retry 事件: 请求失败后的重试和退避等待时间
+#batch 事件: 每个批次(包括重试缺失条目和拆分后的批次)翻译成功和丢弃的条目数，以及时间花在哪里
+#  wait(速率限制) + backoff(失败后退避) + network(网络请求) + processing(其余的时间，主要为解析和检查)
+#Author: cdhigh <https://github.com/cdhigh>
+import os, json, time, threading, contextvars
+from contextlib import contextmanager
+
+#请求延迟直方图的区间上限(秒)
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 40, 80, 160)
+
+#Prometheus指标的类型和说明 {name: (type, help)}
+METRICS = {
+    'autopo_requests_total': ('counter', 'AI requests by endpoint and http status'),
+    'autopo_request_duration_seconds': ('histogram', 'AI request latency, excluding the rate limit wait'),
+    'autopo_network_seconds_total': ('counter', 'Time spent in http requests'),
+    'autopo_ratelimit_wait_seconds_total': ('counter', 'Time spent waiting for the rate limiter before requests'),
+    'autopo_request_bytes_total': ('counter', 'Bytes sent and received (uncompressed)'),
+    'autopo_estimated_tokens_total': ('counter', 'Tokens estimated before the requests'),
+    'autopo_tokens_total': ('counter', 'Tokens reported by the provider'),
+    'autopo_retries_total': ('counter', 'Failed requests by reason, gave_up is true when no retry is left'),
+    'autopo_backoff_seconds_total': ('counter', 'Time slept before retrying failed requests'),
+    'autopo_batches_total': ('counter', 'Translated batches, including retries of missing entries and split batches'),
+    'autopo_batch_entries_total': ('counter', 'Entries sent in batches, by result translated/dropped'),
+    'autopo_batch_seconds_total': ('counter', 'Time spent in batches by phase wait/backoff/network/processing'),
+}
+
+#当前批次的时间统计，同一个批次中的请求(包括对冲请求)将等待和网络时间累加到这里
+currentBatch = contextvars.ContextVar('currentBatch', default=None)
+
+class Metrics:
+    #eventsFile: 追加json-lines事件的文件名，为空则不记录事件
+    #promFile: 结束时写入Prometheus文本格式汇总的文件名，为空则不写入
+    def __init__(self, eventsFile=None, promFile=None):
+        self.eventsFile = eventsFile
+        self.promFile = promFile
+        self._lock = threading.Lock()
+        self._file = open(eventsFile, 'a', encoding='utf-8', buffering=1) if eventsFile else None #按行写入，可以 tail -f
+        self.counters = {} #{(name, labels): value}，labels为 ((name, value), ...)
+        self.histograms = {} #{(name, labels): [每个区间的数量..., 超出最后区间的数量, 总和]}
+        self.aggregators = {'request': self._addRequest, 'retry': self._addRetry, 'batch': self._addBatch}
+
+    def __repr__(self):
+        return f'Metrics({self.eventsFile}, {self.promFile})'
+
+    #记录一个事件，写入事件日志并汇总
+    #event: request/retry/batch，其他事件仅写入日志
+    def record(self, event, **fields):
+        item = {'ts': round(time.time(), 3), 'event': event, **fields}
+        with self._lock:
+            if self._file:
+                self._file.write(json.dumps(item, ensure_ascii=False) + '\n')
+            if aggregator := self.aggregators.get(event):
+                aggregator(fields)
+
+    #统计一个批次的时间，with语句中发出的请求的等待和网络时间累加到返回的字典中
+    #结束后字典中加上 seconds 和 processing，由调用者加上条目数量后使用 record('batch', ...) 记录
+    @contextmanager
+    def batch(self):
+        totals = {'seconds': 0.0, 'wait': 0.0, 'backoff': 0.0, 'network': 0.0}
+        token = currentBatch.set(totals)
+        start = time.monotonic()
+        try:
+            yield totals
+        finally:
+            currentBatch.reset(token)
+            with self._lock:
+                totals['seconds'] = time.monotonic() - start
+                totals['processing'] = max(0.0, totals['seconds'] - totals['wait'] - totals['backoff'] - totals['network'])
+                for name in totals:
+                    totals[name] = round(totals[name], 4)
+
+    def _inc(self, name, labels, value=1):
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _observe(self, name, labels, value):
+        key = (name, tuple(labels.items()))
+        item = self.histograms.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+        idx = next((i for i, bound in enumerate(LATENCY_BUCKETS) if value <= bound), len(LATENCY_BUCKETS))
+        item[idx] += 1
+        item[-1] += value
+
+    def _addRequest(self, f):
+        labels = {'provider': f['provider'], 'model': f['model'], 'host': f['host'], 'key': f['key']}
+        self._inc('autopo_requests_total', {**labels, 'status': str(f['status'] or f['error'] or '')})
+        self._observe('autopo_request_duration_seconds', labels, f['seconds'])
+        self._inc('autopo_network_seconds_total', labels, f['network'])
+        self._inc('autopo_ratelimit_wait_seconds_total', labels, f['wait'])
+        self._inc('autopo_request_bytes_total', {**labels, 'direction': 'sent'}, f['sent'])
+        self._inc('autopo_request_bytes_total', {**labels, 'direction': 'received'}, f['received'])
+        self._inc('autopo_estimated_tokens_total', {**labels, 'type': 'input'}, f['estInput'])
+        self._inc('autopo_estimated_tokens_total', {**labels, 'type': 'output'}, f['estOutput'])
+        if f['input'] is not None:
+            self._inc('autopo_tokens_total', {**labels, 'type': 'input'}, f['input'])
+            self._inc('autopo_tokens_total', {**labels, 'type': 'output'}, f['output'] or 0)
+        if (totals := currentBatch.get()) is not None:
+            totals['wait'] += f['wait']
+            totals['network'] += f['network']
+
+    def _addRetry(self, f):
+        labels = {'provider': f['provider'], 'model': f['model']}
+        self._inc('autopo_retries_total', {**labels, 'reason': str(f['status'] or f['error']),
+            'gave_up': str(f['gaveUp']).lower()})
+        self._inc('autopo_backoff_seconds_total', labels, f['delay'])
+        if (totals := currentBatch.get()) is not None:
+            totals['backoff'] += f['delay']
+
+    def _addBatch(self, f):
+        labels = {'model': f['model'], 'format': f['format'], 'lang': f['lang']}
+        self._inc('autopo_batches_total', labels)
+        self._inc('autopo_batch_entries_total', {**labels, 'result': 'translated'}, f['translated'])
+        self._inc('autopo_batch_entries_total', {**labels, 'result': 'dropped'}, f['dropped'])
+        for phase in ('wait', 'backoff', 'network', 'processing'):
+            self._inc('autopo_batch_seconds_total', {**labels, 'phase': phase}, f[phase])
+
+    #返回Prometheus文本格式的汇总
+    def summary(self):
+        lines = []
+        with self._lock:
+            for name, (mtype, help_) in METRICS.items():
+                if mtype == 'histogram':
+                    items = [(labels, value) for (n, labels), value in self.histograms.items() if n == name]
+                else:
+                    items = [(labels, value) for (n, labels), value in self.counters.items() if n == name]
+                if not items:
+                    continue
+                lines.append(f'# HELP {name} {help_}')
+                lines.append(f'# TYPE {name} {mtype}')
+                for labels, value in sorted(items):
+                    if mtype != 'histogram':
+                        lines.append(f'{name}{formatLabels(labels)} {formatValue(value)}')
+                        continue
+                    count = 0
+                    for bound, num in zip(LATENCY_BUCKETS + ('+Inf',), value[:-1]):
+                        count += num
+                        lines.append(f'{name}_bucket{formatLabels(labels + (("le", str(bound)),))} {count}')
+                    lines.append(f'{name}_sum{formatLabels(labels)} {formatValue(value[-1])}')
+                    lines.append(f'{name}_count{formatLabels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    #写入Prometheus汇总文件，先写入临时文件再替换，避免采集程序读到不完整的文件
+    def save(self):
+        if not self.promFile:
+            return
+        try:
+            tmpFile = self.promFile + '.tmp'
+            with open(tmpFile, 'w', encoding='utf-8') as f:
+                f.write(self.summary())
+            os.replace(tmpFile, self.promFile)
+        except Exception as e:
+            print(f'Failed to save metrics {self.promFile}: {e}')
+
+    #写入汇总文件并关闭事件日志
+    def close(self):
+        self.save()
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+#Prometheus的标签 {name="value",...}，值中的反斜杠、双引号和换行需要转义
+def formatLabels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+def formatValue(value):
+    return str(value) if isinstance(value, int) else f'{value:.6g}'
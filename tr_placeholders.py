@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#翻译前将格式占位符和HTML标签替换为简短的不透明标记(⟦0⟧, ⟦1⟧...)，翻译后再恢复
+#同时检查译文的占位符/标签是否和原文一致，不一致的翻译不使用，由调用者重新翻译，首尾空白直接使用原文的
+#Author: cdhigh <https://github.com/cdhigh>
+import re
+from collections import Counter
+
+TAG_PAT = r'</?[A-Za-z][\w:.-]*(?:\s[^<>]*?)?/?>|&(?:[A-Za-z]+|#\d+|#x[0-9A-Fa-f]+);'
+BRACE_PAT = r'\{\{\s*[\w.]+\s*\}\}|\{[\w.\[\]]*(?:![rsa])?(?::[^{}]*)?\}'
+#printf/python的%格式，不包括空格标志，避免把 "100% sure" 当作占位符
+PERCENT_PAT = (r'%(?:\d+\$|\([^)\s]+\))?[-#0+]*(?:\d+|\*)?(?:\.(?:\d+|\*))?(?:hh|h|ll|l|L|q|j|z|t)?'
+    r'[diouxXeEfFgGcrsaAp%]|%\d+')
+PLACEHOLDER_RE = re.compile(f'{TAG_PAT}|{BRACE_PAT}|{PERCENT_PAT}')
+TAG_RE = re.compile(TAG_PAT)
+BRACE_RE = re.compile(BRACE_PAT)
+PERCENT_RE = re.compile(PERCENT_PAT)
+TOKEN_RE = re.compile(r'⟦\s*(\d+)\s*⟧')
+MIN_MASK_LEN = 3 #%s/{} 这样很短的占位符直接保留，替换为标记反而需要更多token
+
+#将一个文本中的占位符和标签替换为标记，返回 (替换后的文本, 原占位符列表)
+#如果原文本身就包含标记字符，则不替换
+def maskText(text):
+    if '⟦' in text:
+        return text, []
+    tokens = []
+    def repl(match):
+        value = match.group(0)
+        if len(value) < MIN_MASK_LEN:
+            return value
+        tokens.append(value)
+        return f'⟦{len(tokens) - 1}⟧'
+    return PLACEHOLDER_RE.sub(repl, text), tokens
+
+#将译文中的标记恢复为原来的占位符，无效的标记保持原样，由 checkTranslation() 发现
+def restoreText(text, tokens):
+    if not tokens or not isinstance(text, str):
+        return text
+    def repl(match):
+        idx = int(match.group(1))
+        return tokens[idx] if idx < len(tokens) else match.group(0)
+    return TOKEN_RE.sub(repl, text)
+
+#替换一个批次的所有待翻译文本，返回 (替换后的批次字典, unmask)
+#unmask: {替换后的文本: (原文本, 占位符列表)}，替换后相同的两个文本(仅占位符不同)，后一个不替换
+def maskBatch(batch):
+    masked = {}
+    unmask = {}
+    for key, value in batch.items():
+        mkey, tokens = maskText(key)
+        mkey = str(mkey) #有上下文的键为str的子类，AI返回的键只是文本
+        if mkey in unmask:
+            mkey, tokens = str(key), []
+        masked[mkey] = value
+        unmask[mkey] = (key, tokens)
+    return masked, unmask
+
+#将AI返回的 {替换后的文本: 译文} 恢复为 {原文本: 恢复后的译文}，译文也可以是 {语种: 译文} 字典
+#不认识的键保持原样，以便调用者报告被修改的键
+def unmaskResult(ret, unmask):
+    result = {}
+    for mkey, value in ret.items():
+        key, tokens = unmask.get(mkey, (mkey, []))
+        if isinstance(value, dict):
+            value = {lang: restoreText(text, tokens) for lang, text in value.items()}
+        else:
+            value = restoreText(value, tokens)
+        result[key] = value
+    return result
+
+#使用原文的首尾空白替换译文的首尾空白，这种错误不需要重新翻译
+def fixWhitespace(msgid, msgstr):
+    if not msgstr:
+        return msgstr
+    lead = msgid[:len(msgid) - len(msgid.lstrip())]
+    trail = msgid[len(msgid.rstrip()):] if msgid.strip() else ''
+    return lead + msgstr.strip() + trail
+
+#检查一个译文，返回错误原因，没有问题返回空字符串，首尾空白不检查，调用前使用 fixWhitespace() 修正
+#flags: po条目的flags，有 c-format/python-format 时%格式占位符的顺序也需要一致(没有使用名字或者位置参数时)
+def checkTranslation(msgid, msgstr, flags=None):
+    flags = flags or []
+    if TOKEN_RE.search(msgstr) and not TOKEN_RE.search(msgid):
+        return 'unknown token'
+    elif Counter(TAG_RE.findall(msgid)) != Counter(TAG_RE.findall(msgstr)):
+        return 'markup mismatch'
+    elif Counter(BRACE_RE.findall(msgid)) != Counter(BRACE_RE.findall(msgstr)):
+        return 'placeholder mismatch'
+
+    if ('no-c-format' not in flags) and ('no-python-format' not in flags):
+        srcFmt = [e for e in PERCENT_RE.findall(msgid) if e != '%%']
+        dstFmt = [e for e in PERCENT_RE.findall(msgstr) if e != '%%']
+        if Counter(srcFmt) != Counter(dstFmt):
+            return 'format mismatch'
+        #c-format/python-format 的位置参数按照顺序使用
+        if ('c-format' in flags) or ('python-format' in flags):
+            positional = lambda items: [e for e in items if not re.match(r'%(\d+\$|\()', e)]
+            if positional(srcFmt) != positional(dstFmt):
+                return 'format order mismatch'
+    return ''
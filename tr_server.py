@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#翻译服务模式，长期运行，保持AI服务的长连接和速率限制状态，多个翻译任务共享同一个速率限制
+#任务进入优先级队列，由固定数量的工作线程执行，任务的输出可以通过http接口实时获取
+#监听地址可以是 host:port 或者 unix socket 文件(unix:/path/to/socket)
+#接口:
+#  POST /jobs                 提交任务，参数为json，返回 {"id": ...}
+#  GET /jobs                  列出所有任务
+#  GET /jobs/<id>             查询任务状态
+#  GET /jobs/<id>/events      以json lines格式流式返回任务输出，直到任务结束
+#  DELETE /jobs/<id>          取消还在排队的任务
+#Author: cdhigh <https://github.com/cdhigh>
+import os, sys, json, time, queue, socket, threading, contextvars, itertools, http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlsplit
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+JOB_RETENTION = 3600 #结束的任务保留的秒数，之后从任务列表中删除
+MAX_ENDED_JOBS = 100 #最多保留的结束的任务数量
+
+#当前线程正在执行的任务，print() 的输出根据这个变量分发到对应的任务
+currentJob = contextvars.ContextVar('currentJob', default=None)
+
+#一个翻译任务
+class TranslationJob:
+    def __init__(self, jobId, params, priority=0):
+        self.id = jobId
+        self.params = params
+        self.priority = priority
+        self.state = 'queued' #queued/running/done/failed/cancelled
+        self.error = ''
+        self.lines = [] #任务的输出行
+        self.created = time.time()
+        self.started = self.finished = None
+        self._partial = ''
+        self.cond = threading.Condition()
+
+    def write(self, text):
+        with self.cond:
+            text = self._partial + text
+            *lines, self._partial = text.split('\n')
+            if lines:
+                self.lines.extend(lines)
+                self.cond.notify_all()
+
+    def finish(self, state, error=''):
+        with self.cond:
+            if self._partial:
+                self.lines.append(self._partial)
+                self._partial = ''
+            self.state = state
+            self.error = error
+            self.finished = time.time()
+            self.cond.notify_all()
+
+    @property
+    def ended(self):
+        return self.state in ('done', 'failed', 'cancelled')
+
+    def info(self):
+        return {'id': self.id, 'state': self.state, 'priority': self.priority, 'error': self.error,
+            'file': self.params.get('file'), 'dest': self.params.get('dest'), 'created': self.created,
+            'started': self.started, 'finished': self.finished, 'lines': len(self.lines)}
+
+#替换sys.stdout，任务线程中的输出写到对应的任务，其他输出仍然写到原来的stdout
+class JobOutput:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        job = currentJob.get()
+        if job:
+            job.write(text)
+        else:
+            self.stream.write(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class TranslationServer:
+    #runner: 执行一个任务的函数，参数为任务的参数字典，返回错误信息，成功返回空字符串
+    #address: 监听地址，host:port 或者 unix:/path/to/socket
+    #jobs: 同时执行的任务数量
+    def __init__(self, runner, address=DEFAULT_ADDRESS, jobs=2):
+        self.runner = runner
+        self.address = address
+        self.jobs = {} #{id: TranslationJob}
+        self.queue = queue.PriorityQueue()
+        self.seq = itertools.count()
+        self._lock = threading.Lock()
+        self.workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(1, jobs))]
+        self.httpd = None
+
+    #开始服务，阻塞直到按下 Ctrl+C
+    def serveForever(self):
+        sys.stdout = JobOutput(sys.stdout)
+        for t in self.workers:
+            t.start()
+        self.httpd = createHttpServer(self.address, self._makeHandler())
+        print(f'Listening on {self.address}, {len(self.workers)} concurrent jobs')
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.httpd.server_close()
+            if self.address.startswith('unix:') and os.path.exists(self.address[5:]):
+                os.remove(self.address[5:])
+
+    #添加一个任务，priority越大越优先，相同优先级先进先出
+    def submit(self, params, priority=0):
+        with self._lock:
+            self._evict()
+            seq = next(self.seq)
+            jobId = f'{int(time.time())}-{seq + 1}'
+            job = self.jobs[jobId] = TranslationJob(jobId, params, priority)
+        self.queue.put((-priority, seq, job))
+        print(f'Job {jobId} queued: {params.get("file")} -> {params.get("dest")}')
+        return job
+
+    #删除结束超过 JOB_RETENTION 秒的任务，结束的任务最多保留 MAX_ENDED_JOBS 个，调用者需要持有锁
+    def _evict(self):
+        ended = sorted((job for job in self.jobs.values() if job.ended), key=lambda job: job.finished)
+        expired = time.time() - JOB_RETENTION
+        for idx, job in enumerate(ended):
+            if (job.finished < expired) or (idx < len(ended) - MAX_ENDED_JOBS):
+                del self.jobs[job.id]
+
+    def cancel(self, jobId):
+        job = self.jobs.get(jobId)
+        if job and job.state == 'queued':
+            job.finish('cancelled')
+            return True
+        return False
+
+    def _worker(self):
+        while True:
+            _, _, job = self.queue.get()
+            if job.state != 'queued': #已经取消
+                continue
+            job.state = 'running'
+            job.started = time.time()
+            print(f'Job {job.id} started')
+            token = currentJob.set(job)
+            try:
+                error = self.runner(job.params)
+                state = 'failed' if error else 'done'
+                if error:
+                    print(error)
+            except BaseException as e: #包括参数错误时argparse引发的SystemExit，工作线程不能退出
+                error, state = f'{type(e).__name__}: {e}', 'failed'
+                print(f'Error: {error}')
+            finally:
+                currentJob.reset(token)
+            job.finish(state, error)
+            print(f'Job {job.id} {state}')
+
+    def _makeHandler(self):
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def address_string(self): #unix socket没有客户端地址
+                return self.client_address[0] if self.client_address else 'unix'
+
+            def sendJson(self, data, status=200):
+                body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                parts = [e for e in urlsplit(self.path).path.split('/') if e]
+                if parts == ['jobs']:
+                    return self.sendJson([job.info() for job in list(server.jobs.values())])
+                job = server.jobs.get(parts[1]) if (len(parts) >= 2 and parts[0] == 'jobs') else None
+                if not job:
+                    return self.sendJson({'error': 'not found'}, 404)
+                elif len(parts) == 2:
+                    return self.sendJson(job.info())
+                elif parts[2:] == ['events']:
+                    return self.streamEvents(job)
+                self.sendJson({'error': 'not found'}, 404)
+
+            def do_POST(self):
+                if self.path.rstrip('/') != '/jobs':
+                    return self.sendJson({'error': 'not found'}, 404)
+                try:
+                    params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    if not isinstance(params, dict):
+                        raise ValueError('parameters must be a json object')
+                    elif not (params.get('file') and params.get('dest')):
+                        raise ValueError('file and dest are required')
+                    priority = params.pop('priority', 0) or 0
+                    if not isinstance(priority, int) or isinstance(priority, bool):
+                        raise ValueError(f'invalid priority: {priority!r}')
+                except ValueError as e:
+                    return self.sendJson({'error': str(e)}, 400)
+                job = server.submit(params, priority)
+                self.sendJson({'id': job.id}, 201)
+
+            def do_DELETE(self):
+                parts = [e for e in self.path.split('/') if e]
+                if len(parts) == 2 and parts[0] == 'jobs' and server.cancel(parts[1]):
+                    return self.sendJson({'id': parts[1], 'state': 'cancelled'})
+                self.sendJson({'error': 'not found or not queued'}, 404)
+
+            #以chunked编码逐行发送任务的输出，每行为一个json对象，最后一行为任务的结束状态
+            def streamEvents(self, job):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                sent = 0
+                while True:
+                    with job.cond:
+                        while (sent >= len(job.lines)) and not job.ended:
+                            job.cond.wait(15)
+                        lines = job.lines[sent:]
+                        ended = job.ended
+                    sent += len(lines)
+                    events = [{'type': 'log', 'line': line} for line in lines]
+                    if ended:
+                        events.append({'type': 'end', 'state': job.state, 'error': job.error})
+                    data = ''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in events).encode('utf-8')
+                    try:
+                        if data:
+                            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                        if ended:
+                            self.wfile.write(b'0\r\n\r\n')
+                            return
+                        elif not data: #保持连接
+                            self.wfile.write(b'1\r\n\n\r\n')
+                    except OSError: #客户端断开
+                        return
+        return Handler
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+#根据地址创建http服务器
+def createHttpServer(address, handler):
+    if address.startswith('unix:'):
+        path = address[5:]
+        if os.path.exists(path):
+            os.remove(path)
+        return ThreadingUnixHTTPServer(path, handler)
+    host, _, port = address.rpartition(':')
+    return ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+
+#通过unix socket连接的HTTPConnection
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+#创建到服务的连接，address格式和 TranslationServer 一致，也可以带 http:// 前缀
+def connectServer(address):
+    if address.startswith('unix:'):
+        return UnixHTTPConnection(address[5:])
+    netloc = urlsplit(address if '://' in address else ('http://' + address)).netloc
+    return http.client.HTTPConnection(netloc)
+
+#客户端：提交一个任务并且打印任务的输出，直到任务结束
+#params: 任务参数字典，文件路径应该为绝对路径
+#返回任务的结束状态，'done'为成功
+def submitJob(address, params, priority=0):
+    conn = connectServer(address)
+    conn.request('POST', '/jobs', json.dumps({**params, 'priority': priority}),
+        {'Content-Type': 'application/json'})
+    resp = conn.getresponse()
+    data = json.loads(resp.read())
+    if resp.status != 201:
+        print(f'Failed to submit the job: {data.get("error")}')
+        return 'failed'
+    jobId = data['id']
+    print(f'Job {jobId} submitted to {address}')
+    conn.request('GET', f'/jobs/{jobId}/events')
+    resp = conn.getresponse()
+    state = 'failed'
+    while line := resp.readline():
+        line = line.strip()
+        if not line:
+            continue
+        event = json.loads(line)
+        if event['type'] == 'log':
+            print(event['line'])
+        elif event['type'] == 'end':
+            state = event['state']
+    conn.close()
+    return state
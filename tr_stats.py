@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#记录每个模型使用不同请求格式(json/id/placeholder)时的翻译成功率，用于自动选择最合适的格式
+#成功率为AI返回的有效翻译数量除以请求翻译的数量，结果保存为json文件，多次运行之间共享
+#选择时加上UCB探索值，统计数据少的格式偶尔也会被选中，避免一直使用预设成功率最高的格式
+#Author: cdhigh <https://github.com/cdhigh>
+import os, json, math, threading
+
+class FormatStats:
+    #没有统计数据时每种格式的预设成功率，数据越多预设值的影响越小
+    PRIOR_RATES = {'id': 0.99, 'json': 0.97, 'placeholder': 0.90}
+    PRIOR_WEIGHT = 50 #预设成功率相当于多少个条目的统计数据
+    EXPLORE_WEIGHT = 0.3 #探索值的权重，为0则总是选择成功率最高的格式
+
+    #fileName: 保存统计数据的json文件名
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._lock = threading.Lock()
+        self.stats = {} #{model: {fmt: [requested, translated]}}
+        if fileName and os.path.exists(fileName):
+            try:
+                with open(fileName, 'r', encoding='utf-8') as f:
+                    self.stats = json.load(f)
+            except Exception as e:
+                print(f'Failed to load format stats {fileName}: {e}')
+
+    def __repr__(self):
+        return f'FormatStats({self.fileName})'
+
+    #记录一个批次的翻译结果
+    #requested: 请求翻译的条目数量，translated: 返回的有效翻译数量
+    def record(self, model, fmt, requested, translated):
+        with self._lock:
+            item = self.stats.setdefault(model, {}).setdefault(fmt, [0, 0])
+            item[0] += requested
+            item[1] += translated
+
+    #返回某个模型使用某种格式的成功率估计值
+    def rate(self, model, fmt):
+        requested, translated = self.stats.get(model, {}).get(fmt, [0, 0])
+        prior = self.PRIOR_RATES.get(fmt, 0.5)
+        return (translated + prior * self.PRIOR_WEIGHT) / (requested + self.PRIOR_WEIGHT)
+
+    #返回成功率加上探索值最高的格式
+    #探索值随着这个模型总的请求条目数增加而缓慢增加，随着这个格式自己的请求条目数增加而减少
+    def choose(self, model, formats=None):
+        formats = formats or list(self.PRIOR_RATES)
+        with self._lock:
+            items = self.stats.get(model, {})
+            total = sum(items.get(fmt, [0, 0])[0] for fmt in formats)
+            def score(fmt):
+                requested = items.get(fmt, [0, 0])[0]
+                bonus = math.sqrt(math.log(total + 1) / (requested + self.PRIOR_WEIGHT))
+                return self.rate(model, fmt) + self.EXPLORE_WEIGHT * bonus
+            return max(formats, key=score)
+
+    #先保存到临时文件再替换
+    def save(self):
+        if not self.fileName:
+            return
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.fileName)), exist_ok=True)
+                tmpFile = self.fileName + '.tmp'
+                with open(tmpFile, 'w', encoding='utf-8') as f:
+                    json.dump(self.stats, f, indent=2)
+                os.replace(tmpFile, self.fileName)
+            except Exception as e:
+                print(f'Failed to save format stats {self.fileName}: {e}')